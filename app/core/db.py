@@ -4,17 +4,36 @@ from __future__ import annotations
 import asyncio
 import hashlib
 import json
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import Any, Optional
+from typing import Any, Dict, List, Mapping, Optional, Tuple
 from enum import Enum as PyEnum
 
-from sqlalchemy import JSON, Column, DateTime, Integer, String, create_engine, Text, Enum as SQLEnum
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import (
+    DDL, JSON, DateTime, Index, String, Text, bindparam, create_engine, delete, event, func, make_url, select,
+    Enum as SQLEnum,
+)
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
+from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column, sessionmaker
 
 from app.core.config import settings
 from app.utils.jsonio import to_json_safe
 
-Base = declarative_base()
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+
+class Base(DeclarativeBase):
+    """Declarative base for all ORM models."""
+
+
+# На Postgres храним бинарный jsonb: он разбирается один раз при записи, а не при каждом чтении
+JSONType = JSON().with_variant(JSONB(), "postgresql")
+
+
 _engine = None
 _SessionLocal = None
 
@@ -24,10 +43,12 @@ class LayerResult(Base):
 
     __tablename__ = "layer_results"
 
-    id = Column(Integer, primary_key=True, index=True)
-    layer = Column(String, index=True, nullable=False)
-    result = Column(JSON, nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    id: Mapped[int] = mapped_column(primary_key=True, index=True)
+    layer: Mapped[str] = mapped_column(String, index=True)
+    result: Mapped[Any] = mapped_column(JSONType)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
 
 
 class PipelineCache(Base):
@@ -35,13 +56,26 @@ class PipelineCache(Base):
 
     __tablename__ = "pipeline_cache"
 
-    id = Column(Integer, primary_key=True, index=True)
-    stage = Column(String, index=True, nullable=False)
-    input_hash = Column(String(64), index=True, nullable=False)
-    input_data = Column(JSON, nullable=False)
-    result_data = Column(JSON, nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow, index=True)
-    expires_at = Column(DateTime, nullable=True, index=True)
+    id: Mapped[int] = mapped_column(primary_key=True, index=True)
+    stage: Mapped[str] = mapped_column(String)
+    input_hash: Mapped[str] = mapped_column(String(64))
+    input_data: Mapped[Any] = mapped_column(JSONType)
+    result_data: Mapped[Any] = mapped_column(JSONType)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False, index=True
+    )
+    expires_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
+
+    # Поиск всегда идёт по паре (stage, input_hash) — один спуск по составному индексу.
+    # В индекс по expires_at попадают только записи со сроком жизни
+    __table_args__ = (
+        Index("ix_pipeline_cache_stage_hash", "stage", "input_hash", unique=True),
+        Index(
+            "ix_pipeline_cache_expires_at",
+            "expires_at",
+            postgresql_where=expires_at.column.isnot(None),
+        ),
+    )
     
     def __repr__(self):
         return f"<PipelineCache(stage='{self.stage}', hash='{self.input_hash[:8]}...')>"
@@ -52,13 +86,17 @@ class UserSession(Base):
 
     __tablename__ = "user_sessions"
 
-    id = Column(Integer, primary_key=True, index=True)
-    session_id = Column(String(64), index=True, nullable=False, unique=True)
-    import_hash = Column(String(64), nullable=True, index=True)
-    enrich_hash = Column(String(64), nullable=True, index=True)
-    analyze_hash = Column(String(64), nullable=True, index=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    last_accessed = Column(DateTime, default=datetime.utcnow, index=True)
+    id: Mapped[int] = mapped_column(primary_key=True, index=True)
+    session_id: Mapped[str] = mapped_column(String(64), index=True, unique=True)
+    import_hash: Mapped[Optional[str]] = mapped_column(String(64), index=True)
+    enrich_hash: Mapped[Optional[str]] = mapped_column(String(64), index=True)
+    analyze_hash: Mapped[Optional[str]] = mapped_column(String(64), index=True)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+    last_accessed: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False, index=True
+    )
     
     def __repr__(self):
         return f"<UserSession(id='{self.session_id}')>"
@@ -73,48 +111,65 @@ class TaskStatus(PyEnum):
     CANCELLED = "cancelled"
 
 
+_TERMINAL_TASK_STATUSES = frozenset({TaskStatus.COMPLETED, TaskStatus.FAILED, TaskStatus.CANCELLED})
+
+
 class BackgroundTask(Base):
     """Модель для фоновых задач обработки файлов"""
 
     __tablename__ = "background_tasks"
 
-    id = Column(Integer, primary_key=True, index=True)
-    task_id = Column(String(64), index=True, nullable=False, unique=True)
-    user_session = Column(String(64), nullable=True, index=True)
-    task_type = Column(String(50), nullable=False, index=True)
-    status = Column(SQLEnum(TaskStatus), default=TaskStatus.PENDING, index=True)
+    id: Mapped[int] = mapped_column(primary_key=True, index=True)
+    task_id: Mapped[str] = mapped_column(String(64), index=True, unique=True)
+    user_session: Mapped[Optional[str]] = mapped_column(String(64), index=True)
+    task_type: Mapped[str] = mapped_column(String(50), index=True)
+    status: Mapped[Optional[TaskStatus]] = mapped_column(SQLEnum(TaskStatus), default=TaskStatus.PENDING, index=True)
     
-    input_data = Column(JSON, nullable=False)
+    input_data: Mapped[Any] = mapped_column(JSONType)
     
-    import_result = Column(JSON, nullable=True)
-    enrich_result = Column(JSON, nullable=True)
-    analyze_result = Column(JSON, nullable=True)
+    import_result: Mapped[Optional[Any]] = mapped_column(JSONType)
+    enrich_result: Mapped[Optional[Any]] = mapped_column(JSONType)
+    analyze_result: Mapped[Optional[Any]] = mapped_column(JSONType)
     
-    progress = Column(Integer, default=0)
-    current_stage = Column(String(50), nullable=True)
-    error_message = Column(Text, nullable=True)
+    progress: Mapped[Optional[int]] = mapped_column(default=0)
+    current_stage: Mapped[Optional[str]] = mapped_column(String(50))
+    error_message: Mapped[Optional[str]] = mapped_column(Text)
     
-    created_at = Column(DateTime, default=datetime.utcnow, index=True)
-    started_at = Column(DateTime, nullable=True)
-    completed_at = Column(DateTime, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False, index=True
+    )
+    started_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
+    completed_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
     
-    use_cache = Column(String(10), default="true")
-    use_llm = Column(String(10), default="true")
+    use_cache: Mapped[Optional[str]] = mapped_column(String(10), default="true")
+    use_llm: Mapped[Optional[str]] = mapped_column(String(10), default="true")
+
+    __table_args__ = (
+        Index("ix_background_tasks_type_status", "task_type", "status"),
+        # Частичный индекс по активным задачам не растёт вместе с историей
+        Index(
+            "ix_background_tasks_active",
+            "created_at",
+            postgresql_where=status.column.in_([TaskStatus.PENDING, TaskStatus.RUNNING]),
+        ),
+    )
     
     def __repr__(self):
         return f"<BackgroundTask(id='{self.task_id}', status='{self.status.value}', progress={self.progress}%)>"
     
-    def to_dict(self):
-        """Преобразует задачу в словарь для API ответов"""
+    # Не колонка: (статус, байты) последнего JSON-ответа завершённой задачи
+    _cached_json = None
+
+    def _payload(self) -> dict:
         return {
             "task_id": self.task_id,
             "status": self.status.value,
             "progress": self.progress,
             "current_stage": self.current_stage,
             "error_message": self.error_message,
-            "created_at": self.created_at.isoformat() if self.created_at else None,
-            "started_at": self.started_at.isoformat() if self.started_at else None,
-            "completed_at": self.completed_at.isoformat() if self.completed_at else None,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "completed_at": self.completed_at,
             "results": {
                 "import": self.import_result,
                 "enrich": self.enrich_result,
@@ -122,6 +177,205 @@ class BackgroundTask(Base):
             }
         }
 
+    def to_dict(self):
+        """Преобразует задачу в словарь для API ответов"""
+        payload = self._payload()
+        for key in ("created_at", "started_at", "completed_at"):
+            payload[key] = payload[key].isoformat() if payload[key] else None
+        return payload
+
+    def to_json(self) -> bytes:
+        """JSON задачи в байтах; для завершённых задач результат кешируется"""
+        cached = self._cached_json
+        if cached is not None and cached[0] is self.status:
+            return cached[1]
+
+        if orjson:
+            data = orjson.dumps(self._payload())
+        else:
+            data = json.dumps(self.to_dict(), ensure_ascii=False).encode("utf-8")
+
+        if self.status in _TERMINAL_TASK_STATUSES:
+            self._cached_json = (self.status, data)
+        return data
+
+
+def _compress_with_lz4(table: Any, *columns: str) -> None:
+    """Сжимать крупные JSON-колонки в TOAST через lz4 (Postgres 14+)."""
+    alter = ", ".join(f"ALTER COLUMN {c} SET COMPRESSION lz4" for c in columns)
+    event.listen(
+        table,
+        "after_create",
+        DDL(f"ALTER TABLE {table.name} {alter}").execute_if(dialect="postgresql"),
+    )
+
+
+_compress_with_lz4(PipelineCache.__table__, "input_data", "result_data")
+_compress_with_lz4(BackgroundTask.__table__, "import_result", "enrich_result", "analyze_result")
+
+
+# Заранее построенные запросы: ключ кеша компиляции SQLAlchemy совпадает
+# при каждом вызове, поэтому SQL не компилируется заново
+_SELECT_PIPELINE_CACHE = select(PipelineCache).where(
+    PipelineCache.stage == bindparam("stage"),
+    PipelineCache.input_hash == bindparam("input_hash"),
+)
+_SELECT_PIPELINE_CACHE_RESULT = select(PipelineCache.result_data).where(
+    PipelineCache.stage == bindparam("stage"),
+    PipelineCache.input_hash == bindparam("input_hash"),
+)
+_SELECT_USER_SESSION = select(UserSession).where(UserSession.session_id == bindparam("session_id"))
+_SELECT_BACKGROUND_TASK = select(BackgroundTask).where(BackgroundTask.task_id == bindparam("task_id"))
+
+
+def get_pipeline_cache(session: Session, stage: str, input_hash: str) -> Optional[PipelineCache]:
+    """Fetch cache entry for (stage, input_hash) using the prebuilt select."""
+    return session.scalars(_SELECT_PIPELINE_CACHE, {"stage": stage, "input_hash": input_hash}).first()
+
+
+def get_pipeline_cache_result(session: Session, stage: str, input_hash: str) -> Optional[Any]:
+    """Fetch only result_data for (stage, input_hash), without hydrating an ORM object."""
+    return session.execute(
+        _SELECT_PIPELINE_CACHE_RESULT, {"stage": stage, "input_hash": input_hash}
+    ).scalar()
+
+
+def upsert_pipeline_cache(
+    session: Session,
+    stage: str,
+    input_hash: str,
+    input_data: Any,
+    result_data: Any,
+    expires_at: Optional[datetime] = None,
+) -> None:
+    """Insert or refresh a cache entry in one round trip (INSERT ... ON CONFLICT DO UPDATE)."""
+    stmt = pg_insert(PipelineCache).values(
+        stage=stage,
+        input_hash=input_hash,
+        input_data=input_data,
+        result_data=result_data,
+        created_at=func.now(),
+        expires_at=expires_at,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[PipelineCache.stage, PipelineCache.input_hash],
+        set_={
+            "input_data": stmt.excluded.input_data,
+            "result_data": stmt.excluded.result_data,
+            "created_at": stmt.excluded.created_at,
+            "expires_at": stmt.excluded.expires_at,
+        },
+    )
+    session.execute(stmt)
+
+
+def purge_expired_pipeline_cache(session: Session, batch_size: int = 5000) -> int:
+    """Delete expired cache entries in index-driven batches; returns rows deleted."""
+    expired_ids = (
+        select(PipelineCache.id)
+        .where(PipelineCache.expires_at < func.now())
+        .limit(batch_size)
+        .scalar_subquery()
+    )
+    stmt = delete(PipelineCache).where(PipelineCache.id.in_(expired_ids))
+    total = 0
+    while True:
+        deleted = session.execute(stmt).rowcount or 0
+        session.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+
+# L1: результаты pipeline_cache в памяти процесса, ключ (stage, input_hash),
+# значение (момент истечения по monotonic, result_data); порядок - LRU
+_L1_CACHE: "OrderedDict[Tuple[str, str], Tuple[float, Any]]" = OrderedDict()
+_L1_INFLIGHT: Dict[Tuple[str, str], "asyncio.Future[Any]"] = {}
+
+
+def _l1_get(key: Tuple[str, str]) -> Optional[Any]:
+    entry = _L1_CACHE.get(key)
+    if entry is None:
+        return None
+    if entry[0] < time.monotonic():
+        del _L1_CACHE[key]
+        return None
+    _L1_CACHE.move_to_end(key)
+    return entry[1]
+
+
+def _l1_put(key: Tuple[str, str], value: Any) -> None:
+    _L1_CACHE[key] = (time.monotonic() + settings.db_cache_l1_ttl_seconds, value)
+    _L1_CACHE.move_to_end(key)
+    while len(_L1_CACHE) > settings.db_cache_l1_maxsize:
+        _L1_CACHE.popitem(last=False)
+
+
+async def get_cached(stage: str, input_hash: str) -> Optional[Any]:
+    """Cached result_data for (stage, input_hash): in-process L1 first, then the DB.
+
+    Concurrent misses for the same key share one DB query.
+    """
+    key = (stage, input_hash)
+    value = _l1_get(key)
+    if value is not None:
+        return value
+
+    pending = _L1_INFLIGHT.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+
+    if _SessionLocal is None:
+        return None
+
+    future: "asyncio.Future[Any]" = asyncio.get_running_loop().create_future()
+    _L1_INFLIGHT[key] = future
+
+    def _load() -> Optional[Any]:
+        with _SessionLocal() as session:
+            return get_pipeline_cache_result(session, stage, input_hash)
+
+    try:
+        value = await asyncio.to_thread(_load)
+        if value is not None:
+            _l1_put(key, value)
+        return value
+    finally:
+        # Ошибка БД для ожидающих - просто промах кеша
+        if not future.done():
+            future.set_result(value)
+        _L1_INFLIGHT.pop(key, None)
+
+
+async def put_cached(
+    stage: str,
+    input_hash: str,
+    input_data: Any,
+    result_data: Any,
+    expires_at: Optional[datetime] = None,
+) -> None:
+    """Upsert result into pipeline_cache and the in-process L1."""
+    _l1_put((stage, input_hash), result_data)
+    if _SessionLocal is None:
+        return
+
+    def _store() -> None:
+        with _SessionLocal() as session:
+            upsert_pipeline_cache(session, stage, input_hash, input_data, result_data, expires_at)
+            session.commit()
+
+    await asyncio.to_thread(_store)
+
+
+def get_user_session(session: Session, session_id: str) -> Optional[UserSession]:
+    """Fetch user session by its public id using the prebuilt select."""
+    return session.scalars(_SELECT_USER_SESSION, {"session_id": session_id}).first()
+
+
+def get_background_task(session: Session, task_id: str) -> Optional[BackgroundTask]:
+    """Fetch background task by its public id using the prebuilt select."""
+    return session.scalars(_SELECT_BACKGROUND_TASK, {"task_id": task_id}).first()
+
 
 def init_db() -> None:
     """Initialize database connection and create tables."""
@@ -131,7 +385,21 @@ def init_db() -> None:
         return
 
     try:
-        _engine = create_engine(settings.database_url, future=True)
+        url = make_url(settings.database_url)
+        connect_args = {}
+        if url.get_driver_name() == "psycopg":
+            # psycopg 3 сам делает PREPARE для запросов, повторённых N раз
+            connect_args["prepare_threshold"] = settings.db_prepare_threshold
+        _engine = create_engine(
+            url,
+            future=True,
+            query_cache_size=1200,
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_recycle=settings.db_pool_recycle,
+            pool_pre_ping=False,
+            connect_args=connect_args,
+        )
         _SessionLocal = sessionmaker(bind=_engine, autoflush=False, autocommit=False)
         Base.metadata.create_all(bind=_engine)
     except Exception as exc:  # pragma: no cover - best effort
@@ -140,27 +408,129 @@ def init_db() -> None:
         print(f"DB init failed: {exc}")
 
 
-async def log_layer_result(layer: str, data: Any) -> None:
-    """Persist layer result to JSON storage."""
+_LOG_QUEUE_MAXSIZE = 10_000
+_LOG_BATCH_SIZE = 500
+_LOG_FLUSH_INTERVAL = 0.5  # секунды между сбросами пачек
+
+_log_queue: Optional["asyncio.Queue[Tuple[str, Any]]"] = None
+_log_consumer_task: Optional["asyncio.Task[None]"] = None
+
+
+def _write_layer_logs(records: List[Tuple[str, Any]]) -> None:
     from app.services.json_storage import json_storage
-    
-    def _log() -> None:
+
+    try:
+        json_storage.log_layer_results(records)
+    except Exception as exc:  # pragma: no cover - best effort
+        print(f"JSON log failed: {exc}")
+
+
+def _drain_log_queue(queue: "asyncio.Queue[Tuple[str, Any]]", batch: List[Tuple[str, Any]]) -> None:
+    while len(batch) < _LOG_BATCH_SIZE:
+        try:
+            batch.append(queue.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+
+
+async def _log_consumer(queue: "asyncio.Queue[Tuple[str, Any]]") -> None:
+    """Collect queued layer results and write them in batches."""
+    while True:
+        batch = [await queue.get()]
         try:
-            json_storage.log_layer_result(layer, data)
-        except Exception as exc:  # pragma: no cover - best effort
-            print(f"JSON log failed: {exc}")
+            # Даём накопиться остальным записям, чтобы писать файл раз в интервал
+            await asyncio.sleep(_LOG_FLUSH_INTERVAL)
+        finally:
+            # При остановке уже взятая из очереди пачка тоже записывается
+            _drain_log_queue(queue, batch)
+            await asyncio.to_thread(_write_layer_logs, batch)
+
+
+def start_layer_log() -> None:
+    """Start the background consumer for layer result logs (app startup)."""
+    global _log_queue, _log_consumer_task
+    if _log_consumer_task is not None:
+        return
+    _log_queue = asyncio.Queue(maxsize=_LOG_QUEUE_MAXSIZE)
+    _log_consumer_task = asyncio.get_running_loop().create_task(_log_consumer(_log_queue))
 
-    await asyncio.to_thread(_log)
 
+async def stop_layer_log() -> None:
+    """Stop the consumer and flush everything still queued (app shutdown)."""
+    global _log_queue, _log_consumer_task
+    queue, task = _log_queue, _log_consumer_task
+    _log_queue, _log_consumer_task = None, None
+    if task is None or queue is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    while not queue.empty():
+        batch: List[Tuple[str, Any]] = []
+        _drain_log_queue(queue, batch)
+        await asyncio.to_thread(_write_layer_logs, batch)
 
-def create_hash(data: Any) -> str:
-    """Create SHA256 hash from data for caching."""
-    json_str = json.dumps(
-        to_json_safe(data),
+
+async def log_layer_result(layer: str, data: Any) -> None:
+    """Persist layer result to JSON storage.
+
+    data may be a pydantic model: it is dumped by the log writer thread,
+    not on the caller's event loop.
+    """
+    if _log_queue is None:
+        # Консьюмер не запущен (скрипты, тесты) - пишем сразу
+        await asyncio.to_thread(_write_layer_logs, [(layer, data)])
+        return
+    await _log_queue.put((layer, data))
+
+
+def _canonical_bytes(data: Any) -> bytes:
+    """Serialize data to canonical (sorted keys, compact) JSON bytes."""
+    safe = to_json_safe(data)
+    if orjson:
+        return orjson.dumps(safe, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(
+        safe,
         sort_keys=True,
         ensure_ascii=False,
-    )
-    return hashlib.sha256(json_str.encode('utf-8')).hexdigest()
+        separators=(",", ":"),
+    ).encode('utf-8')
+
+
+def _feed_canonical(hasher: Any, data: Any) -> None:
+    """Feed canonical JSON of data into hasher piece by piece.
+
+    Mappings are walked key by key and lists item by item, so the bytes are
+    the same as ``_canonical_bytes(data)`` but the full payload (e.g. a list
+    of thousands of events) is never materialized as one string.
+    """
+    if isinstance(data, Mapping):
+        hasher.update(b"{")
+        for i, key in enumerate(sorted(data, key=str)):
+            if i:
+                hasher.update(b",")
+            hasher.update(_canonical_bytes(str(key)))
+            hasher.update(b":")
+            _feed_canonical(hasher, data[key])
+        hasher.update(b"}")
+    elif isinstance(data, (list, tuple)):
+        hasher.update(b"[")
+        for i, item in enumerate(data):
+            if i:
+                hasher.update(b",")
+            hasher.update(_canonical_bytes(item))
+        hasher.update(b"]")
+    else:
+        hasher.update(_canonical_bytes(data))
+
+
+def create_hash(data: Any) -> str:
+    """Create BLAKE2b-256 hash (64 hex chars) from data for caching."""
+    hasher = hashlib.blake2b(digest_size=32)
+    _feed_canonical(hasher, data)
+    return hasher.hexdigest()
 
 
 def get_session() -> Optional[sessionmaker]:
@@ -168,4 +538,4 @@ def get_session() -> Optional[sessionmaker]:
     return _SessionLocal
 
 
-__all__ = ["init_db", "log_layer_result", "LayerResult", "PipelineCache", "UserSession", "BackgroundTask", "TaskStatus", "Base", "create_hash", "get_session"]
+__all__ = ["init_db", "log_layer_result", "start_layer_log", "stop_layer_log", "LayerResult", "PipelineCache", "UserSession", "BackgroundTask", "TaskStatus", "Base", "create_hash", "get_session", "get_pipeline_cache", "get_pipeline_cache_result", "upsert_pipeline_cache", "purge_expired_pipeline_cache", "get_cached", "put_cached", "get_user_session", "get_background_task"]
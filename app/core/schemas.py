@@ -2,10 +2,10 @@
 Pydantic схемы для Smart Calendar API
 """
 from datetime import datetime
-from enum import Enum
-from typing import List, Optional, Dict, Any
+from enum import Enum, IntEnum
+from typing import List, Optional, Dict, Any, Tuple
 
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, ConfigDict, Field, model_validator
 
 
 class EventType(str, Enum):
@@ -22,6 +22,25 @@ class EventType(str, Enum):
     OTHER = "прочее"
 
 
+class EventTypeId(IntEnum):
+    """Целочисленные id типов событий для внутренних агрегаций"""
+    WORK = 0
+    STUDY = 1
+    HEALTH = 2
+    HOUSEHOLD = 3
+    FAMILY = 4
+    CREATIVE = 5
+    TRAVEL = 6
+    LEISURE = 7
+    ROUTINE = 8
+    OTHER = 9
+
+
+# Таблицы перевода EventType <-> id (индекс кортежа совпадает с id)
+EVENT_TYPE_TO_ID: Dict[EventType, int] = {t: int(EventTypeId[t.name]) for t in EventType}
+ID_TO_EVENT_TYPE: Tuple[EventType, ...] = tuple(sorted(EVENT_TYPE_TO_ID, key=EVENT_TYPE_TO_ID.__getitem__))
+
+
 class PriorityType(str, Enum):
     """Типы приоритетов"""
     REGULAR = "regular"
@@ -40,6 +59,8 @@ class TaskStatusType(str, Enum):
 
 class RawEvent(BaseModel):
     """Сырое событие для импорта"""
+    model_config = ConfigDict(frozen=True)
+
     calendar: str
     start: str
     end: str
@@ -53,7 +74,7 @@ class RawEvent(BaseModel):
 class ImportRequest(BaseModel):
     """Запрос на импорт"""
     ics_content: Optional[str] = Field(None, description="ICS файл как строка")
-    events: Optional[List[RawEvent]] = Field(None, description="Список сырых событий")
+    events: List[RawEvent] = Field(default_factory=list, description="Список сырых событий")
     timezone: str = Field("Europe/Moscow", description="Таймзона по умолчанию")
     expand_recurring: bool = Field(True, description="Развернуть повторяющиеся события")
     horizon_days: int = Field(30, description="Горизонт для разворачивания RRULE")
@@ -62,15 +83,17 @@ class ImportRequest(BaseModel):
         description="Кол-во дней до и после текущей недели для импорта. None для полного импорта",
     )
 
-    @validator('ics_content', 'events')
-    def validate_input(cls, v, values):
-        if not v and not values.get('events') and not values.get('ics_content'):
+    @model_validator(mode='after')
+    def _require_one_input(self) -> 'ImportRequest':
+        if not (self.ics_content or self.events):
             raise ValueError("Нужен либо ics_content, либо events")
-        return v
+        return self
 
 
 class Event(BaseModel):
     """Нормализованное событие"""
+    model_config = ConfigDict(frozen=True)
+
     calendar: str
     start: datetime
     end: datetime
@@ -80,11 +103,6 @@ class Event(BaseModel):
     event_type: Optional[EventType] = None
     priority_type: Optional[PriorityType] = None
 
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
-
 
 class ImportResponse(BaseModel):
     """Ответ импорта"""
@@ -93,15 +111,12 @@ class ImportResponse(BaseModel):
     events: List[Event]
     stats: Dict[str, Any] = Field(default_factory=dict)
 
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
-
 
 
 class EnrichAttributes(BaseModel):
     """Дополнительные атрибуты события"""
+    model_config = ConfigDict(frozen=True)
+
     duration_min: int
     day_of_week: int  # 1-7
     hour_of_day: int  # 0-23
@@ -124,11 +139,6 @@ class EnrichRequest(BaseModel):
     events: List[Event]
     use_llm: bool = Field(True, description="Использовать LLM для классификации")
 
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
-
 
 class EnrichResponse(BaseModel):
     """Ответ обогащения"""
@@ -136,11 +146,6 @@ class EnrichResponse(BaseModel):
     events: List[EnrichedEvent]
     enrichment_stats: Dict[str, Any] = Field(default_factory=dict)
 
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
-
 
 
 class TimeWindow(BaseModel):
@@ -168,11 +173,6 @@ class AnalyzeRequest(BaseModel):
     analysis_weeks: int = Field(2, description="Недель для анализа")
     min_sample_size: int = Field(4, description="Минимум событий для паттерна")
 
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
-
 
 class AnalyzeResponse(BaseModel):
     """Ответ анализа"""
@@ -195,14 +195,11 @@ class UserQuery(BaseModel):
 
 class TimeSlot(BaseModel):
     """Временной слот"""
+    model_config = ConfigDict(frozen=True)
+
     start: datetime
     end: datetime
 
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
-
 
 class SlotRecommendation(BaseModel):
     """Рекомендация слота"""
@@ -219,11 +216,6 @@ class RecommendRequest(BaseModel):
     search_days: int = Field(7, description="Дней вперед для поиска")
     max_alternatives: int = Field(3, description="Максимум альтернатив")
 
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
-
 
 class RecommendResponse(BaseModel):
     """Ответ с рекомендацией"""
@@ -232,11 +224,6 @@ class RecommendResponse(BaseModel):
     conflicts_found: List[str] = []
     search_stats: Dict[str, Any] = Field(default_factory=dict)
 
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
-
 
 
 class HealthResponse(BaseModel):
@@ -245,11 +232,6 @@ class HealthResponse(BaseModel):
     timestamp: datetime = Field(default_factory=datetime.now)
     version: str = "1.0.0"
 
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
-
 
 class ErrorResponse(BaseModel):
     """Стандартный ответ об ошибке"""
@@ -257,11 +239,6 @@ class ErrorResponse(BaseModel):
     detail: Optional[str] = None
     timestamp: datetime = Field(default_factory=datetime.now)
 
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
-
 
 
 class BackgroundTaskCreate(BaseModel):
@@ -281,11 +258,6 @@ class BackgroundTaskResponse(BaseModel):
     status: TaskStatusType
     message: str = "Task created successfully"
 
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
-
 
 class TaskResults(BaseModel):
     ready: bool
@@ -309,18 +281,8 @@ class BackgroundTaskStatus(BaseModel):
     completed_at: Optional[datetime] = None
     results: TaskResults = Field(default_factory=TaskResults)
 
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
-
 
 class TaskListResponse(BaseModel):
     """Список задач"""
     tasks: List[BackgroundTaskStatus]
     total: int
-
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
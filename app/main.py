@@ -1,15 +1,24 @@
+import asyncio
+import codecs
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
+from functools import lru_cache
 import logging
-from typing import Optional
+import os
+from pathlib import Path
+import re
+import sys
+from typing import Mapping, Optional
 from zoneinfo import ZoneInfo
 
 import uvicorn
 from fastapi import Depends, FastAPI, File, Form, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 
 from app.core.config import settings
+from app.core.db import start_layer_log, stop_layer_log
 from app.core.schemas import (
     AnalyzeRequest,
     AnalyzeResponse,
@@ -20,7 +29,6 @@ from app.core.schemas import (
     EnrichResponse,
     ErrorResponse,
     Event,
-    EnrichedEvent,
     EventType,
     HealthResponse,
     ImportRequest,
@@ -39,19 +47,23 @@ from app.services.cache import cache_service
 from app.services.enricher import enricher_service
 from app.services.fs_cache import (
     USE_CONTENT_CACHE,
+    aget_latest_ready_cache_key,
+    append_meta_step,
+    aset_latest_ready_for_session,
     cache_paths,
     compute_cache_key,
-    get_latest_ready_cache_key,
-    set_latest_ready_for_session,
+    load_meta,
     _now_iso,
 )
 from app.services.importer import importer_service
 from app.services.recommender import recommender_service
-from app.utils.jsonio import load_json, save_json, to_json_safe
+from app.utils.jsonio import aload_json, asave_json, dump_json_bytes, load_model, to_json_safe
 
 # Logger
 logger = logging.getLogger(__name__)
 
+_DEFAULT_TZ = ZoneInfo(settings.default_timezone)
+
 
 app = FastAPI(
     title=settings.app_name,
@@ -77,10 +89,35 @@ app.mount("/static", StaticFiles(directory="app/static"), name="static")
 #     """Initialize database on application startup."""
 #     init_db()
 
-@app.get("/favicon.ico", include_in_schema=False)
-async def favicon():
-    return FileResponse("app/static/favicon.ico")
 
+@app.on_event("startup")
+async def start_layer_log_writer() -> None:
+    """Start batched writer for layer result logs."""
+    start_layer_log()
+
+
+@app.on_event("startup")
+async def start_cache_cleanup() -> None:
+    """Start periodic cleanup of expired pipeline cache entries."""
+    cache_service.start_cleanup()
+
+
+@app.on_event("shutdown")
+async def stop_cache_cleanup() -> None:
+    """Stop periodic pipeline cache cleanup."""
+    await cache_service.stop_cleanup()
+
+
+@app.on_event("shutdown")
+async def flush_layer_log_writer() -> None:
+    """Flush pending layer result logs before exit."""
+    await stop_layer_log()
+
+
+@app.on_event("shutdown")
+async def close_llm_client() -> None:
+    """Close the shared Ollama HTTP client."""
+    await enricher_service.aclose()
 
 
 @app.get("/health", response_model=HealthResponse)
@@ -92,12 +129,6 @@ async def health_check():
     )
 
 
-@app.get("/")
-async def serve_frontend():
-    return FileResponse("app/static/index.html")
-
-
-
 @app.post(
     f"{settings.api_prefix}/import",
     response_model=ImportResponse,
@@ -139,8 +170,7 @@ async def import_events_file(
     Импортирует события из загруженного ICS файла.
     """
     try:
-        contents = await file.read()
-        ics_content = contents.decode("utf-8", errors="ignore")
+        ics_content = await _read_upload_text(file)
 
         request = ImportRequest(
             ics_content=ics_content,
@@ -327,8 +357,7 @@ async def import_enrichment_and_analyze_tasks(
     Результаты в кеш: /data/cache/<cache_key>/{import,enrich,analyze}.json
     """
     try:
-        contents = await file.read()
-        ics_content = contents.decode("utf-8", errors="ignore")
+        ics_bytes = await _read_upload_bytes(file)
     except Exception as e:
         _stage_fail("read_file", e)
 
@@ -341,116 +370,98 @@ async def import_enrichment_and_analyze_tasks(
     }
 
     try:
-        cache_key = compute_cache_key(ics_content, params)
+        cache_key = compute_cache_key(ics_bytes, params)
         p = cache_paths(cache_key)
-        if USE_CONTENT_CACHE:
-            save_json(p["meta"], {
-                "created_at": _now_iso(),
-                "status": "running",
-                "params": params,
-                "steps": {}
-            })
     except Exception as e:
         _stage_fail("compute_cache_key", e)
 
     try:
         if USE_CONTENT_CACHE and p["analyze"].exists():
-            analyze_payload = load_json(p["analyze"])
-            set_latest_ready_for_session(user_session, cache_key)
-            return TaskResults(
-                ready=True,
-                cache_key=cache_key,
-                session_id=user_session,
-                counts={
-                    "imported": (len(load_json(p["import"]).get("events", []))
-                                 if p["import"].exists() else 0),
-                    "enriched": (len(load_json(p["enrich"]).get("events", []))
-                                 if p["enrich"].exists() else 0),
-                },
-                params=params,
-                message="Hit from cache",
-                analysis=AnalyzeResponse(**analyze_payload),
+            # analyze.json отдаём как есть: без разбора, валидации и повторной сериализации
+            analyze_bytes = await asyncio.to_thread(p["analyze"].read_bytes)
+            counts = await _cached_counts(p)
+            await aset_latest_ready_for_session(user_session, cache_key)
+            head = dump_json_bytes({
+                "ready": True,
+                "cache_key": cache_key,
+                "session_id": user_session,
+                "counts": counts,
+                "params": params,
+                "message": "Hit from cache",
+            })
+            return Response(
+                content=head[:-1] + b',"analysis":' + analyze_bytes + b"}",
+                media_type="application/json",
             )
     except Exception as e:
         _stage_fail("read_cache", e, cache_key)
 
+    # meta живёт в памяти весь запрос; на диск пишется только при смене
+    # статуса: running в начале, ready или error в конце
+    meta = {
+        "created_at": _now_iso(),
+        "status": "running",
+        "params": params,
+        "steps": {}
+    }
     try:
-        import_response = await importer_service.import_events(ImportRequest(
-            ics_content=ics_content,
+        if USE_CONTENT_CACHE:
+            await asave_json(p["meta"], meta)
+            # Шаги прошлого прогона по этому ключу больше не актуальны
+            p["meta_log"].unlink(missing_ok=True)
+    except Exception as e:
+        _stage_fail("write_meta", e, cache_key)
+
+    # Записи результатов стадий идут в фоне, пока считается следующая стадия
+    pending: list = []
+
+    async with _meta_stage(meta, p, "import", cache_key, pending):
+        # Декодируем только при промахе кеша
+        import_response = await importer_service.import_events_raw(ImportRequest(
+            ics_content=ics_bytes.decode("utf-8", errors="ignore"),
             timezone=timezone,
             expand_recurring=expand_recurring,
             horizon_days=horizon_days,
             days_limit=days_limit,
         ))
         if USE_CONTENT_CACHE:
-            save_json(p["import"], import_response)
-            meta = load_json(p["meta"]); meta["steps"]["import"] = {
+            _write_behind(pending, p["import"], import_response)
+            meta["steps"]["import"] = {
                 "ok": True, "done_at": _now_iso(),
                 "count": len(import_response.events)
             }
-            save_json(p["meta"], meta)
-    except Exception as e:
-        try:
-            if USE_CONTENT_CACHE:
-                meta = load_json(p["meta"])
-                meta["steps"]["import"] = {"ok": False, "failed_at": _now_iso(), "error": str(e)}
-                meta["status"] = "error"; meta["error_stage"] = "import"; meta["error"] = str(e)
-                save_json(p["meta"], meta)
-        except Exception:
-            pass
-        _stage_fail("import", e, cache_key)
 
-    try:
-        enrich_response = await enricher_service.enrich_events(EnrichRequest(
+    async with _meta_stage(meta, p, "enrich", cache_key, pending):
+        enrich_response = await enricher_service.enrich_events_raw(EnrichRequest(
             tz=timezone,
             events=import_response.events,
             use_llm=settings.use_llm,
         ))
         if USE_CONTENT_CACHE:
-            save_json(p["enrich"], enrich_response)
-            meta = load_json(p["meta"])
+            _write_behind(pending, p["enrich"], enrich_response)
             meta["steps"]["enrich"] = {
                 "ok": True, "done_at": _now_iso(),
                 "count": len(enrich_response.events)
             }
-            save_json(p["meta"], meta)
-    except Exception as e:
-        try:
-            if USE_CONTENT_CACHE:
-                meta = load_json(p["meta"])
-                meta["steps"]["enrich"] = {"ok": False, "failed_at": _now_iso(), "error": str(e)}
-                meta["status"] = "error"; meta["error_stage"] = "enrich"; meta["error"] = str(e)
-                save_json(p["meta"], meta)
-        except Exception:
-            pass
-        _stage_fail("enrich", e, cache_key)
 
-    try:
-        analyze_response = await analyzer_service.analyze_habits(AnalyzeRequest(
+    async with _meta_stage(meta, p, "analyze", cache_key, pending):
+        analyze_response = await analyzer_service.analyze_habits_raw(AnalyzeRequest(
             tz=timezone,
             events=enrich_response.events,
         ))
         if USE_CONTENT_CACHE:
-            save_json(p["analyze"], analyze_response)
-            meta = load_json(p["meta"])
+            _write_behind(pending, p["analyze"], analyze_response)
             meta["steps"]["analyze"] = {"ok": True, "done_at": _now_iso()}
             meta["status"] = "ready"; meta["ready_at"] = _now_iso()
             meta["counts"] = {
                 "imported": len(import_response.events),
                 "enriched": len(enrich_response.events),
             }
-            save_json(p["meta"], meta)
-            set_latest_ready_for_session(user_session, cache_key)
-    except Exception as e:
-        try:
-            if USE_CONTENT_CACHE:
-                meta = load_json(p["meta"])
-                meta["steps"]["analyze"] = {"ok": False, "failed_at": _now_iso(), "error": str(e)}
-                meta["status"] = "error"; meta["error_stage"] = "analyze"; meta["error"] = str(e)
-                save_json(p["meta"], meta)
-        except Exception:
-            pass
-        _stage_fail("analyze", e, cache_key)
+            # Финальный meta пишем последним, когда все фоновые записи завершены;
+            # shield: отмена запроса (обрыв клиента) не должна обрывать запись кеша
+            await asyncio.shield(asyncio.gather(*pending))
+            await asave_json(p["meta"], meta)
+            await aset_latest_ready_for_session(user_session, cache_key)
 
     return TaskResults(
         ready=True,
@@ -481,7 +492,7 @@ async def user_query_recommendation(
     user_session: Optional[str] = Form(None),
 ):
     try:
-        use_key = cache_key or get_latest_ready_cache_key(user_session)
+        use_key = cache_key or await aget_latest_ready_cache_key(user_session)
         if not use_key:
             raise ValueError("No cache_key provided and no ready flow for this session. Run /flow/import+enrich+analyze first.")
         p = cache_paths(use_key)
@@ -491,8 +502,7 @@ async def user_query_recommendation(
         _stage_fail("resolve_cache_key", e, cache_key)
 
     try:
-        tzinfo = ZoneInfo(settings.default_timezone)
-        now = datetime.now(tzinfo)
+        now = datetime.now(_DEFAULT_TZ)
         mock_event = Event(
             calendar="__user_query__",
             start=now,
@@ -517,13 +527,12 @@ async def user_query_recommendation(
         _stage_fail("classify_user_query", e, use_key)
 
     try:
-        enrich_payload = load_json(p["enrich"])
-        analyze_payload = load_json(p["analyze"])
-        enriched_events = [EnrichedEvent(**e) for e in enrich_payload.get("events", [])]
+        # Кеш написан нами же: валидируем прямо из байтов, без промежуточных dict
+        enriched_events = (await _aload_model_cached(p["enrich"], EnrichResponse)).events
         try:
-            history_habits = AnalyzeResponse(**analyze_payload)
+            history_habits = await _aload_model_cached(p["analyze"], AnalyzeResponse)
         except Exception:
-            history_habits = analyze_payload
+            history_habits = await aload_json(p["analyze"])
     except Exception as e:
         _stage_fail("read_cache_payloads", e, use_key)
 
@@ -534,30 +543,16 @@ async def user_query_recommendation(
             history_habits=history_habits
         ))
         if USE_CONTENT_CACHE:
-            save_json(p["recommend"], recommend_response)
-            try:
-                meta = load_json(p["meta"])
-                meta_steps = meta.setdefault("steps", {})
-                meta_steps["recommend"] = {"ok": True, "done_at": _now_iso()}
-                save_json(p["meta"], meta)
-            except Exception:
-                pass
-        return recommend_response
+            await asave_json(p["recommend"], recommend_response, indent=False)
     except Exception as e:
-        if USE_CONTENT_CACHE:
-            try:
-                meta = load_json(p["meta"])
-                meta_steps = meta.setdefault("steps", {})
-                meta_steps["recommend"] = {
-                    "ok": False,
-                    "failed_at": _now_iso(),
-                    "error": str(e)
-                }
-                save_json(p["meta"], meta)
-            except Exception:
-                pass
+        await _record_meta_step(p, "recommend", {"ok": False, "failed_at": _now_iso(), "error": str(e)})
         _stage_fail("recommend", e, use_key)
 
+    await _record_meta_step(p, "recommend", {"ok": True, "done_at": _now_iso()})
+    # Ответ уже RecommendResponse: сериализуем один раз, минуя повторную
+    # валидацию response_model (он остаётся только для схемы OpenAPI)
+    return Response(content=recommend_response.model_dump_json(), media_type="application/json")
+
 
 
 @app.get(
@@ -572,16 +567,18 @@ async def get_cached_analytics(
 ):
     """Возвращает результаты анализа, сохранённые в кеше."""
     try:
-        use_key = cache_key or get_latest_ready_cache_key(user_session)
+        use_key = cache_key or await aget_latest_ready_cache_key(user_session)
         if not use_key:
             raise ValueError(
                 "No cache_key provided and no ready flow for this session. Run /flow/import+enrich+analyze first."
             )
+        if not _CACHE_KEY_RE.fullmatch(use_key):
+            raise ValueError(f"Invalid cache_key: {use_key}")
         p = cache_paths(use_key)
         if not p["analyze"].exists():
             raise FileNotFoundError(f"Analyze results not found for key={use_key}")
-        analyze_payload = load_json(p["analyze"])
-        return AnalyzeResponse.model_validate(analyze_payload)
+        # Файл записан из AnalyzeResponse, отдаём его без разбора
+        return FileResponse(p["analyze"], media_type="application/json")
     except Exception as e:
         _stage_fail("get_flow_analytics", e, cache_key)
 
@@ -802,20 +799,117 @@ async def value_error_handler(request, exc):
         content=ErrorResponse(
             error="Validation Error",
             detail=str(exc)
-        ).dict()
+        ).model_dump(mode="json")
     )
 
 
+# Конверт 500-ки вне debug статичен: меняется только timestamp
+_INTERNAL_ERROR_HEAD = dump_json_bytes(
+    {"error": "Internal Server Error", "detail": "An error occurred"}
+)[:-1] + b',"timestamp":"'
+
+
 @app.exception_handler(Exception)
 async def general_exception_handler(request, exc):
+    if not settings.debug:
+        return Response(
+            content=_INTERNAL_ERROR_HEAD + datetime.now().isoformat().encode() + b'"}',
+            status_code=500,
+            media_type="application/json",
+        )
     return JSONResponse(
         status_code=500,
         content=ErrorResponse(
             error="Internal Server Error",
-            detail=str(exc) if settings.debug else "An error occurred"
-        ).dict()
+            detail=str(exc)
+        ).model_dump(mode="json")
     )
 
+_UPLOAD_CHUNK_SIZE = 1 << 20
+_CACHE_KEY_RE = re.compile(r"[0-9a-f]{32}")
+
+
+@lru_cache(maxsize=8)
+def _load_model_cached(path_str: str, mtime_ns: int, model):
+    # mtime_ns в ключе: перезапись файла даёт новый ключ, старая запись вытесняется LRU
+    return load_model(Path(path_str), model)
+
+
+async def _aload_model_cached(path: Path, model):
+    """load_model с LRU по (путь, mtime): повторные рекомендации по одному кешу не парсят файл заново"""
+    mtime_ns = path.stat().st_mtime_ns
+    return await asyncio.to_thread(_load_model_cached, str(path), mtime_ns, model)
+
+
+async def _cached_counts(p: Mapping) -> dict:
+    """Счётчики готового прогона: из meta (meta.json + журнал meta.ndjson),
+    а для старых записей - по файлам стадий"""
+    try:
+        counts = (await asyncio.to_thread(load_meta, p)).get("counts")
+        if counts:
+            return counts
+    except Exception:
+        pass
+    return {
+        "imported": (len((await aload_json(p["import"])).get("events", []))
+                     if p["import"].exists() else 0),
+        "enriched": (len((await aload_json(p["enrich"])).get("events", []))
+                     if p["enrich"].exists() else 0),
+    }
+
+
+async def _read_upload_bytes(file: UploadFile) -> bytearray:
+    """Читает загрузку чанками в один bytearray"""
+    buf = bytearray()
+    while chunk := await file.read(_UPLOAD_CHUNK_SIZE):
+        buf += chunk
+    return buf
+
+
+async def _read_upload_text(file: UploadFile) -> str:
+    """Читает загрузку чанками и декодирует их по мере поступления"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    parts = []
+    while chunk := await file.read(_UPLOAD_CHUNK_SIZE):
+        parts.append(decoder.decode(chunk))
+    parts.append(decoder.decode(b"", final=True))
+    return "".join(parts)
+
+
+def _write_behind(pending: list, path, payload) -> None:
+    """Запускает save_json в фоне; задачи собираются перед финальной записью meta.
+    Результаты стадий читает только код - пишем компактно"""
+    pending.append(asyncio.create_task(asave_json(path, payload, indent=False)))
+
+
+@asynccontextmanager
+async def _meta_stage(meta: dict, p: Mapping, stage: str, cache_key: str, pending: list):
+    """Стадия flow: при ошибке отмечает её в meta (в памяти), сбрасывает meta на диск
+    и отвечает 400 через _stage_fail; успешные шаги записывает сама стадия"""
+    try:
+        yield
+    except Exception as e:
+        if USE_CONTENT_CACHE:
+            try:
+                await asyncio.gather(*pending, return_exceptions=True)
+                meta["steps"][stage] = {"ok": False, "failed_at": _now_iso(), "error": str(e)}
+                meta["status"] = "error"; meta["error_stage"] = stage; meta["error"] = str(e)
+                await asave_json(p["meta"], meta)
+            except Exception:
+                pass
+        _stage_fail(stage, e, cache_key)
+
+
+async def _record_meta_step(p: Mapping, stage: str, step: dict) -> None:
+    """Дописывает шаг готового кеша в журнал meta.ndjson, не трогая meta.json"""
+    if not USE_CONTENT_CACHE:
+        return
+    try:
+        await asyncio.to_thread(append_meta_step, p["meta_log"], stage, step)
+    except Exception:
+        pass
+
+
 def _stage_fail(stage: str, e: Exception, cache_key: str | None = None):
     logger.exception("Flow stage '%s' failed%s", stage, f" (cache_key={cache_key})" if cache_key else "")
     raise HTTPException(
@@ -824,11 +918,21 @@ def _stage_fail(stage: str, e: Exception, cache_key: str | None = None):
     )
 
 
+# Фронтенд (/ и /favicon.ico) отдаёт StaticFiles: монтируется последним,
+# чтобы API-маршруты выше имели приоритет
+app.mount("/", StaticFiles(directory="app/static", html=True), name="frontend")
+
+
 if __name__ == "__main__":
     uvicorn.run(
         "app.main:app",
         host="0.0.0.0",
         port=8000,
+        # uvloop и httptools входят в uvicorn[standard]; uvloop нет под Windows
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        # reload работает только с одним процессом
+        workers=1 if settings.debug else (settings.workers or os.cpu_count() or 2),
         reload=settings.debug,
         log_level="debug" if settings.debug else "info"
     )
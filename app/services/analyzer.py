@@ -2,18 +2,111 @@
 Сервис анализа привычек и паттернов пользователя
 """
 from typing import Dict, List, Tuple, Optional
-from datetime import datetime, timedelta
-from collections import defaultdict
-import statistics
-from zoneinfo import ZoneInfo
+from datetime import date, datetime, timedelta
+from collections import Counter, OrderedDict, defaultdict
+import hashlib
+from itertools import pairwise
+import json
+import math
+import struct
 
 from app.core.schemas import (
     AnalyzeRequest, AnalyzeResponse, EnrichedEvent,
-    TimeWindow, DashboardAggregates, EventType
+    TimeWindow, DashboardAggregates, EventType,
+    EVENT_TYPE_TO_ID, ID_TO_EVENT_TYPE
 )
 from app.core.config import settings
 from app.core.db import log_layer_result
 from app.services.cache import cache_service, PipelineStage
+from app.utils.timezones import get_zone
+
+
+# Сколько собранных ответов держать для повторных попаданий в кеш
+_RESPONSE_MEMO_SIZE = 32
+# Максимальный возраст результата анализа в кеше этапа
+_CACHE_MAX_AGE_HOURS = 12
+
+# Имена дней недели по date.weekday(): вместо strftime("%A") на каждое событие
+_WEEKDAY_NAMES = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+_WEEKDAY_SHORT_NAMES = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+
+
+# start/end (timestamp), их смещения от UTC, id типа, число участников
+_EVENT_FINGERPRINT = struct.Struct("<ddiiHI")
+
+
+def _events_fingerprint(params: Dict, events: List[EnrichedEvent]) -> str:
+    """BLAKE2b-256 по параметрам и тем полям событий, от которых зависит анализ.
+
+    Анализ читает только start/end (включая часовой пояс для локальных часов),
+    event_type, число участников и summary, поэтому полный model_dump событий
+    для ключа кеша не нужен.
+    """
+    hasher = hashlib.blake2b(digest_size=32)
+    hasher.update(json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    pack = _EVENT_FINGERPRINT.pack
+    for event in events:
+        start, end = event.start, event.end
+        start_offset, end_offset = start.utcoffset(), end.utcoffset()
+        hasher.update(pack(
+            start.timestamp(),
+            end.timestamp(),
+            int(start_offset.total_seconds()) if start_offset is not None else 0,
+            int(end_offset.total_seconds()) if end_offset is not None else 0,
+            EVENT_TYPE_TO_ID[event.event_type],
+            len(event.attendees),
+        ))
+        hasher.update(event.summary.encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+_WORK_ID = EVENT_TYPE_TO_ID[EventType.WORK]
+
+
+def _event_rows(events: List[EnrichedEvent]) -> List[tuple]:
+    """Поля событий, нужные анализу, за один проход.
+
+    Строка: (start, id типа, длительность в часах, час начала и конца с долями,
+    weekday, час начала, есть ли участники, summary). Окна, дашборд и паттерны
+    читают готовые значения вместо повторной арифметики над datetime.
+    """
+    rows = []
+    append = rows.append
+    for event in events:
+        start, end = event.start, event.end
+        append((
+            start,
+            EVENT_TYPE_TO_ID[event.event_type],
+            (end - start).total_seconds() / 3600,
+            start.hour + start.minute / 60,
+            end.hour + end.minute / 60,
+            start.weekday(),
+            start.hour,
+            bool(event.attendees),
+            event.summary,
+        ))
+    return rows
+
+
+def _median(values: List[float]) -> float:
+    """Медиана непустого списка: одна сортировка в C, без проверок statistics.median"""
+    ordered = sorted(values)
+    mid = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[mid]
+    return (ordered[mid - 1] + ordered[mid]) / 2
+
+
+def _stdev(values: List[float]) -> float:
+    """Выборочное стандартное отклонение во float.
+
+    statistics.stdev считает точно через Fraction и заметно медленнее;
+    для оценки разброса часов такой точности не нужно.
+    """
+    n = len(values)
+    mean = math.fsum(values) / n
+    return math.sqrt(math.fsum((x - mean) ** 2 for x in values) / (n - 1))
 
 
 class AnalyzerService:
@@ -22,60 +115,58 @@ class AnalyzerService:
     def __init__(self):
         self.default_windows = settings.default_time_windows
         self.min_sample_size = settings.min_events_for_pattern
+        # input_hash -> (dict результата из кеша, собранный AnalyzeResponse)
+        self._response_memo: "OrderedDict[str, Tuple[Dict, AnalyzeResponse]]" = OrderedDict()
 
     async def analyze_habits(self, request: AnalyzeRequest, use_cache: bool = True) -> AnalyzeResponse:
         """Анализирует привычки и строит профиль пользователя с поддержкой кеширования"""
         
+        if not use_cache:
+            # Без кеша результат собирается прямо из моделей, без dump/validate
+            default_windows, dashboard, patterns = await self._analyze_raw(request)
+            await log_layer_result(
+                "analyze", self._response_data(request.tz, default_windows, dashboard, patterns)
+            )
+            return AnalyzeResponse(
+                tz=request.tz,
+                default_windows=default_windows,
+                dashboard_aggregates=dashboard,
+                patterns=patterns
+            )
+
+        # В записи кеша храним только параметры; события входят в хеш
+        # отпечатком полей, которые читает анализ
         cache_input = {
             "tz": request.tz,
-            "events": [event.model_dump() if hasattr(event, 'model_dump') else event.dict() for event in request.events],
+            "events_count": len(request.events),
             "analysis_weeks": request.analysis_weeks,
             "min_sample_size": request.min_sample_size
         }
+        input_hash = _events_fingerprint(cache_input, request.events)
+
+        # Горячий ключ: результат ещё в LRU кеша этапа и ответ по нему уже собран
+        memo = self._response_memo.get(input_hash)
+        if memo is not None and memo[0] is cache_service.peek_cached_result(
+            PipelineStage.ANALYZE, input_hash, max_age_hours=_CACHE_MAX_AGE_HOURS
+        ):
+            self._response_memo.move_to_end(input_hash)
+            return memo[1]
 
         async def _compute_analyze():
             """Внутренняя функция для выполнения анализа"""
-            tz = ZoneInfo(request.tz)
-            now = datetime.now(tz)
-
-            cutoff_date = now - timedelta(weeks=request.analysis_weeks)
-            relevant_events = [
-                e for e in request.events
-                if e.start >= cutoff_date
-            ]
-
-            default_windows = await self._analyze_time_windows(
-                relevant_events,
-                request.min_sample_size
-            )
-
-            dashboard = await self._calculate_dashboard_aggregates(
-                relevant_events,
-                now
-            )
-
-            patterns = await self._extract_patterns(relevant_events)
-
-            response_data = {
-                "tz": request.tz,
-                "default_windows": {k.value if hasattr(k, 'value') else str(k): v.model_dump() if hasattr(v, 'model_dump') else v.dict() for k, v in default_windows.items()},
-                "dashboard_aggregates": dashboard.model_dump() if hasattr(dashboard, 'model_dump') else dashboard.dict(),
-                "patterns": patterns
-            }
-            
+            default_windows, dashboard, patterns = await self._analyze_raw(request)
+            response_data = self._response_data(request.tz, default_windows, dashboard, patterns)
             await log_layer_result("analyze", response_data)
             return response_data
 
-        if use_cache:
-            result_data = await cache_service.get_or_cache(
-                PipelineStage.ANALYZE,
-                cache_input,
-                _compute_analyze,
-                max_age_hours=12,
-                expires_hours=24
-            )
-        else:
-            result_data = await _compute_analyze()
+        result_data = await cache_service.get_or_cache(
+            PipelineStage.ANALYZE,
+            cache_input,
+            _compute_analyze,
+            max_age_hours=_CACHE_MAX_AGE_HOURS,
+            expires_hours=24,
+            input_hash=input_hash
+        )
 
         default_windows = {}
         for k, v in result_data["default_windows"].items():
@@ -84,34 +175,97 @@ class AnalyzerService:
         
         dashboard = DashboardAggregates.model_validate(result_data["dashboard_aggregates"])
         
-        return AnalyzeResponse(
+        response = AnalyzeResponse(
             tz=result_data["tz"],
             default_windows=default_windows,
             dashboard_aggregates=dashboard,
             patterns=result_data["patterns"]
         )
+        self._response_memo[input_hash] = (result_data, response)
+        if len(self._response_memo) > _RESPONSE_MEMO_SIZE:
+            self._response_memo.popitem(last=False)
+        return response
+
+    @staticmethod
+    def _response_data(
+        tz: str,
+        default_windows: Dict[EventType, TimeWindow],
+        dashboard: DashboardAggregates,
+        patterns: Dict
+    ) -> Dict:
+        """Словарь результата для JSON-кеша этапа и лога слоя"""
+        return {
+            "tz": tz,
+            "default_windows": {k.value: v.model_dump() for k, v in default_windows.items()},
+            "dashboard_aggregates": dashboard.model_dump(),
+            "patterns": patterns
+        }
+
+    async def analyze_habits_raw(self, request: AnalyzeRequest) -> AnalyzeResponse:
+        """Анализ без кеша этапа и логирования: результат собирается из моделей, без dump/validate"""
+        default_windows, dashboard, patterns = await self._analyze_raw(request)
+        return AnalyzeResponse(
+            tz=request.tz,
+            default_windows=default_windows,
+            dashboard_aggregates=dashboard,
+            patterns=patterns
+        )
+
+    async def _analyze_raw(
+        self,
+        request: AnalyzeRequest
+    ) -> Tuple[Dict[EventType, TimeWindow], DashboardAggregates, Dict]:
+        """Окна по типам, агрегаты дашборда и паттерны за период анализа"""
+        tz = get_zone(request.tz)
+        now = datetime.now(tz)
+
+        cutoff_date = now - timedelta(weeks=request.analysis_weeks)
+        relevant_events = [
+            e for e in request.events
+            if e.start >= cutoff_date
+        ]
+
+        rows = _event_rows(relevant_events)
+
+        default_windows = await self._analyze_time_windows(
+            rows,
+            request.min_sample_size
+        )
+
+        dashboard = await self._calculate_dashboard_aggregates(
+            rows,
+            now
+        )
+
+        patterns = await self._extract_patterns(rows)
+
+        return default_windows, dashboard, patterns
 
     async def _analyze_time_windows(
         self,
-        events: List[EnrichedEvent],
+        rows: List[tuple],
         min_sample_size: int
     ) -> Dict[EventType, TimeWindow]:
         """Анализирует временные окна для каждого типа событий"""
 
         windows = {}
 
-        # Группируем события по типам
-        events_by_type = defaultdict(list)
-        for event in events:
-            events_by_type[event.event_type].append(event)
+        # Один проход по событиям: часы начала/конца сразу раскладываются
+        # по спискам, индексированным id типа
+        start_hours: List[List[float]] = [[] for _ in ID_TO_EVENT_TYPE]
+        end_hours: List[List[float]] = [[] for _ in ID_TO_EVENT_TYPE]
+        for _start, type_id, _duration, start_hour, end_hour, *_ in rows:
+            start_hours[type_id].append(start_hour)
+            end_hours[type_id].append(end_hour)
 
         # Анализируем каждый тип
         for event_type in EventType:
-            type_events = events_by_type.get(event_type, [])
+            type_id = EVENT_TYPE_TO_ID[event_type]
+            sample_size = len(start_hours[type_id])
 
-            if len(type_events) >= min_sample_size:
+            if sample_size >= min_sample_size:
                 # Достаточно данных для анализа
-                window = self._calculate_time_window(type_events)
+                window = self._calculate_time_window(start_hours[type_id], end_hours[type_id])
                 windows[event_type] = window
             else:
                 # Используем дефолтные значения
@@ -120,33 +274,24 @@ class AnalyzerService:
                     start=default[0],
                     end=default[1],
                     confidence=0.0,  # Низкая уверенность, т.к. мало данных
-                    sample_size=len(type_events)
+                    sample_size=sample_size
                 )
 
         return windows
 
-    def _calculate_time_window(self, events: List[EnrichedEvent]) -> TimeWindow:
-        """Вычисляет оптимальное временное окно для списка событий"""
+    def _calculate_time_window(self, start_hours: List[float], end_hours: List[float]) -> TimeWindow:
+        """Вычисляет оптимальное временное окно по часам начала и окончания событий"""
 
-        if not events:
+        if not start_hours:
             return TimeWindow(start="09:00", end="17:00", confidence=0.0, sample_size=0)
 
-        # Собираем времена начала и окончания
-        start_hours = []
-        end_hours = []
-
-        for event in events:
-            start_hour = event.start.hour + event.start.minute / 60
-            end_hour = event.end.hour + event.end.minute / 60
-
-            start_hours.append(start_hour)
-            end_hours.append(end_hour)
+        sample_size = len(start_hours)
 
         # Используем квантили для устойчивости к выбросам
         # 25-й квантиль для начала (чтобы захватить ранние события)
         # 75-й квантиль для конца (чтобы захватить поздние события)
 
-        if len(start_hours) >= 3:
+        if sample_size >= 3:
             # Сортируем для квантилей
             start_hours.sort()
             end_hours.sort()
@@ -164,18 +309,18 @@ class AnalyzerService:
 
         else:
             # Мало данных, используем медиану
-            window_start = statistics.median(start_hours)
-            window_end = statistics.median(end_hours)
+            window_start = _median(start_hours)
+            window_end = _median(end_hours)
 
         # Форматируем время
         start_time = f"{int(window_start):02d}:{int((window_start % 1) * 60):02d}"
         end_time = f"{int(window_end):02d}:{int((window_end % 1) * 60):02d}"
 
         # Вычисляем уверенность на основе разброса данных
-        if len(start_hours) >= 3:
+        if sample_size >= 3:
             # Стандартное отклонение как мера разброса
-            std_start = statistics.stdev(start_hours)
-            std_end = statistics.stdev(end_hours)
+            std_start = _stdev(start_hours)
+            std_end = _stdev(end_hours)
 
             # Чем меньше разброс, тем выше уверенность
             # Нормализуем: если STD < 1 час, уверенность высокая
@@ -187,72 +332,68 @@ class AnalyzerService:
             start=start_time,
             end=end_time,
             confidence=confidence,
-            sample_size=len(events)
+            sample_size=sample_size
         )
 
     async def _calculate_dashboard_aggregates(
         self,
-        events: List[EnrichedEvent],
+        rows: List[tuple],
         now: datetime
     ) -> DashboardAggregates:
         """Вычисляет агрегаты для дашборда"""
 
         # Фильтруем события за последнюю неделю
         week_ago = now - timedelta(days=7)
-        week_events = [e for e in events if e.start >= week_ago]
+        week_rows = [row for row in rows if row[0] >= week_ago]
 
         # Базовые метрики
-        total_events = len(week_events)
-
-        # Часы по категориям
-        hours_by_category = defaultdict(float)
-        total_hours = 0
-        durations = []
-
-        for event in week_events:
-            duration = (event.end - event.start).total_seconds() / 3600
-            hours_by_category[event.event_type.value] += duration
-            total_hours += duration
-            durations.append(duration * 60)  # В минутах для средней длительности
-
-        # Часы встреч (работа с участниками)
-        meetings_hours = sum(
-            (e.end - e.start).total_seconds() / 3600
-            for e in week_events
-            if e.event_type == EventType.WORK and len(e.attendees) > 0
-        )
-
-        # Часы фокусной работы (работа без участников)
-        focus_hours = sum(
-            (e.end - e.start).total_seconds() / 3600
-            for e in week_events
-            if e.event_type == EventType.WORK and len(e.attendees) == 0
-        )
+        total_events = len(week_rows)
+
+        # Один проход: длительность считается один раз на событие и сразу
+        # раскладывается по категориям, встречам/фокусу и дням
+        hours = [0.0] * len(ID_TO_EVENT_TYPE)
+        seen = [False] * len(ID_TO_EVENT_TYPE)
+        meetings_hours = 0.0  # работа с участниками
+        focus_hours = 0.0  # работа без участников
+        total_minutes = 0.0
+        events_by_day: Dict[int, int] = defaultdict(int)  # ключ - ordinal даты
+        for start, type_id, duration, _sh, _eh, _wd, _hour, has_attendees, _summary in week_rows:
+            hours[type_id] += duration
+            seen[type_id] = True
+            if type_id == _WORK_ID:
+                if has_attendees:
+                    meetings_hours += duration
+                else:
+                    focus_hours += duration
+            total_minutes += duration * 60
+            events_by_day[start.toordinal()] += 1
+
+        hours_by_category = {
+            ID_TO_EVENT_TYPE[type_id].value: hours[type_id]
+            for type_id in range(len(ID_TO_EVENT_TYPE))
+            if seen[type_id]
+        }
 
         # Самый загруженный день
-        events_by_day = defaultdict(int)
-        for event in week_events:
-            day_key = event.start.date().isoformat()
-            events_by_day[day_key] += 1
-
         busiest_day = None
         if events_by_day:
-            busiest = max(events_by_day.items(), key=lambda x: x[1])
-            busiest_day = busiest[0]
+            # Строка ISO строится один раз, для победившего дня
+            busiest_ordinal = max(events_by_day, key=events_by_day.__getitem__)
+            busiest_day = date.fromordinal(busiest_ordinal).isoformat()
 
         # Средняя длительность
-        avg_duration = statistics.mean(durations) if durations else 0
+        avg_duration = total_minutes / total_events if total_events else 0
 
         return DashboardAggregates(
             total_events=total_events,
             meetings_hours=round(meetings_hours, 1),
             focus_hours=round(focus_hours, 1),
-            by_category=dict(hours_by_category),
+            by_category=hours_by_category,
             busiest_day=busiest_day,
             average_duration_min=round(avg_duration, 0)
         )
 
-    async def _extract_patterns(self, events: List[EnrichedEvent]) -> Dict:
+    async def _extract_patterns(self, rows: List[tuple]) -> Dict:
         """Извлекает дополнительные паттерны из событий"""
 
         patterns = {
@@ -263,48 +404,48 @@ class AnalyzerService:
             "time_distribution": {}
         }
 
-        if not events:
+        if not rows:
             return patterns
 
-        # Анализ продуктивных часов (когда больше всего событий)
-        hour_counts = defaultdict(int)
-        for event in events:
-            hour_counts[event.start.hour] += 1
+        # Один проход собирает все счётчики по заранее посчитанным полям событий
+        hour_counts: Counter = Counter()
+        meeting_days: Counter = Counter()  # ключ - weekday(), имена подставляются в конце
+        day_hours = [0.0] * 7  # сумма часов по weekday()
+        day_counts = [0] * 7  # число событий по weekday()
+        event_names: Dict[str, List[datetime]] = defaultdict(list)
+        category_hours = [0.0] * len(ID_TO_EVENT_TYPE)
+        seen = [False] * len(ID_TO_EVENT_TYPE)
+        total_hours = 0.0
+        for start, type_id, duration, _sh, _eh, weekday, hour, has_attendees, summary in rows:
+            hour_counts[hour] += 1
+            if has_attendees:
+                meeting_days[weekday] += 1
+            day_hours[weekday] += duration
+            day_counts[weekday] += 1
+            event_names[summary].append(start)
 
-        if hour_counts:
-            # Топ-3 продуктивных часа
-            top_hours = sorted(hour_counts.items(), key=lambda x: x[1], reverse=True)[:3]
-            patterns["most_productive_hours"] = [
-                {"hour": h, "count": c} for h, c in top_hours
-            ]
+            category_hours[type_id] += duration
+            seen[type_id] = True
+            total_hours += duration
 
-        # Предпочитаемые дни для встреч
-        meeting_days = defaultdict(int)
-        for event in events:
-            if len(event.attendees) > 0:
-                weekday = event.start.strftime("%A")
-                meeting_days[weekday] += 1
+        # Топ-3 продуктивных часа (когда больше всего событий)
+        patterns["most_productive_hours"] = [
+            {"hour": h, "count": c} for h, c in hour_counts.most_common(3)
+        ]
 
-        if meeting_days:
-            top_days = sorted(meeting_days.items(), key=lambda x: x[1], reverse=True)[:2]
-            patterns["preferred_meeting_days"] = [d[0] for d in top_days]
+        # Предпочитаемые дни для встреч
+        patterns["preferred_meeting_days"] = [
+            _WEEKDAY_NAMES[weekday] for weekday, _ in meeting_days.most_common(2)
+        ]
 
         # Средняя загрузка по дням недели
-        day_loads = defaultdict(list)
-        for event in events:
-            weekday = event.start.weekday()
-            duration = (event.end - event.start).total_seconds() / 3600
-            day_loads[weekday].append(duration)
-
-        for day, loads in day_loads.items():
-            day_name = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"][day]
-            patterns["average_day_load"][day_name] = round(sum(loads) / len(loads), 1)
+        patterns["average_day_load"] = {
+            _WEEKDAY_SHORT_NAMES[day]: round(day_hours[day] / day_counts[day], 1)
+            for day in range(7)
+            if day_counts[day]
+        }
 
         # Поиск повторяющихся событий (одинаковое название в разные дни)
-        event_names = defaultdict(list)
-        for event in events:
-            event_names[event.summary].append(event.start)
-
         for name, dates in event_names.items():
             if len(dates) >= 3:  # Минимум 3 повторения
                 patterns["recurring_events"].append({
@@ -314,17 +455,11 @@ class AnalyzerService:
                 })
 
         # Распределение времени по категориям
-        category_hours = defaultdict(float)
-        total_hours = 0
-        for event in events:
-            duration = (event.end - event.start).total_seconds() / 3600
-            category_hours[event.event_type.value] += duration
-            total_hours += duration
-
         if total_hours > 0:
-            for category, hours in category_hours.items():
-                percentage = (hours / total_hours) * 100
-                patterns["time_distribution"][category] = round(percentage, 1)
+            for type_id in range(len(ID_TO_EVENT_TYPE)):
+                if seen[type_id]:
+                    percentage = (category_hours[type_id] / total_hours) * 100
+                    patterns["time_distribution"][ID_TO_EVENT_TYPE[type_id].value] = round(percentage, 1)
 
         return patterns
 
@@ -334,20 +469,14 @@ class AnalyzerService:
         if len(dates) < 2:
             return "разовое"
 
-        # Сортируем даты
+        # Сортируем даты (события приходят отсортированными, так что timsort здесь линеен)
         dates.sort()
 
-        # Вычисляем интервалы между событиями
-        deltas = []
-        for i in range(1, len(dates)):
-            delta = (dates[i] - dates[i-1]).days
-            deltas.append(delta)
-
-        if not deltas:
-            return "разовое"
+        # Интервалы между соседними событиями в целых днях, без копии среза dates[1:]
+        deltas = [(later - earlier).days for earlier, later in pairwise(dates)]
 
         # Медианный интервал
-        median_delta = statistics.median(deltas)
+        median_delta = _median(deltas)
 
         # Определяем частоту
         if median_delta <= 1:
@@ -2,8 +2,10 @@
 Сервис для управления фоновыми задачами обработки файлов
 """
 import asyncio
+import hashlib
 import uuid
 from datetime import datetime, timedelta
+from pathlib import Path
 from typing import Optional, Dict, Any, List
 
 from app.core.schemas import ImportRequest, EnrichRequest, AnalyzeRequest
@@ -19,6 +21,9 @@ class BackgroundTaskService:
     def __init__(self):
         self.storage = json_storage
         self._running_tasks = {}  # Словарь активных задач в памяти
+        # Загруженные ICS лежат отдельными файлами по хешу содержимого,
+        # в записи задачи - только путь и хеш
+        self.ics_dir = self.storage.data_dir / "ics"
 
     async def create_ics_processing_task(
         self, 
@@ -38,9 +43,25 @@ class BackgroundTaskService:
             task_id: Уникальный идентификатор задачи
         """
         task_id = str(uuid.uuid4())
+
+        ics_bytes = ics_content.encode("utf-8")
+        ics_hash = hashlib.blake2b(ics_bytes, digest_size=16).hexdigest()
+        ics_path = self.ics_dir / f"{ics_hash}.ics"
+
+        def _store_ics():
+            # Повторная загрузка того же файла ничего не пишет
+            if not ics_path.exists():
+                self.ics_dir.mkdir(parents=True, exist_ok=True)
+                # Через временный файл: параллельная задача не прочитает недописанный ICS
+                tmp_path = ics_path.with_suffix(f".{task_id}.tmp")
+                tmp_path.write_bytes(ics_bytes)
+                tmp_path.replace(ics_path)
+
+        await asyncio.to_thread(_store_ics)
         
         input_data = {
-            "ics_content": ics_content,
+            "ics_path": str(ics_path),
+            "ics_hash": ics_hash,
             "timezone": timezone,
             "expand_recurring": expand_recurring,
             "horizon_days": horizon_days,
@@ -88,8 +109,11 @@ class BackgroundTaskService:
             )
             
             # Этап 1: Импорт
+            ics_content = await asyncio.to_thread(
+                Path(input_data["ics_path"]).read_text, encoding="utf-8"
+            )
             import_request = ImportRequest(
-                ics_content=input_data["ics_content"],
+                ics_content=ics_content,
                 timezone=input_data["timezone"],
                 expand_recurring=input_data["expand_recurring"],
                 horizon_days=input_data["horizon_days"],
@@ -101,9 +125,14 @@ class BackgroundTaskService:
                 use_cache=input_data["use_cache"]
             )
             
-            # Сохраняем результат импорта
-            await self._update_task_result(task_id, "import", import_result.model_dump())
-            await self._update_task_status(task_id, "running", progress=33, current_stage="enrich")
+            # Результат импорта и переход к обогащению - одной записью
+            await self._update_task_status(
+                task_id,
+                "running",
+                progress=33,
+                current_stage="enrich",
+                results={"import": import_result.model_dump()}
+            )
             
             # Этап 2: Обогащение
             enrich_request = EnrichRequest(
@@ -117,9 +146,14 @@ class BackgroundTaskService:
                 use_cache=input_data["use_cache"]
             )
             
-            # Сохраняем результат обогащения
-            await self._update_task_result(task_id, "enrich", enrich_result.model_dump())
-            await self._update_task_status(task_id, "running", progress=66, current_stage="analyze")
+            # Результат обогащения и переход к анализу - одной записью
+            await self._update_task_status(
+                task_id,
+                "running",
+                progress=66,
+                current_stage="analyze",
+                results={"enrich": enrich_result.model_dump()}
+            )
             
             # Этап 3: Анализ
             analyze_request = AnalyzeRequest(
@@ -134,14 +168,14 @@ class BackgroundTaskService:
                 use_cache=input_data["use_cache"]
             )
             
-            # Сохраняем результат анализа и завершаем
-            await self._update_task_result(task_id, "analyze", analyze_result.model_dump())
+            # Результат анализа и завершение - одной записью
             await self._update_task_status(
                 task_id, 
                 "completed", 
                 progress=100, 
                 current_stage="completed",
-                completed_at=datetime.utcnow()
+                completed_at=datetime.utcnow(),
+                results={"analyze": analyze_result.model_dump()}
             )
             
         except Exception as e:
@@ -209,9 +243,10 @@ class BackgroundTaskService:
         current_stage: Optional[str] = None,
         error_message: Optional[str] = None,
         started_at: Optional[datetime] = None,
-        completed_at: Optional[datetime] = None
+        completed_at: Optional[datetime] = None,
+        results: Optional[Dict[str, Any]] = None
     ) -> bool:
-        """Обновляет статус задачи в JSON"""
+        """Обновляет статус задачи в JSON; results ({этап: результат}) пишутся той же записью"""
         
         def _update():
             updates = {"status": status}
@@ -225,32 +260,13 @@ class BackgroundTaskService:
                 updates["started_at"] = started_at.isoformat()
             if completed_at is not None:
                 updates["completed_at"] = completed_at.isoformat()
+            for stage, result_data in (results or {}).items():
+                updates[f"results.{stage}"] = result_data
             
             return self.storage.update_background_task(task_id, updates)
         
         return await asyncio.to_thread(_update)
 
-    async def _update_task_result(
-        self, 
-        task_id: str, 
-        stage: str, 
-        result_data: Dict[str, Any]
-    ) -> bool:
-        """Обновляет результат конкретного этапа"""
-        
-        def _update():
-            updates = {f"results.{stage}": result_data}
-            
-            task = self.storage.get_background_task(task_id)
-            if task:
-                if "results" not in task:
-                    task["results"] = {}
-                task["results"][stage] = result_data
-                return self.storage.update_background_task(task_id, {"results": task["results"]})
-            return False
-        
-        return await asyncio.to_thread(_update)
-
 
 # Глобальный экземпляр сервиса фоновых задач
 background_service = BackgroundTaskService()
\ No newline at end of file
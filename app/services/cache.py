@@ -2,13 +2,33 @@
 Сервис кеширования результатов пайплайна
 """
 import asyncio
+import logging
+import statistics
+import time
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
-from typing import Any, Optional, Dict, List
+from typing import Any, Optional, Dict, List, Set, Tuple
 from enum import Enum
 
+from app.core.config import settings
 from app.core.db import create_hash
 from app.services.json_storage import json_storage
 
+logger = logging.getLogger(__name__)
+
+
+# Адаптивный TTL: срок жизни новой записи - 2 x медиана интервала между
+# обращениями к одному ключу этого этапа, в пределах [1 ч, 48 ч]
+_HIT_GAP_WINDOW = 128  # последних интервалов на этап
+_HIT_GAP_MIN_SAMPLES = 8  # меньше - используем expires_hours вызывающего
+_ADAPTIVE_TTL_MIN_HOURS = 1.0
+_ADAPTIVE_TTL_MAX_HOURS = 48.0
+_ACCESS_TRACK_MAX = 4096  # ключей с временем последнего обращения
+
+# Как часто перечитывать набор известных хешей этапа: записи других
+# процессов (несколько воркеров uvicorn) становятся видны с этой задержкой
+_KNOWN_HASHES_REFRESH_SECONDS = 30.0
+
 
 class PipelineStage(str, Enum):
     """Этапы пайплайна для кеширования"""
@@ -22,12 +42,90 @@ class CacheService:
 
     def __init__(self):
         self.storage = json_storage
+        # LRU в памяти процесса: (этап, хеш) -> (created_at, expires_at, результат);
+        # горячие ключи отдаются без похода в пул потоков и разбора JSON
+        self._lru: "OrderedDict[Tuple[str, str], Tuple[datetime, Optional[datetime], Any]]" = OrderedDict()
+        self._lru_max = settings.pipeline_cache_lru_maxsize
+        # (этап, хеш) -> future идущего вычисления (single-flight в get_or_cache)
+        self._inflight: Dict[Tuple[str, str], "asyncio.Future[Any]"] = {}
+        # Время последнего обращения к ключу и интервалы повторных обращений по этапам
+        self._last_access: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._hit_gaps: Dict[str, deque] = {}
+        # Этап -> (когда прочитан, хеши записей в хранилище): промах по
+        # неизвестному хешу не идёт в пул потоков и не читает JSON
+        self._known_hashes: Dict[str, Tuple[float, Set[str]]] = {}
+        self._cleanup_task: Optional["asyncio.Task[None]"] = None
+
+    def _lru_get(self, key: Tuple[str, str], max_age_hours: int) -> Optional[Any]:
+        hit = self._lru.get(key)
+        if hit is None:
+            return None
+        now = datetime.utcnow()
+        # Срок жизни записи (в т.ч. адаптивный) действует и для копии в памяти
+        if hit[1] is not None and now > hit[1]:
+            del self._lru[key]
+            return None
+        if hit[0] < now - timedelta(hours=max_age_hours):
+            return None
+        self._lru.move_to_end(key)
+        return hit[2]
+
+    def _lru_put(
+        self, key: Tuple[str, str], created_at: datetime, expires_at: Optional[datetime], result: Any
+    ) -> None:
+        self._lru[key] = (created_at, expires_at, result)
+        self._lru.move_to_end(key)
+        if len(self._lru) > self._lru_max:
+            self._lru.popitem(last=False)
+
+    def _note_access(self, key: Tuple[str, str]) -> None:
+        """Запоминает обращение к ключу; повторное даёт интервал для адаптивного TTL.
+
+        Вызывается только при записи и при чтении из хранилища: попадания в LRU
+        идут с интервалом в секунды и прижали бы TTL самых востребованных этапов к минимуму.
+        """
+        now = time.monotonic()
+        last = self._last_access.pop(key, None)
+        if last is not None:
+            gaps = self._hit_gaps.get(key[0])
+            if gaps is None:
+                gaps = self._hit_gaps[key[0]] = deque(maxlen=_HIT_GAP_WINDOW)
+            gaps.append(now - last)
+        self._last_access[key] = now
+        if len(self._last_access) > _ACCESS_TRACK_MAX:
+            self._last_access.popitem(last=False)
+
+    def _expires_hours_for(self, stage: PipelineStage, expires_hours: Optional[float]) -> Optional[float]:
+        """TTL новой записи по наблюдаемым интервалам повторного использования этапа"""
+        gaps = self._hit_gaps.get(stage.value)
+        if not expires_hours or gaps is None or len(gaps) < _HIT_GAP_MIN_SAMPLES:
+            return expires_hours
+        hours = 2 * statistics.median(gaps) / 3600
+        return min(max(hours, _ADAPTIVE_TTL_MIN_HOURS), _ADAPTIVE_TTL_MAX_HOURS)
+
+    async def _stage_hashes(self, stage: PipelineStage) -> Set[str]:
+        known = self._known_hashes.get(stage.value)
+        now = time.monotonic()
+        if known is None or now - known[0] > _KNOWN_HASHES_REFRESH_SECONDS:
+            hashes = await asyncio.to_thread(self.storage.list_cache_hashes, stage.value)
+            known = self._known_hashes[stage.value] = (now, hashes)
+        return known[1]
+
+    def peek_cached_result(
+        self,
+        stage: PipelineStage,
+        input_hash: str,
+        max_age_hours: int = 24
+    ) -> Optional[Any]:
+        """Результат из LRU в памяти без обращения к хранилищу (None при промахе)"""
+        return self._lru_get((stage.value, input_hash), max_age_hours)
 
     async def get_cached_result(
         self, 
         stage: PipelineStage, 
         input_data: Any,
-        max_age_hours: int = 24
+        max_age_hours: int = 24,
+        input_hash: Optional[str] = None
     ) -> Optional[Dict[str, Any]]:
         """
         Получает закешированный результат для этапа пайплайна.
@@ -36,11 +134,20 @@ class CacheService:
             stage: Этап пайплайна
             input_data: Входные данные для хеширования
             max_age_hours: Максимальный возраст кеша в часах
+            input_hash: Готовый хеш входа (тогда input_data не хешируется)
         
         Returns:
             Закешированный результат или None если не найден/устарел
         """
-        input_hash = create_hash(input_data)
+        input_hash = input_hash or create_hash(input_data)
+        key = (stage.value, input_hash)
+        hit = self._lru_get(key, max_age_hours)
+        if hit is not None:
+            return hit
+
+        # Хеша точно нет в хранилище - файл кеша не читаем
+        if input_hash not in await self._stage_hashes(stage):
+            return None
         
         def _get_cache():
             entry = self.storage.get_cache_entry(stage.value, input_hash)
@@ -54,16 +161,24 @@ class CacheService:
                 if created_at < cutoff_time:
                     return None
             
-            return entry.get('result_data')
+            expires_at = self.storage._parse_datetime(entry.get('expires_at'))
+            return created_at or datetime.utcnow(), expires_at, entry.get('result_data')
 
-        return await asyncio.to_thread(_get_cache)
+        found = await asyncio.to_thread(_get_cache)
+        if found is None or found[2] is None:
+            return None
+        # LRU трогаем только из event loop, не из рабочего потока
+        self._lru_put(key, *found)
+        self._note_access(key)
+        return found[2]
 
     async def cache_result(
         self, 
         stage: PipelineStage, 
         input_data: Any, 
         result_data: Any,
-        expires_hours: Optional[int] = None
+        expires_hours: Optional[int] = None,
+        input_hash: Optional[str] = None
     ) -> bool:
         """
         Кеширует результат этапа пайплайна.
@@ -73,15 +188,24 @@ class CacheService:
             input_data: Входные данные
             result_data: Результат для кеширования
             expires_hours: Время жизни кеша в часах (опционально)
+            input_hash: Готовый хеш входа (тогда input_data не хешируется)
         
         Returns:
             True если успешно закеширован, False при ошибке
         """
-        input_hash = create_hash(input_data)
+        input_hash = input_hash or create_hash(input_data)
+        key = (stage.value, input_hash)
+        expires_hours = self._expires_hours_for(stage, expires_hours)
         expires_at = None
         if expires_hours:
             expires_at = datetime.utcnow() + timedelta(hours=expires_hours)
 
+        self._lru_put(key, datetime.utcnow(), expires_at, result_data)
+        self._note_access(key)
+        known = self._known_hashes.get(stage.value)
+        if known is not None:
+            known[1].add(input_hash)
+
         def _cache():
             return self.storage.save_cache_entry(
                 stage.value, 
@@ -99,7 +223,8 @@ class CacheService:
         input_data: Any, 
         compute_func,
         max_age_hours: int = 24,
-        expires_hours: Optional[int] = None
+        expires_hours: Optional[int] = None,
+        input_hash: Optional[str] = None
     ) -> Any:
         """
         Получает результат из кеша или вычисляет и кеширует его.
@@ -110,22 +235,46 @@ class CacheService:
             compute_func: Функция для вычисления результата (async)
             max_age_hours: Максимальный возраст кеша
             expires_hours: Время жизни нового кеша
+            input_hash: Готовый хеш входа (тогда input_data не хешируется)
         
         Returns:
             Результат (из кеша или вычисленный)
         """
+        # Хешируем вход один раз на чтение и запись
+        input_hash = input_hash or create_hash(input_data)
+
         # Пытаемся получить из кеша
-        cached_result = await self.get_cached_result(stage, input_data, max_age_hours)
+        cached_result = await self.get_cached_result(stage, input_data, max_age_hours, input_hash)
         if cached_result is not None:
             return cached_result
 
-        # Вычисляем результат
-        result = await compute_func()
-        
-        # Кешируем результат
-        await self.cache_result(stage, input_data, result, expires_hours)
-        
-        return result
+        # Параллельные промахи по тому же ключу ждут уже идущее вычисление
+        key = (stage.value, input_hash)
+        pending = self._inflight.get(key)
+        if pending is not None:
+            result = await asyncio.shield(pending)
+            if result is not None:
+                return result
+            # Вычисление, которое мы ждали, упало - считаем сами
+
+        future: "asyncio.Future[Any]" = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        result = None
+        try:
+            # Вычисляем результат
+            result = await compute_func()
+            future.set_result(result)
+
+            # Кешируем результат
+            await self.cache_result(stage, input_data, result, expires_hours, input_hash)
+
+            return result
+        finally:
+            # При ошибке ожидающие получают None и считают сами
+            if not future.done():
+                future.set_result(None)
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
 
     async def invalidate_cache(
         self, 
@@ -142,6 +291,14 @@ class CacheService:
         Returns:
             Количество удаленных записей
         """
+        if stage:
+            for key in [k for k in self._lru if k[0] == stage.value]:
+                del self._lru[key]
+            self._known_hashes.pop(stage.value, None)
+        else:
+            self._lru.clear()
+            self._known_hashes.clear()
+
         def _invalidate():
             return self.storage.invalidate_cache(
                 stage.value if stage else None,
@@ -160,8 +317,36 @@ class CacheService:
         def _cleanup():
             return self.storage.cleanup_expired_cache()
 
+        # Наборы хешей перечитаются при следующем обращении
+        self._known_hashes.clear()
         return await asyncio.to_thread(_cleanup)
 
+    async def _cleanup_loop(self, interval_seconds: float) -> None:
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                await self.cleanup_expired_cache()
+            except Exception:
+                logger.exception("Ошибка очистки кеша этапов")
+
+    def start_cleanup(self) -> None:
+        """Запускает периодическую очистку просроченных записей (старт приложения)"""
+        if self._cleanup_task is not None:
+            return
+        interval = max(1, settings.pipeline_cache_cleanup_minutes) * 60.0
+        self._cleanup_task = asyncio.get_running_loop().create_task(self._cleanup_loop(interval))
+
+    async def stop_cleanup(self) -> None:
+        """Останавливает периодическую очистку (остановка приложения)"""
+        task, self._cleanup_task = self._cleanup_task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
     async def get_cache_stats(self) -> Dict[str, Any]:
         """
         Получает статистику кеша.
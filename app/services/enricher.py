@@ -1,20 +1,75 @@
 """
 Сервис обогащения событий атрибутами
 """
+import asyncio
+import hashlib
 import json
+import logging
 import re
-from typing import List, Optional
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
 from zoneinfo import ZoneInfo
 
-import requests
+import httpx
+from pydantic import TypeAdapter
 
-from app.core.config import settings, EVENT_KEYWORDS, PRIORITY_KEYWORDS
+from app.core.config import (
+    settings, EVENT_KEYWORDS, PRIORITY_KEYWORDS,
+    EVENT_KEYWORD_MATCHER, PRIORITY_KEYWORD_MATCHER
+)
 from app.core.schemas import (
     EnrichRequest, EnrichResponse, Event, EnrichedEvent,
     EnrichAttributes, EventType, PriorityType
 )
 from app.core.db import log_layer_result
 from app.services.cache import cache_service, PipelineStage
+from app.services.json_storage import json_storage
+from app.utils.timezones import get_zone
+
+logger = logging.getLogger(__name__)
+
+
+# Сколько живёт сохранённая LLM-классификация одного текста события
+_LLM_LABEL_TTL = timedelta(hours=72)
+
+# Сериализация списков событий одним вызовом pydantic-core вместо model_dump на каждое
+_EVENTS_ADAPTER = TypeAdapter(List[Event])
+_ENRICHED_EVENTS_ADAPTER = TypeAdapter(List[EnrichedEvent])
+
+# Значение типа (как его возвращает LLM) -> EventType
+_EVENT_TYPE_BY_VALUE = {t.value: t for t in EventType}
+# Перечень типов для промптов
+_EVENT_TYPES_LIST = ", ".join(_EVENT_TYPE_BY_VALUE)
+
+# Шаблоны промптов LLM: перечень типов подставлен один раз, поля события -
+# через format_map (значения полей шаблоном не разбираются)
+_EVENT_PROMPT_TEMPLATE = (
+    'Event: "{summary}"\n'
+    '            Description: "{description}"\n'
+    '            Time: {start} - {end}\n'
+    '            Day: {day}\n'
+    '            Attendees: {attendees}'
+)
+_CLASSIFY_PROMPT_TEMPLATE = f"""
+            Classify this calendar event into one of these types: {_EVENT_TYPES_LIST}
+
+            {_EVENT_PROMPT_TEMPLATE}
+
+            Return JSON:
+            {{{{"type": "event_type", "confidence": 0.0-1.0}}}}
+            """
+
+# Шаблоны тегов (текст уже в нижнем регистре)
+_HASHTAG_RE = re.compile(r"#(\w+)")
+_ONLINE_RE = re.compile(r"online|zoom|teams")
+_DEADLINE_RE = re.compile(r"deadline|дедлайн")
+
+# (рабочие часы, выходной) для слота weekday * 24 + hour: рабочие часы 9-18 в будни
+_SLOT_FLAGS = tuple(
+    (weekday < 5 and 9 <= hour < 18, weekday >= 5)
+    for weekday in range(7)
+    for hour in range(24)
+)
 
 
 class EnricherService:
@@ -23,71 +78,62 @@ class EnricherService:
     def __init__(self):
         self.event_keywords = EVENT_KEYWORDS
         self.priority_keywords = PRIORITY_KEYWORDS
-        self.default_tz = ZoneInfo(settings.default_timezone)
+        self.event_matcher = EVENT_KEYWORD_MATCHER
+        self.priority_matcher = PRIORITY_KEYWORD_MATCHER
+        self.default_tz = get_zone(settings.default_timezone)
+
+        # Таблицы правил по индексу категории матчера
+        categories = self.event_matcher.categories
+        index = {c: i for i, c in enumerate(categories)}
+        self._rule_types: Tuple[Optional[EventType], ...] = tuple(_EVENT_TYPE_BY_VALUE.get(c) for c in categories)
+        # +3 за эвристики
+        self._rule_max_scores: Tuple[int, ...] = tuple(len(self.event_keywords[c]) + 3 for c in categories)
+
+        def _bumps(*pairs: Tuple[str, float]) -> Tuple[Tuple[int, float], ...]:
+            return tuple((index[c], bump) for c, bump in pairs if c in index)
+
+        self._morning_bumps = _bumps(("здоровье_и_активность", 1), ("личные_рутины_и_уход", 1))
+        self._work_bumps = _bumps(("работа", 1))
+        self._evening_bumps = _bumps(
+            ("учёба_и_саморазвитие", 0.5), ("семья_и_отношения", 0.5), ("отдых_и_досуг", 0.5)
+        )
+        # Общий клиент держит соединения к Ollama; семафор ограничивает число
+        # одновременных запросов (согласовать с OLLAMA_NUM_PARALLEL сервера)
+        self.llm_client = httpx.AsyncClient(
+            base_url=settings.ollama_url,
+            timeout=settings.ollama_timeout,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32)
+        )
+        self.llm_semaphore = asyncio.Semaphore(max(1, settings.ollama_parallel))
+        # Ключ текста события -> {"type", "confidence", "expires_at"}; читается
+        # с диска при первой LLM-классификации
+        self._llm_labels: Optional[Dict[str, Dict[str, Any]]] = None
+
+    async def aclose(self) -> None:
+        """Закрывает HTTP-клиент LLM"""
+        await self.llm_client.aclose()
 
     async def enrich_events(self, request: EnrichRequest, use_cache: bool = True) -> EnrichResponse:
         """Обогащает события дополнительными атрибутами с поддержкой кеширования"""
         
         cache_input = {
             "tz": request.tz,
-            "events": [event.model_dump() if hasattr(event, 'model_dump') else event.dict() for event in request.events],
+            "events": _EVENTS_ADAPTER.dump_python(request.events),
             "use_llm": request.use_llm
         }
 
+        # События, посчитанные в этом вызове: при промахе кеша отдаём их,
+        # не разбирая обратно только что сериализованные dict
+        fresh_events: List[EnrichedEvent] = []
+
         async def _compute_enrich():
             """Внутренняя функция для выполнения обогащения"""
-            enriched_events = []
-            stats = {
-                "total_events": len(request.events),
-                "classified_by_rules": 0,
-                "classified_by_llm": 0,
-                "classification_failures": 0,
-                "event_types": {}
-            }
-
-            tz = ZoneInfo(request.tz)
-
-            for event in request.events:
-                if request.use_llm and settings.use_llm:
-                    event_type, confidence = await self._classify_with_llm(event)
-                    if event_type:
-                        stats["classified_by_llm"] += 1
-                else:
-                    event_type, confidence = self._classify_with_rules(event)
-                    if event_type != EventType.OTHER:
-                        stats["classified_by_rules"] += 1
-
-                if not event_type:
-                    event_type = EventType.OTHER
-                    confidence = 0.0
-                    stats["classification_failures"] += 1
-
-                # Определяем приоритет
-                priority_type = self._determine_priority(event)
-
-                # Вычисляем дополнительные атрибуты
-                enrich_attrs = self._calculate_attributes(event, tz, confidence)
-
-                enriched_event = EnrichedEvent(
-                    calendar=event.calendar,
-                    start=event.start,
-                    end=event.end,
-                    summary=event.summary,
-                    description=event.description,
-                    attendees=event.attendees,
-                    event_type=event_type,
-                    priority_type=priority_type,
-                    enrich_attrs=enrich_attrs
-                )
-
-                enriched_events.append(enriched_event)
-
-                # Обновляем статистику
-                stats["event_types"][event_type] = stats["event_types"].get(event_type, 0) + 1
+            enriched_events, stats = await self._enrich_raw(request)
+            fresh_events.extend(enriched_events)
 
             response_data = {
                 "tz": request.tz,
-                "events": [event.model_dump() if hasattr(event, 'model_dump') else event.dict() for event in enriched_events],
+                "events": _ENRICHED_EVENTS_ADAPTER.dump_python(enriched_events),
                 "enrichment_stats": stats
             }
             
@@ -105,8 +151,11 @@ class EnricherService:
         else:
             result_data = await _compute_enrich()
 
-        # Преобразуем обратно в объекты
-        enriched_events = [EnrichedEvent.model_validate(event_data) for event_data in result_data["events"]]
+        # Преобразуем обратно в объекты (только для результата из кеша)
+        if fresh_events:
+            enriched_events = fresh_events
+        else:
+            enriched_events = [EnrichedEvent.model_validate(event_data) for event_data in result_data["events"]]
         
         return EnrichResponse(
             tz=result_data["tz"],
@@ -114,72 +163,208 @@ class EnricherService:
             enrichment_stats=result_data["enrichment_stats"]
         )
 
-    def _classify_with_rules(self, event: Event) -> tuple[EventType, float]:
-        """Классификация на основе правил и ключевых слов"""
+    async def enrich_events_raw(self, request: EnrichRequest) -> EnrichResponse:
+        """Обогащение без кеша этапа и логирования: события остаются моделями, без dump/validate"""
+        enriched_events, stats = await self._enrich_raw(request)
+        return EnrichResponse(
+            tz=request.tz,
+            events=enriched_events,
+            enrichment_stats=stats
+        )
 
-        # Объединяем текст для анализа
-        text = f"{event.summary} {event.description}".lower()
+    async def _enrich_raw(self, request: EnrichRequest) -> Tuple[List[EnrichedEvent], Dict[str, Any]]:
+        """Классифицирует события и считает атрибуты"""
+        enriched_events = []
+        stats = {
+            "total_events": len(request.events),
+            "classified_by_rules": 0,
+            "classified_by_llm": 0,
+            "classification_failures": 0,
+            "event_types": {}
+        }
 
-        # Счетчики совпадений для каждого типа
-        scores = {}
+        tz = get_zone(request.tz)
+
+        use_llm = request.use_llm and settings.use_llm
+        if use_llm:
+            llm_results = await self._classify_all_with_llm(request.events)
+
+        for i, event in enumerate(request.events):
+            # Текст для поиска ключевых слов собирается один раз на событие
+            text = f"{event.summary} {event.description}".lower()
+
+            if use_llm:
+                event_type, confidence = llm_results[i]
+                if event_type:
+                    stats["classified_by_llm"] += 1
+            else:
+                event_type, confidence = self._classify_with_rules(event, text)
+                if event_type != EventType.OTHER:
+                    stats["classified_by_rules"] += 1
+
+            if not event_type:
+                event_type = EventType.OTHER
+                confidence = 0.0
+                stats["classification_failures"] += 1
+
+            # Определяем приоритет
+            priority_type = self._determine_priority(event, text)
+
+            # Вычисляем дополнительные атрибуты
+            enrich_attrs = self._calculate_attributes(event, tz, confidence, text)
+
+            enriched_event = EnrichedEvent(
+                calendar=event.calendar,
+                start=event.start,
+                end=event.end,
+                summary=event.summary,
+                description=event.description,
+                attendees=event.attendees,
+                event_type=event_type,
+                priority_type=priority_type,
+                enrich_attrs=enrich_attrs
+            )
 
-        for event_type, keywords in self.event_keywords.items():
-            score = 0
-            matched_keywords = []
+            enriched_events.append(enriched_event)
 
-            for keyword in keywords:
-                if keyword.lower() in text:
-                    score += 1
-                    matched_keywords.append(keyword)
+            # Обновляем статистику
+            stats["event_types"][event_type] = stats["event_types"].get(event_type, 0) + 1
 
-            if score > 0:
-                scores[event_type] = (score, matched_keywords)
+        return enriched_events, stats
 
-        # Дополнительные эвристики
+    async def _classify_all_with_llm(
+            self,
+            events: List[Event]
+    ) -> List[tuple[Optional[EventType], float]]:
+        """Классифицирует события через LLM с кешем по тексту события.
+
+        Повторяющиеся события (регулярные встречи) берутся из кеша на диске;
+        остальные уходят пачками параллельно (число одновременных ограничено
+        семафором), а пачка, ответ на которую не разобрался, классифицируется
+        по одному событию.
+        """
+        if self._llm_labels is None:
+            self._llm_labels = await asyncio.to_thread(json_storage.load_llm_labels)
+        labels = self._llm_labels
+        now = datetime.utcnow().isoformat()
+
+        # В LLM уходят только тексты, которых нет в кеше, и каждый - один раз
+        keys = [self._llm_label_key(event) for event in events]
+        pending: Dict[str, Event] = {}
+        for key, event in zip(keys, events):
+            if key is None:
+                continue
+            label = labels.get(key)
+            if label is not None and label["expires_at"] <= now:
+                del labels[key]
+                label = None
+            if label is None and key not in pending:
+                pending[key] = event
+        uncached = [event for key, event in zip(keys, events) if key is None]
+
+        to_classify = list(pending.values()) + uncached
+        classified = await self._classify_uncached_with_llm(to_classify)
+
+        expires_at = (datetime.utcnow() + _LLM_LABEL_TTL).isoformat()
+        new_labels = {}
+        for key, (event_type, confidence) in zip(pending, classified):
+            if event_type is not None:
+                new_labels[key] = {"type": event_type.value, "confidence": confidence, "expires_at": expires_at}
+        if new_labels:
+            labels.update(new_labels)
+            await asyncio.to_thread(json_storage.save_llm_labels, new_labels)
+
+        fresh = dict(zip(pending, classified))
+        uncached_results = iter(classified[len(pending):])
+        results: List[tuple[Optional[EventType], float]] = []
+        for key in keys:
+            if key is None:
+                results.append(next(uncached_results))
+            elif key in fresh:
+                results.append(fresh[key])
+            else:
+                label = labels[key]
+                results.append((EventType(label["type"]), label["confidence"]))
+        return results
+
+    @staticmethod
+    def _llm_label_key(event: Event) -> Optional[str]:
+        """Ключ кеша LLM-классификации по нормализованному тексту события"""
+        summary = event.summary.strip().lower()
+        if not summary:
+            return None
+        description = (event.description or "").strip().lower()
+        return hashlib.blake2b(
+            f"{summary}\x1f{description}".encode("utf-8"), digest_size=16
+        ).hexdigest()
+
+    async def _classify_uncached_with_llm(
+            self,
+            events: List[Event]
+    ) -> List[tuple[Optional[EventType], float]]:
+        """Запросы к LLM пачками по ollama_batch_size"""
+        batch_size = max(1, settings.ollama_batch_size)
+        batches = [events[i:i + batch_size] for i in range(0, len(events), batch_size)]
+
+        async def _run(batch: List[Event]) -> List[tuple[Optional[EventType], float]]:
+            if len(batch) > 1:
+                results = await self._classify_batch_with_llm(batch)
+                if results is not None:
+                    return results
+            return list(await asyncio.gather(*(self._classify_with_llm(event) for event in batch)))
+
+        results: List[tuple[Optional[EventType], float]] = []
+        for batch_results in await asyncio.gather(*(_run(batch) for batch in batches)):
+            results.extend(batch_results)
+        return results
+
+    def _classify_with_rules(self, event: Event, text: Optional[str] = None) -> tuple[EventType, float]:
+        """Классификация на основе правил и ключевых слов"""
+
+        # Объединяем текст для анализа
+        if text is None:
+            text = f"{event.summary} {event.description}".lower()
+
+        # Счетчики совпадений по индексу категории (один проход по тексту)
+        scores = self.event_matcher.count_by_category(text)
+        if not any(scores):
+            return EventType.OTHER, 0.0
+
+        # Дополнительные эвристики: бонус только категориям, у которых уже есть совпадения
 
         # Время события для уточнения типа
         hour = event.start.hour
 
         # Утренние события скорее всего спорт или рутины
         if 6 <= hour < 9:
-            if "здоровье_и_активность" in scores:
-                scores["здоровье_и_активность"] = (
-                scores["здоровье_и_активность"][0] + 1, scores["здоровье_и_активность"][1])
-            if "личные_рутины_и_уход" in scores:
-                scores["личные_рутины_и_уход"] = (
-                scores["личные_рутины_и_уход"][0] + 1, scores["личные_рутины_и_уход"][1])
-
+            bumps = self._morning_bumps
         # Рабочее время - скорее всего работа
         elif 9 <= hour < 18 and event.start.weekday() < 5:
-            if "работа" in scores:
-                scores["работа"] = (scores["работа"][0] + 1, scores["работа"][1])
-
+            bumps = self._work_bumps
         # Вечернее время - учеба, семья, отдых
         elif 18 <= hour < 22:
-            for category in ["учёба_и_саморазвитие", "семья_и_отношения", "отдых_и_досуг"]:
-                if category in scores:
-                    scores[category] = (scores[category][0] + 0.5, scores[category][1])
+            bumps = self._evening_bumps
+        else:
+            bumps = ()
 
-        # Проверка участников
-        if len(event.attendees) > 2:
-            # Много участников - скорее всего встреча/работа
-            if "работа" in scores:
-                scores["работа"] = (scores["работа"][0] + 1, scores["работа"][1])
+        for index, bump in bumps:
+            if scores[index]:
+                scores[index] += bump
 
-        # Выбираем тип с максимальным счетом
-        if scores:
-            best_type = max(scores.items(), key=lambda x: x[1][0])
-            event_type_str = best_type[0]
-            score = best_type[1][0]
-            max_possible_score = len(self.event_keywords[event_type_str]) + 3  # +3 за эвристики
-            confidence = min(score / max_possible_score, 1.0)
+        # Много участников - скорее всего встреча/работа
+        if len(event.attendees) > 2:
+            for index, bump in self._work_bumps:
+                if scores[index]:
+                    scores[index] += bump
 
-            # Конвертируем строку в EventType
-            for enum_type in EventType:
-                if enum_type.value == event_type_str:
-                    return enum_type, confidence
+        # Выбираем тип с максимальным счетом (при равенстве - первый по порядку категорий)
+        best = max(range(len(scores)), key=scores.__getitem__)
+        enum_type = self._rule_types[best]
+        if enum_type is None:
+            return EventType.OTHER, 0.0
 
-        return EventType.OTHER, 0.0
+        confidence = min(scores[best] / self._rule_max_scores[best], 1.0)
+        return enum_type, confidence
 
     async def _classify_with_llm(self, event: Event) -> tuple[Optional[EventType], float]:
         """Классификация с помощью LLM"""
@@ -189,65 +374,128 @@ class EnricherService:
 
         try:
             # Формируем промпт
-            event_types_list = ", ".join([t.value for t in EventType])
+            prompt = _CLASSIFY_PROMPT_TEMPLATE.format_map(self._prompt_fields(event))
+
+            result = await self._generate(prompt)
+            if result is not None:
+                return self._parse_classification(json.loads(result))
+
+        except Exception as e:
+            logger.warning("LLM classification error: %s", e)
+
+        return None, 0.0
+
+    async def _classify_batch_with_llm(
+            self,
+            events: List[Event]
+    ) -> Optional[List[tuple[Optional[EventType], float]]]:
+        """Классификация пачки событий одним запросом к LLM.
+
+        Возвращает None, если ответ не удалось разобрать (или число
+        результатов не совпало с числом событий).
+        """
+
+        if not settings.use_llm:
+            return None
+
+        try:
+            events_block = "\n\n".join(
+                f"{i}) {self._describe_event(event)}" for i, event in enumerate(events, 1)
+            )
 
             prompt = f"""
-            Classify this calendar event into one of these types: {event_types_list}
+            Classify each of these {len(events)} calendar events into one of these types: {_EVENT_TYPES_LIST}
 
-            Event: "{event.summary}"
-            Description: "{event.description}"
-            Time: {event.start.strftime('%H:%M')} - {event.end.strftime('%H:%M')}
-            Day: {event.start.strftime('%A')}
-            Attendees: {len(event.attendees)}
+            {events_block}
 
-            Return JSON:
-            {{"type": "event_type", "confidence": 0.0-1.0}}
+            Return JSON with one result per event, in the same order:
+            {{"results": [{{"type": "event_type", "confidence": 0.0-1.0}}, ...]}}
             """
 
-            # Вызов Ollama
-            response = requests.post(
-                f"{settings.ollama_url}/api/generate",
+            result = await self._generate(prompt)
+            if result is None:
+                return None
+
+            data = json.loads(result)
+            items = data.get("results") if isinstance(data, dict) else data
+            if not isinstance(items, list) or len(items) != len(events):
+                return None
+
+            return [self._parse_classification(item) for item in items]
+
+        except Exception as e:
+            logger.warning("LLM batch classification error: %s", e)
+
+        return None
+
+    @staticmethod
+    def _prompt_fields(event: Event) -> Dict[str, Any]:
+        """Поля события для шаблонов промпта"""
+        return {
+            "summary": event.summary,
+            "description": event.description,
+            "start": event.start.strftime('%H:%M'),
+            "end": event.end.strftime('%H:%M'),
+            "day": event.start.strftime('%A'),
+            "attendees": len(event.attendees),
+        }
+
+    @classmethod
+    def _describe_event(cls, event: Event) -> str:
+        """Описание события для промпта"""
+        return _EVENT_PROMPT_TEMPLATE.format_map(cls._prompt_fields(event))
+
+    async def _generate(self, prompt: str) -> Optional[str]:
+        """Запрос к Ollama, возвращает текст ответа без думающей части"""
+
+        # Вызов Ollama
+        async with self.llm_semaphore:
+            response = await self.llm_client.post(
+                "/api/generate",
                 json={
                     "model": settings.ollama_model,
                     "prompt": prompt,
                     "stream": False,
                     "format": "json"
-                },
-                timeout=settings.ollama_timeout
+                }
             )
 
-            if response.status_code == 200:
-                result = response.json().get("response", "{}")
+        if response.status_code != 200:
+            return None
 
-                # Обрезаем думающую часть для qwen
-                if "</think>" in result:
-                    result = result.split("</think>")[1].strip()
+        result = response.json().get("response", "{}")
 
-                data = json.loads(result)
-                event_type_str = data.get("type")
-                val = data.get("confidence")
-                confidence = 0.5 if val is None else float(val)
-                # confidence = float(data.get("confidence", 0.5))
+        # Обрезаем думающую часть для qwen
+        if "</think>" in result:
+            result = result.split("</think>")[1].strip()
 
-                # Конвертируем в EventType
-                for enum_type in EventType:
-                    if enum_type.value == event_type_str:
-                        return enum_type, confidence
+        return result
 
-        except Exception as e:
-            print(f"LLM classification error: {e}")
+    @staticmethod
+    def _parse_classification(data: Any) -> tuple[Optional[EventType], float]:
+        """Тип и уверенность из JSON-ответа LLM"""
+        if not isinstance(data, dict):
+            return None, 0.0
 
-        return None, 0.0
+        event_type_str = data.get("type")
+        val = data.get("confidence")
+        confidence = 0.5 if val is None else float(val)
+
+        # Конвертируем в EventType; неизвестный тип - неудачная классификация
+        enum_type = _EVENT_TYPE_BY_VALUE.get(event_type_str)
+        if enum_type is None:
+            return None, 0.0
+        return enum_type, confidence
 
-    def _determine_priority(self, event: Event) -> PriorityType:
+    def _determine_priority(self, event: Event, text: Optional[str] = None) -> PriorityType:
         """Определяет приоритет события"""
 
-        text = f"{event.summary} {event.description}".lower()
+        if text is None:
+            text = f"{event.summary} {event.description}".lower()
 
         # Проверяем ключевые слова высокого приоритета
-        for keyword in self.priority_keywords["high"]:
-            if keyword.lower() in text:
-                return PriorityType.HIGH
+        if self.priority_matcher.search(text):
+            return PriorityType.HIGH
 
         # Проверяем другие признаки высокого приоритета
 
@@ -268,35 +516,29 @@ class EnricherService:
             self,
             event: Event,
             tz: ZoneInfo,
-            confidence: float
+            confidence: float,
+            text: Optional[str] = None
     ) -> EnrichAttributes:
         """Вычисляет дополнительные атрибуты события"""
 
-        # Длительность в минутах
-        duration = event.end - event.start
-        duration_min = int(duration.total_seconds() / 60)
-
-        # День недели (1-7, понедельник = 1)
-        day_of_week = event.start.weekday() + 1
+        start = event.start
 
-        # Час дня
-        hour_of_day = event.start.hour
+        # Длительность в минутах
+        duration_min = int((event.end - start).total_seconds() / 60)
 
-        # Рабочие часы (9-18 в будни)
-        is_working_hours = (
-                9 <= hour_of_day < 18 and
-                day_of_week <= 5
-        )
+        # День недели (0-6) и час дня
+        weekday = start.weekday()
+        hour_of_day = start.hour
 
-        # Выходной день
-        is_weekend = day_of_week > 5
+        # Рабочие часы (9-18 в будни) и выходной - по таблице слотов недели
+        is_working_hours, is_weekend = _SLOT_FLAGS[weekday * 24 + hour_of_day]
 
         # Извлекаем теги из текста
-        tags = self._extract_tags(event)
+        tags = self._extract_tags(event, text)
 
         return EnrichAttributes(
             duration_min=duration_min,
-            day_of_week=day_of_week,
+            day_of_week=weekday + 1,  # 1-7, понедельник = 1
             hour_of_day=hour_of_day,
             is_working_hours=is_working_hours,
             is_weekend=is_weekend,
@@ -304,28 +546,35 @@ class EnricherService:
             category_confidence=confidence
         )
 
-    def _extract_tags(self, event: Event) -> List[str]:
+    def _extract_tags(self, event: Event, text: Optional[str] = None) -> List[str]:
         """Извлекает теги из события"""
 
-        tags = []
-        text = f"{event.summary} {event.description}".lower()
+        if text is None:
+            text = f"{event.summary} {event.description}".lower()
 
         # Извлекаем хештеги
-        hashtags = re.findall(r'#(\w+)', text)
-        tags.extend(hashtags)
+        tags = _HASHTAG_RE.findall(text) if "#" in text else []
 
         # Добавляем специальные теги
         if len(event.attendees) > 0:
             tags.append("meeting")
 
-        if "online" in text or "zoom" in text or "teams" in text:
+        if _ONLINE_RE.search(text):
             tags.append("online")
 
-        if "deadline" in text or "дедлайн" in text:
+        if _DEADLINE_RE.search(text):
             tags.append("deadline")
 
-        # Ограничиваем количество тегов
-        return list(set(tags))[:10]
+        # Убираем повторы с сохранением порядка и ограничиваем количество тегов
+        unique: List[str] = []
+        seen = set()
+        for tag in tags:
+            if tag not in seen:
+                seen.add(tag)
+                unique.append(tag)
+                if len(unique) == 10:
+                    break
+        return unique
 
 
 enricher_service = EnricherService()
\ No newline at end of file
@@ -1,4 +1,5 @@
 from __future__ import annotations
+import asyncio
 from pathlib import Path
 from typing import Any, Mapping
 from datetime import datetime, date, time, timedelta
@@ -9,11 +10,30 @@ from decimal import Decimal
 from pathlib import Path as _Path
 import json
 
+from app.utils.jsonio import write_bytes_atomic
+
 try:
     import orjson
 except Exception:
     orjson = None
 
+try:
+    from pydantic import BaseModel
+except Exception:
+    BaseModel = None
+
+_ORJSON_OPTIONS = (
+    orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    if orjson else 0
+)
+
+# Типы numpy для _json_default; без numpy - пустые кортежи, isinstance(obj, ()) всегда False
+try:
+    import numpy as np
+    _NP_INT, _NP_FLOAT, _NP_NDARRAY = np.integer, np.floating, np.ndarray
+except ImportError:
+    _NP_INT = _NP_FLOAT = _NP_NDARRAY = ()
+
 
 def _json_default(obj: Any):
     if isinstance(obj, (datetime, date, time)):
@@ -28,13 +48,9 @@ def _json_default(obj: Any):
         return obj.decode("utf-8", errors="ignore")
     if isinstance(obj, set):
         return list(obj)
-    try:
-        import numpy as np  # type: ignore
-        if isinstance(obj, np.integer):   return int(obj)
-        if isinstance(obj, np.floating):  return float(obj)
-        if isinstance(obj, np.ndarray):   return obj.tolist()
-    except Exception:
-        pass
+    if isinstance(obj, _NP_INT):      return int(obj)
+    if isinstance(obj, _NP_FLOAT):    return float(obj)
+    if isinstance(obj, _NP_NDARRAY):  return obj.tolist()
     return str(obj)
 
 
@@ -47,28 +63,31 @@ def _to_json_safe(obj: Any) -> Any:
     if isinstance(obj, (list, tuple, set)):
         return [_to_json_safe(v) for v in obj]
     # pydantic v2 BaseModel?
-    try:
-        from pydantic import BaseModel  # type: ignore
-        if isinstance(obj, BaseModel):
-            return _to_json_safe(obj.model_dump(mode="json"))
-    except Exception:
-        pass
+    if BaseModel is not None and isinstance(obj, BaseModel):
+        return _to_json_safe(obj.model_dump(mode="json"))
     # fallback
     return _json_default(obj)
 
 
+def _orjson_default(obj: Any):
+    if BaseModel is not None and isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json")
+    return _json_default(obj)
+
+
 def _save_json(path: Path, payload: Any) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
-    safe = _to_json_safe(payload)
     if orjson:
-        data = orjson.dumps(
-            safe,
-            option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
-        )
-        path.write_bytes(data)
+        # datetime/UUID/Enum/numpy orjson пишет сам за один проход, остальное - через default;
+        # полная копия через _to_json_safe нужна только для того, что orjson не принял
+        try:
+            data = orjson.dumps(payload, default=_orjson_default, option=_ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            data = orjson.dumps(_to_json_safe(payload), option=_ORJSON_OPTIONS)
     else:
-        with path.open("w", encoding="utf-8") as f:
-            json.dump(safe, f, ensure_ascii=False, indent=2, default=_json_default)
+        safe = _to_json_safe(payload)
+        data = json.dumps(safe, ensure_ascii=False, indent=2, default=_json_default).encode("utf-8")
+    write_bytes_atomic(path, data)
 
 
 def _load_json(path: Path) -> Any:
@@ -86,6 +105,8 @@ json_default = _json_default
 
 
 from typing import Optional, Dict
+from functools import lru_cache
+from types import MappingProxyType
 import os, uuid, hashlib
 from datetime import datetime, timezone as _tz
 
@@ -104,9 +125,14 @@ def _now_iso() -> str:
     return datetime.now(_tz.utc).isoformat()
 
 
-def compute_cache_key(ics_content: str, params: Dict[str, Any]) -> str:
-    """Ключ = SHA256(версия + хэш ics + нормализованные параметры)."""
-    ics_hash = hashlib.sha256(ics_content.encode("utf-8")).hexdigest()
+def compute_cache_key(ics_content: str | bytes, params: Dict[str, Any]) -> str:
+    """Ключ = BLAKE2b-128(версия + хэш ics + нормализованные параметры).
+
+    ics можно передать сырыми байтами загрузки: тогда хэш считается до декодирования.
+    """
+    if isinstance(ics_content, str):
+        ics_content = ics_content.encode("utf-8")
+    ics_hash = hashlib.blake2b(ics_content, digest_size=16).hexdigest()
     payload = {
         "v": PIPELINE_VERSION,
         "ics": ics_hash,
@@ -119,19 +145,54 @@ def compute_cache_key(ics_content: str, params: Dict[str, Any]) -> str:
         }
     }
     raw = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
-    return hashlib.sha256(raw).hexdigest()[:32]
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
 
 
-def cache_paths(cache_key: str) -> Dict[str, Path]:
+@lru_cache(maxsize=1024)
+def cache_paths(cache_key: str) -> Mapping[str, Path]:
+    """Пути файлов кеша; набор для ключа строится один раз и только читается"""
     base = CACHE_DIR / cache_key
-    return {
+    return MappingProxyType({
         "base": base,
         "import": base / "import.json",
         "enrich": base / "enrich.json",
         "analyze": base / "analyze.json",
         "recommend": base / "recommend.json",
         "meta": base / "meta.json",
-    }
+        "meta_log": base / "meta.ndjson",
+    })
+
+
+def append_meta_step(path: Path, stage: str, step: Dict[str, Any]) -> None:
+    """Дописывает шаг строкой в meta.ndjson: один write с O_APPEND вместо перезаписи meta.json"""
+    record = {"step": stage, **step}
+    if orjson:
+        line = orjson.dumps(record, default=_json_default) + b"\n"
+    else:
+        line = (json.dumps(record, ensure_ascii=False, default=_json_default) + "\n").encode("utf-8")
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def load_meta(paths: Mapping[str, Path]) -> Dict[str, Any]:
+    """meta.json с шагами из meta.ndjson поверх (поздние записи побеждают)"""
+    meta = _load_json(paths["meta"]) if paths["meta"].exists() else {}
+    steps = meta.setdefault("steps", {})
+    if paths["meta_log"].exists():
+        with open(paths["meta_log"], "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = orjson.loads(line) if orjson else json.loads(line)
+                    steps[record.pop("step")] = record
+                except Exception:
+                    # Оборванную или испорченную строку журнала пропускаем
+                    continue
+    return meta
 
 
 def set_latest_ready_for_session(session_id: Optional[str], cache_key: str) -> None:
@@ -152,3 +213,16 @@ def get_latest_ready_cache_key(session_id: Optional[str]) -> Optional[str]:
         except Exception:
             return None
     return None
+
+
+async def aset_latest_ready_for_session(session_id: Optional[str], cache_key: str) -> None:
+    """set_latest_ready_for_session в потоке"""
+    if session_id:
+        await asyncio.to_thread(set_latest_ready_for_session, session_id, cache_key)
+
+
+async def aget_latest_ready_cache_key(session_id: Optional[str]) -> Optional[str]:
+    """get_latest_ready_cache_key в потоке"""
+    if not session_id:
+        return None
+    return await asyncio.to_thread(get_latest_ready_cache_key, session_id)
@@ -1,13 +1,19 @@
 """
 Сервис импорта и нормализации событий
 """
+import asyncio
 import hashlib
-from datetime import datetime, timedelta, date
-from typing import List, Optional, Set
+import json
+import logging
+from datetime import datetime, timedelta, date, time, timezone as dt_timezone
+from functools import lru_cache
+from operator import attrgetter
+from typing import Any, Dict, List, Optional, Set, Tuple
 from zoneinfo import ZoneInfo
 
 from dateutil import rrule, parser
 from icalendar import Calendar
+from pydantic import TypeAdapter
 
 from app.core.config import settings
 from app.core.schemas import (
@@ -15,96 +21,147 @@ from app.core.schemas import (
 )
 from app.core.db import log_layer_result
 from app.services.cache import cache_service, PipelineStage
+from app.utils.timezones import get_zone
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+_EVENTS_ADAPTER = TypeAdapter(List[Event])
+
+
+def _import_fingerprint(params: Dict[str, Any], ics_content: Optional[str], raw_events: List[RawEvent]) -> str:
+    """BLAKE2b-256 по параметрам импорта, тексту ICS и полям сырых событий.
+
+    Вход идёт в хеш как есть, без model_dump каждого события и без копии
+    ICS в записи кеша.
+    """
+    hasher = hashlib.blake2b(digest_size=32)
+    hasher.update(json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    if ics_content:
+        hasher.update(b"\0ics\0")
+        hasher.update(ics_content.encode("utf-8"))
+    if raw_events:
+        rows = [
+            (e.calendar, e.start, e.end, e.summary, e.description, e.attendees, e.rrule, e.all_day)
+            for e in raw_events
+        ]
+        hasher.update(b"\0events\0")
+        hasher.update(
+            orjson.dumps(rows) if orjson
+            else json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        )
+    return hasher.hexdigest()
+
+
+_BY_START = attrgetter("start")
+
+
+def _extract_attendees(value) -> List[str]:
+    """Участники VEVENT: CN или адрес без mailto:.
+
+    icalendar отдаёт одного участника как vCalAddress, нескольких - списком.
+    """
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        value = [value]
+    attendees = []
+    for attendee in value:
+        params = getattr(attendee, 'params', None)
+        if params is None:
+            continue
+        email = params.get('CN')
+        if email is None:
+            email = str(attendee)
+        attendees.append(email.replace('mailto:', ''))
+    return attendees
+
+# Начало суток для all-day событий и недельного окна
+_MIDNIGHT = time(0, 0)
+
+# Шаг сдвига dtstart для правил, у которых набор повторений периодичен
+_RRULE_PERIODS = {"DAILY": timedelta(days=1), "WEEKLY": timedelta(weeks=1)}
+
+
+def _rrule_params(rule_str: str) -> Optional[Dict[str, str]]:
+    """Параметры однострочного RRULE ('FREQ=WEEKLY;BYDAY=MO' -> dict), None для составных"""
+    if "\n" in rule_str:
+        return None
+    if rule_str.upper().startswith("RRULE:"):
+        rule_str = rule_str[6:]
+    params = {}
+    for part in rule_str.split(";"):
+        name, sep, value = part.partition("=")
+        if sep:
+            params[name.strip().upper()] = value.strip()
+    return params
+
+
+# dtstart шаблона: aware, как и все dtstart импорта, чтобы проверка UNTIL
+# на согласованность таймзон давала ту же ошибку, что и rrulestr
+_RRULE_TEMPLATE_DTSTART = datetime(2000, 1, 1, tzinfo=dt_timezone.utc)
+
+
+@lru_cache(maxsize=256)
+def _rrule_template(rule_str: str) -> rrule.rrule:
+    """Разобранный однострочный RRULE, общий для всех мастеров с этим правилом.
+
+    Конкретный dtstart подставляется через rrule.replace: BYDAY/BYMONTHDAY
+    по умолчанию пересчитываются от нового dtstart.
+    """
+    return rrule.rrulestr(rule_str, dtstart=_RRULE_TEMPLATE_DTSTART)
+
+
+def _parse_rrule_until(value: str, tz) -> Optional[datetime]:
+    """UNTIL из RRULE: дата (весь день включительно) или дата-время, 'Z' - UTC"""
+    try:
+        if len(value) == 8:
+            return datetime.combine(datetime.strptime(value, "%Y%m%d").date(), time.max, tzinfo=tz)
+        if value.endswith("Z"):
+            return datetime.strptime(value[:-1], "%Y%m%dT%H%M%S").replace(tzinfo=dt_timezone.utc)
+        return datetime.strptime(value, "%Y%m%dT%H%M%S").replace(tzinfo=tz)
+    except ValueError:
+        return None
 
 
 class ImporterService:
     """Сервис для импорта и нормализации событий"""
 
     def __init__(self):
-        self.default_tz = ZoneInfo(settings.default_timezone)
+        self.default_tz = get_zone(settings.default_timezone)
 
     async def import_events(self, request: ImportRequest, use_cache: bool = True) -> ImportResponse:
         """Импортирует события из ICS или сырого списка с поддержкой кеширования"""
         
+        # В записи кеша храним только параметры; ICS и сырые события входят в хеш
         cache_input = {
-            "ics_content": request.ics_content,
-            "events": [event.model_dump() if hasattr(event, 'model_dump') else event.dict() for event in request.events] if request.events else None,
             "timezone": request.timezone,
             "expand_recurring": request.expand_recurring,
             "horizon_days": request.horizon_days,
-            "days_limit": request.days_limit
+            "days_limit": request.days_limit,
+            "has_ics": bool(request.ics_content),
+            "events_count": len(request.events)
         }
+        input_hash = _import_fingerprint(cache_input, request.ics_content, request.events)
+
+        # События, посчитанные в этом вызове: при промахе кеша отдаём их,
+        # не разбирая обратно только что сериализованные dict
+        fresh_events: List[Event] = []
 
         async def _compute_import():
             """Внутренняя функция для выполнения импорта"""
-            events = []
-
-            tz = ZoneInfo(request.timezone)
-            now = datetime.now(tz)
-            week_start_date = now.date() - timedelta(days=now.weekday())
-            week_start = datetime.combine(week_start_date, datetime.min.time(), tz)
-
-            if request.days_limit is None:
-                window_start = datetime.min.replace(tzinfo=tz)
-                window_end = datetime.max.replace(tzinfo=tz)
-            else:
-                window_start = week_start - timedelta(days=request.days_limit)
-                window_end = week_start + timedelta(days=7 + request.days_limit)
-
-            if request.ics_content:
-                events.extend(self._parse_ics(
-                    request.ics_content,
-                    request.timezone,
-                    request.expand_recurring,
-                    window_start,
-                    window_end
-                ))
-
-            # Импорт из сырых событий
-            if request.events:
-                for raw_event in request.events:
-                    normalized = self._normalize_event(raw_event, request.timezone)
-                    if not normalized:
-                        continue
-                    if raw_event.rrule and request.expand_recurring:
-                        recurring_events = self._expand_rrule(
-                            raw_event.rrule,
-                            normalized.start,
-                            normalized.end,
-                            window_start,
-                            window_end,
-                            normalized.summary,
-                            normalized.description,
-                            normalized.calendar,
-                            normalized.attendees,
-                            raw_event.all_day or False,
-                        )
-                        events.extend(recurring_events)
-                    else:
-                        if window_start <= normalized.start <= window_end:
-                            events.append(normalized)
-
-            # Фильтрация по оконному диапазону
-            events = [e for e in events if window_start <= e.start <= window_end]
-
-            # Дедупликация
-            events = self._deduplicate_events(events)
-
-            # Сортировка по времени начала
-            events.sort(key=lambda e: e.start)
-
-            # Статистика
-            stats = {
-                "total_imported": len(events),
-                "recurring_expanded": sum(1 for e in events if hasattr(e, '_from_recurring')),
-                "all_day_events": sum(1 for e in events if hasattr(e, '_all_day')),
-                "unique_calendars": len(set(e.calendar for e in events))
-            }
+            # Разбор ICS и разворачивание RRULE - чистый CPU, уводим из event loop
+            events, stats = await asyncio.to_thread(self._import_raw, request)
+            fresh_events.extend(events)
 
             response_data = {
                 "tz": request.timezone,
                 "generated_at": datetime.now(self.default_tz),
-                "events": [event.model_dump() if hasattr(event, 'model_dump') else event.dict() for event in events],
+                "events": _EVENTS_ADAPTER.dump_python(events),
                 "stats": stats
             }
             
@@ -117,13 +174,17 @@ class ImporterService:
                 cache_input,
                 _compute_import,
                 max_age_hours=24,  # Кеш на 24 часа
-                expires_hours=48   # Время жизни 48 часов
+                expires_hours=48,  # Время жизни 48 часов
+                input_hash=input_hash
             )
         else:
             result_data = await _compute_import()
 
-        # Преобразуем обратно в объекты
-        events = [Event.model_validate(event_data) for event_data in result_data["events"]]
+        # Преобразуем обратно в объекты (только для результата из кеша)
+        if fresh_events:
+            events = fresh_events
+        else:
+            events = _EVENTS_ADAPTER.validate_python(result_data["events"])
         
         return ImportResponse(
             tz=result_data["tz"],
@@ -132,6 +193,120 @@ class ImporterService:
             stats=result_data["stats"]
         )
 
+    async def import_events_raw(self, request: ImportRequest) -> ImportResponse:
+        """Импорт без кеша этапа и логирования: события остаются моделями, без dump/validate"""
+        events, stats = await asyncio.to_thread(self._import_raw, request)
+        return ImportResponse(
+            tz=request.timezone,
+            generated_at=datetime.now(self.default_tz),
+            events=events,
+            stats=stats
+        )
+
+    def _import_raw(self, request: ImportRequest) -> Tuple[List[Event], Dict[str, Any]]:
+        """Разбирает, фильтрует по окну, дедуплицирует и сортирует события"""
+        events = []
+
+        tz = get_zone(request.timezone)
+        now = datetime.now(tz)
+        week_start_date = now.date() - timedelta(days=now.weekday())
+        week_start = datetime.combine(week_start_date, _MIDNIGHT, tz)
+
+        if request.days_limit is None:
+            window_start = datetime.min.replace(tzinfo=tz)
+            window_end = datetime.max.replace(tzinfo=tz)
+        else:
+            window_start = week_start - timedelta(days=request.days_limit)
+            window_end = week_start + timedelta(days=7 + request.days_limit)
+
+        if request.ics_content:
+            events.extend(self._parse_ics(
+                request.ics_content,
+                request.timezone,
+                request.expand_recurring,
+                window_start,
+                window_end
+            ))
+
+        # Импорт из сырых событий
+        if request.events:
+            # Строки дат в пакете часто повторяются (расписания, повторный импорт):
+            # каждую уникальную разбираем один раз за импорт. Кеш не переживает
+            # вызов - dateutil дополняет неполные даты сегодняшним днём
+            parsed_dates: Dict[str, Optional[datetime]] = {}
+
+            def parse_date(dt_str: str) -> Optional[datetime]:
+                try:
+                    return parsed_dates[dt_str]
+                except KeyError:
+                    dt = parsed_dates[dt_str] = self._parse_datetime_string(dt_str, tz)
+                    return dt
+
+            for raw_event in request.events:
+                start_dt = parse_date(raw_event.start)
+                if not start_dt:
+                    continue
+                is_recurring = bool(raw_event.rrule and request.expand_recurring)
+                # Одиночные события вне окна отбрасываем по одному start,
+                # не разбирая end и не собирая Event
+                if not is_recurring and not (window_start <= start_dt <= window_end):
+                    continue
+                end_dt = parse_date(raw_event.end)
+                if not end_dt:
+                    continue
+                normalized = self._normalize_event(raw_event, request.timezone, start_dt, end_dt)
+                if not normalized:
+                    continue
+                if is_recurring:
+                    recurring_events = self._expand_rrule(
+                        raw_event.rrule,
+                        normalized.start,
+                        normalized.end,
+                        window_start,
+                        window_end,
+                        normalized.summary,
+                        normalized.description,
+                        normalized.calendar,
+                        normalized.attendees,
+                        raw_event.all_day or False,
+                    )
+                    events.extend(recurring_events)
+                else:
+                    # Окно по start уже проверено выше, до разбора end
+                    events.append(normalized)
+
+        # Фильтрация по окну уже сделана при сборке: каждая ветка кладёт
+        # событие только с window_start <= start <= window_end
+
+        # Дедупликация
+        events = self._deduplicate_events(events)
+
+        # Сортировка по времени начала
+        events.sort(key=_BY_START)
+
+        # Статистика одним проходом. Флаги _from_recurring/_all_day лежат в
+        # __dict__ экземпляра: проверка членства дешевле hasattr, который у
+        # pydantic-модели на промахе проходит через __getattr__ и AttributeError
+        recurring_expanded = 0
+        all_day_events = 0
+        calendars = set()
+        for e in events:
+            flags = e.__dict__
+            if '_from_recurring' in flags:
+                recurring_expanded += 1
+            if '_all_day' in flags:
+                all_day_events += 1
+            calendars.add(e.calendar)
+
+        stats = {
+            "total_imported": len(events),
+            "recurring_expanded": recurring_expanded,
+            "all_day_events": all_day_events,
+            "unique_calendars": len(calendars)
+        }
+
+        return events, stats
+
     def _parse_ics(
             self,
             ics_content: str,
@@ -143,7 +318,7 @@ class ImporterService:
         """Парсит ICS контент"""
 
         events = []
-        tz = ZoneInfo(timezone)
+        tz = get_zone(timezone)
 
         try:
             cal = Calendar.from_ical(ics_content)
@@ -151,17 +326,6 @@ class ImporterService:
 
             for component in cal.walk():
                 if component.name == "VEVENT":
-                    # Базовая информация
-                    summary = str(component.get('SUMMARY', ''))
-                    description = str(component.get('DESCRIPTION', ''))
-
-                    # Участники
-                    attendees = []
-                    for attendee in component.get('ATTENDEE', []):
-                        if hasattr(attendee, 'params'):
-                            email = attendee.params.get('CN', str(attendee))
-                            attendees.append(email.replace('mailto:', ''))
-
                     dtstart = component.get('DTSTART')
                     dtend = component.get('DTEND')
 
@@ -174,9 +338,9 @@ class ImporterService:
                     if is_all_day:
                         # All-day событие
                         if isinstance(dtstart.dt, date):
-                            start_dt = datetime.combine(dtstart.dt, datetime.min.time(), tzinfo=tz)
+                            start_dt = datetime.combine(dtstart.dt, _MIDNIGHT, tzinfo=tz)
                             if dtend and isinstance(dtend.dt, date):
-                                end_dt = datetime.combine(dtend.dt, datetime.min.time(), tzinfo=tz)
+                                end_dt = datetime.combine(dtend.dt, _MIDNIGHT, tzinfo=tz)
                             else:
                                 end_dt = start_dt + timedelta(days=1)
                         else:
@@ -197,6 +361,12 @@ class ImporterService:
                         if not self._intersects(start_dt, end_dt, window_start, window_end):
                             continue
 
+                    # Текстовые поля и участников разбираем только для событий,
+                    # прошедших фильтр окна
+                    summary = str(component.get('SUMMARY', ''))
+                    description = str(component.get('DESCRIPTION', ''))
+                    attendees = _extract_attendees(component.get('ATTENDEE'))
+
                     if rrule_data and expand_recurring:
                         # Разворачиваем RRULE
                         recurring_events = self._expand_rrule(
@@ -228,7 +398,7 @@ class ImporterService:
                             events.append(event)
 
         except Exception as e:
-            print(f"Ошибка парсинга ICS: {e}")
+            logger.warning("Ошибка парсинга ICS: %s", e)
 
         return events
 
@@ -250,12 +420,28 @@ class ImporterService:
         events = []
         duration = end_dt - start_dt
 
+        # Повторения идут от dtstart: мастер, начавшийся после окна, ничего не даст
+        if start_dt >= window_end:
+            return events
+
         try:
-            rule = (
-                rrule.rrulestr(rrule_data, dtstart=start_dt)
-                if isinstance(rrule_data, str)
-                else rrule.rrulestr(rrule_data.to_ical().decode(), dtstart=start_dt)
-            )
+            rule_str = rrule_data if isinstance(rrule_data, str) else rrule_data.to_ical().decode()
+            rule_start = start_dt
+
+            params = _rrule_params(rule_str)
+            if params is not None:
+                # Шаблон из кеша заодно проверяет правило: некорректное уходит
+                # в обработку ошибки до проверок ниже
+                template = _rrule_template(rule_str)
+
+                # Правило закончилось до окна - rrule под этот dtstart не собираем
+                if self._rrule_ends_before(params, start_dt, window_start):
+                    return events
+
+                rule_start = self._fast_forward_rrule_start(params, start_dt, window_start)
+                rule = template.replace(dtstart=rule_start)
+            else:
+                rule = rrule.rrulestr(rule_str, dtstart=rule_start)
 
             occurrences = rule.between(window_start, window_end, inc=False)
             for occurrence in occurrences:
@@ -273,9 +459,10 @@ class ImporterService:
                 events.append(event)
 
         except Exception as e:
-            print(f"Ошибка разворачивания RRULE: {e}")
-            # Возвращаем исходное событие только если оно пересекает окно
-            if self._intersects(start_dt, end_dt, window_start, window_end):
+            logger.warning("Ошибка разворачивания RRULE: %s", e)
+            # Возвращаем исходное событие только если оно пересекает окно и начинается в нём
+            if (self._intersects(start_dt, end_dt, window_start, window_end)
+                    and window_start <= start_dt <= window_end):
                 event = Event(
                     calendar=calendar,
                     start=start_dt,
@@ -290,15 +477,71 @@ class ImporterService:
 
         return events
 
-    def _normalize_event(self, raw_event: RawEvent, timezone: str) -> Optional[Event]:
-        """Нормализует сырое событие"""
+    @staticmethod
+    def _rrule_ends_before(params: Dict[str, str], start_dt: datetime, window_start: datetime) -> bool:
+        """Последнее повторение правила заведомо не позже начала окна.
+
+        UNTIL сравнивается напрямую. COUNT оценивается только для DAILY/WEEKLY
+        без BY*-частей, где повторения идут ровно через INTERVAL периодов;
+        берётся запас в один период.
+        """
+        if "UNTIL" in params:
+            until = _parse_rrule_until(params["UNTIL"], start_dt.tzinfo)
+            if until is not None and until <= window_start:
+                return True
+
+        period = _RRULE_PERIODS.get(params.get("FREQ", "").upper())
+        if period is None or "COUNT" not in params or any(name.startswith("BY") for name in params):
+            return False
+        try:
+            step = period * max(1, int(params.get("INTERVAL", "1")))
+            return start_dt + step * int(params["COUNT"]) <= window_start
+        except (ValueError, OverflowError):
+            return False
+
+    @staticmethod
+    def _fast_forward_rrule_start(
+            params: Dict[str, str],
+            start_dt: datetime,
+            window_start: datetime
+    ) -> datetime:
+        """Сдвигает dtstart старого мастера к окну на целое число периодов правила.
+
+        rrule перебирает повторения от dtstart; для DAILY/WEEKLY без COUNT набор
+        повторений не меняется при сдвиге dtstart на кратное INTERVAL число дней/недель,
+        так что многолетний мастер не проходится с начала. Сдвиг идёт по настенному
+        времени, как и перебор в dateutil.
+        """
+        period = _RRULE_PERIODS.get(params.get("FREQ", "").upper())
+        if period is None or "COUNT" in params:
+            return start_dt
+        try:
+            period *= max(1, int(params.get("INTERVAL", "1")))
+            # Один период запаса: первое повторение окна не может быть раньше сдвинутого dtstart
+            periods = (window_start - start_dt) // period - 1
+        except (ValueError, OverflowError):
+            return start_dt
+        if periods <= 0:
+            return start_dt
+        return start_dt + period * periods
+
+    def _normalize_event(
+            self,
+            raw_event: RawEvent,
+            timezone: str,
+            start_dt: Optional[datetime] = None,
+            end_dt: Optional[datetime] = None
+    ) -> Optional[Event]:
+        """Нормализует сырое событие (start_dt/end_dt - уже разобранные даты, если есть)"""
 
-        tz = ZoneInfo(timezone)
+        tz = get_zone(timezone)
 
         try:
             # Парсим даты
-            start_dt = self._parse_datetime_string(raw_event.start, tz)
-            end_dt = self._parse_datetime_string(raw_event.end, tz)
+            if start_dt is None:
+                start_dt = self._parse_datetime_string(raw_event.start, tz)
+            if end_dt is None:
+                end_dt = self._parse_datetime_string(raw_event.end, tz)
 
             if not start_dt or not end_dt:
                 return None
@@ -320,7 +563,7 @@ class ImporterService:
             return event
 
         except Exception as e:
-            print(f"Ошибка нормализации события: {e}")
+            logger.warning("Ошибка нормализации события: %s", e)
             return None
 
     def _parse_datetime_string(self, dt_str: str, default_tz: ZoneInfo) -> Optional[datetime]:
@@ -330,8 +573,12 @@ class ImporterService:
             return None
 
         try:
-            # Пробуем распарсить с dateutil
-            dt = parser.parse(dt_str)
+            # Быстрый путь - ISO 8601 (в 3.11 понимает и суффикс Z),
+            # полный токенайзер dateutil только для прочих форматов
+            try:
+                dt = datetime.fromisoformat(dt_str)
+            except ValueError:
+                dt = parser.parse(dt_str)
 
             # Если нет таймзоны, добавляем дефолтную
             if dt.tzinfo is None:
@@ -340,7 +587,7 @@ class ImporterService:
             return dt
 
         except Exception as e:
-            print(f"Ошибка парсинга даты {dt_str}: {e}")
+            logger.warning("Ошибка парсинга даты %s: %s", dt_str, e)
             return None
 
     def _normalize_datetime(self, dt, default_tz: ZoneInfo) -> datetime:
@@ -353,7 +600,7 @@ class ImporterService:
 
         # Если это date, конвертируем в datetime
         if isinstance(dt, date):
-            return datetime.combine(dt, datetime.min.time(), tzinfo=default_tz)
+            return datetime.combine(dt, _MIDNIGHT, tzinfo=default_tz)
 
         return datetime.now(default_tz)
 
@@ -365,24 +612,18 @@ class ImporterService:
     def _deduplicate_events(self, events: List[Event]) -> List[Event]:
         """Удаляет дубликаты событий"""
 
-        seen: Set[str] = set()
+        # Ключ - кортеж полей: set сравнивает ключи сам, хешировать их в строку не нужно
+        seen: Set[Tuple[str, datetime, datetime, str]] = set()
         unique_events = []
 
         for event in events:
-            event_hash = self._get_event_hash(event)
+            key = (event.calendar, event.start, event.end, event.summary)
 
-            if event_hash not in seen:
-                seen.add(event_hash)
+            if key not in seen:
+                seen.add(key)
                 unique_events.append(event)
 
         return unique_events
 
-    def _get_event_hash(self, event: Event) -> str:
-        """Создает хеш события для дедупликации"""
-
-        # Используем ключевые поля для создания уникального идентификатора
-        key = f"{event.calendar}|{event.start.isoformat()}|{event.end.isoformat()}|{event.summary}"
-        return hashlib.md5(key.encode()).hexdigest()
-
 
 importer_service = ImporterService()
\ No newline at end of file
@@ -1,14 +1,39 @@
 """
 Сервис для работы с JSON файлами вместо базы данных
 """
+import atexit
 import json
+import logging
 import os
 import hashlib
+import heapq
+import threading
 from datetime import datetime, timedelta
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Set, Tuple
 from pathlib import Path
 import uuid
 
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+try:
+    from pydantic import BaseModel
+except Exception:
+    BaseModel = None
+
+from app.utils.jsonio import write_bytes_atomic
+
+logger = logging.getLogger(__name__)
+
+
+# Через сколько секунд после записи в кеш изменения сбрасываются на диск
+_CACHE_FLUSH_DELAY = 2.0
+
+# Размер файла логов, после которого он уходит в layer_logs.jsonl.1
+_LOGS_ROTATE_BYTES = 4 * 1024 * 1024
+
 
 class JSONStorageService:
     """Сервис для хранения данных в JSON файлах"""
@@ -16,6 +41,29 @@ class JSONStorageService:
     def __init__(self, data_dir: str = "data"):
         self.data_dir = Path(data_dir)
         self.data_dir.mkdir(exist_ok=True)
+        # Чтение-изменение-запись файла задач идёт из потоков asyncio.to_thread:
+        # без блокировки параллельные обновления разных задач затирают друг друга
+        self._tasks_lock = threading.Lock()
+        # Задачи в памяти (перечитываются, если файл записал другой процесс)
+        # и индексы id по сессии и статусу для list_background_tasks
+        self._tasks_mem: Optional[Dict[str, Any]] = None
+        self._tasks_mtime: Optional[int] = None
+        self._tasks_by_session: Dict[str, Set[str]] = {}
+        self._tasks_by_status: Dict[str, Set[str]] = {}
+        # Дозапись и ротация файла логов
+        self._logs_lock = threading.Lock()
+        # Чтение-изменение-запись llm_labels.json из параллельных enrich-запросов
+        self._llm_labels_lock = threading.Lock()
+        # Файлы кеша этапов держим в памяти: этап -> {hash: запись}, перечитываем
+        # только если файл изменился (другой процесс). Новые записи и удаления
+        # копятся в _cache_pending (None - удаление) и пишутся на диск отложенно,
+        # поверх свежей версии файла
+        self._cache_lock = threading.Lock()
+        self._cache_mem: Dict[str, Dict[str, Any]] = {}
+        self._cache_mtime: Dict[str, Optional[int]] = {}
+        self._cache_pending: Dict[str, Dict[str, Optional[Dict[str, Any]]]] = {}
+        self._flush_timer: Optional[threading.Timer] = None
+        atexit.register(self.flush_cache)
     
     def _get_cache_file(self, stage: str) -> Path:
         """Получить путь к файлу кеша для этапа"""
@@ -26,33 +74,45 @@ class JSONStorageService:
         return self.data_dir / "background_tasks.json"
     
     def _get_logs_file(self) -> Path:
-        """Получить путь к файлу логов"""
-        return self.data_dir / "layer_logs.json"
+        """Получить путь к файлу логов (JSONL, по записи на строку, новые - в конце)"""
+        return self.data_dir / "layer_logs.jsonl"
+    
+    def _get_llm_labels_file(self) -> Path:
+        """Получить путь к файлу LLM-классификаций событий"""
+        return self.data_dir / "llm_labels.json"
     
     def _load_json(self, file_path: Path) -> Dict[str, Any]:
         """Загружает JSON файл, возвращает пустой dict если файл не существует"""
         if not file_path.exists():
             return {}
         try:
+            if orjson:
+                return orjson.loads(file_path.read_bytes())
             with open(file_path, 'r', encoding='utf-8') as f:
                 return json.load(f)
-        except (json.JSONDecodeError, IOError):
+        except (ValueError, IOError):
             return {}
     
     def _save_json(self, file_path: Path, data: Dict[str, Any]) -> bool:
-        """Сохраняет данные в JSON файл"""
+        """Сохраняет данные в JSON файл (компактно, атомарно через временный файл)"""
         try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2, default=self._json_serializer)
+            if orjson:
+                # datetime и Enum orjson пишет сам, без вызова default
+                payload = orjson.dumps(data, default=self._json_serializer, option=orjson.OPT_NON_STR_KEYS)
+            else:
+                payload = json.dumps(data, ensure_ascii=False, default=self._json_serializer).encode('utf-8')
+            write_bytes_atomic(file_path, payload)
             return True
         except (IOError, TypeError) as e:
-            print(f"Ошибка сохранения JSON {file_path}: {e}")
+            logger.warning("Ошибка сохранения JSON %s: %s", file_path, e)
             return False
     
     def _json_serializer(self, obj):
-        """Сериализатор для datetime объектов"""
+        """Сериализатор для datetime объектов и pydantic-моделей (логи этапов)"""
         if isinstance(obj, datetime):
             return obj.isoformat()
+        if BaseModel is not None and isinstance(obj, BaseModel):
+            return obj.model_dump(mode="json")
         raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
     
     def _parse_datetime(self, dt_str: str) -> Optional[datetime]:
@@ -65,31 +125,90 @@ class JSONStorageService:
             return None
     
     
+    @staticmethod
+    def _file_mtime(file_path: Path) -> Optional[int]:
+        try:
+            return file_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+    
+    def _stage_entries(self, stage: str) -> Dict[str, Any]:
+        """Записи этапа из памяти; файл читается при первом обращении и после чужой записи.
+        Вызывать под _cache_lock"""
+        cache_file = self._get_cache_file(stage)
+        mtime = self._file_mtime(cache_file)
+        entries = self._cache_mem.get(stage)
+        if entries is None or self._cache_mtime.get(stage) != mtime:
+            entries = self._load_json(cache_file)
+            self._apply_pending(entries, self._cache_pending.get(stage, {}))
+            self._cache_mem[stage] = entries
+            self._cache_mtime[stage] = mtime
+        return entries
+    
+    @staticmethod
+    def _apply_pending(data: Dict[str, Any], pending: Dict[str, Optional[Dict[str, Any]]]) -> None:
+        for input_hash, entry in pending.items():
+            if entry is None:
+                data.pop(input_hash, None)
+            else:
+                data[input_hash] = entry
+    
+    def _rewrite_stage(self, stage: str, mutate) -> int:
+        """Файл этапа + несброшенные изменения -> mutate(data) -> запись на диск, если что-то
+        изменилось. Вызывать под _cache_lock; возвращает результат mutate"""
+        cache_file = self._get_cache_file(stage)
+        data = self._load_json(cache_file)
+        pending = self._cache_pending.pop(stage, {})
+        self._apply_pending(data, pending)
+        result = mutate(data)
+        if pending or result:
+            self._save_json(cache_file, data)
+        self._cache_mem[stage] = data
+        self._cache_mtime[stage] = self._file_mtime(cache_file)
+        return result
+    
+    def _mark_pending(self, stage: str, input_hash: str, entry: Optional[Dict[str, Any]]) -> None:
+        """Запоминает изменение и планирует отложенную запись. Вызывать под _cache_lock"""
+        self._cache_pending.setdefault(stage, {})[input_hash] = entry
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(_CACHE_FLUSH_DELAY, self.flush_cache)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+    
+    def flush_cache(self) -> None:
+        """Записывает накопленные изменения кеша на диск"""
+        with self._cache_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            for stage in list(self._cache_pending):
+                self._rewrite_stage(stage, lambda data: None)
+    
+    def list_cache_hashes(self, stage: str) -> Set[str]:
+        """Хеши всех записей кеша этапа"""
+        with self._cache_lock:
+            return set(self._stage_entries(stage))
+    
     def get_cache_entry(self, stage: str, input_hash: str) -> Optional[Dict[str, Any]]:
         """Получить запись из кеша"""
-        cache_file = self._get_cache_file(stage)
-        cache_data = self._load_json(cache_file)
-        
-        entry = cache_data.get(input_hash)
-        if not entry:
-            return None
-        
-        # Проверяем срок действия
-        expires_at = self._parse_datetime(entry.get('expires_at'))
-        if expires_at and datetime.utcnow() > expires_at:
-            # Удаляем просроченную запись
-            del cache_data[input_hash]
-            self._save_json(cache_file, cache_data)
-            return None
-        
-        return entry
+        with self._cache_lock:
+            cache_data = self._stage_entries(stage)
+            
+            entry = cache_data.get(input_hash)
+            if not entry:
+                return None
+            
+            # Проверяем срок действия; просроченную запись не удаляем на чтении -
+            # её уберёт периодический cleanup_expired_cache
+            expires_at = self._parse_datetime(entry.get('expires_at'))
+            if expires_at and datetime.utcnow() > expires_at:
+                return None
+            
+            return entry
     
     def save_cache_entry(self, stage: str, input_hash: str, input_data: Dict[str, Any], 
                         result_data: Dict[str, Any], expires_at: Optional[datetime] = None) -> bool:
-        """Сохранить запись в кеш"""
-        cache_file = self._get_cache_file(stage)
-        cache_data = self._load_json(cache_file)
-        
+        """Сохранить запись в кеш (на диск - отложенно, см. flush_cache)"""
         entry = {
             "input_hash": input_hash,
             "input_data": input_data,
@@ -98,42 +217,33 @@ class JSONStorageService:
             "expires_at": expires_at.isoformat() if expires_at else None
         }
         
-        cache_data[input_hash] = entry
-        return self._save_json(cache_file, cache_data)
+        with self._cache_lock:
+            self._stage_entries(stage)[input_hash] = entry
+            self._mark_pending(stage, input_hash, entry)
+        return True
     
     def invalidate_cache(self, stage: Optional[str] = None, session_id: Optional[str] = None) -> int:
         """Очистить кеш"""
-        deleted_count = 0
+        def _clear(data: Dict[str, Any]) -> int:
+            count = len(data)
+            data.clear()
+            return count
         
-        if stage:
-            # Очищаем конкретный этап
-            cache_file = self._get_cache_file(stage)
-            if cache_file.exists():
-                cache_data = self._load_json(cache_file)
-                deleted_count = len(cache_data)
-                self._save_json(cache_file, {})
-        else:
-            # Очищаем все этапы
-            for stage_name in ["import", "enrich", "analyze"]:
-                cache_file = self._get_cache_file(stage_name)
-                if cache_file.exists():
-                    cache_data = self._load_json(cache_file)
-                    deleted_count += len(cache_data)
-                    self._save_json(cache_file, {})
+        stages = [stage] if stage else ["import", "enrich", "analyze"]
+        deleted_count = 0
+        with self._cache_lock:
+            for stage_name in stages:
+                deleted_count += self._rewrite_stage(stage_name, _clear)
         
         return deleted_count
     
     def cleanup_expired_cache(self) -> int:
         """Удалить просроченные записи кеша"""
-        deleted_count = 0
         now = datetime.utcnow()
         
-        for stage in ["import", "enrich", "analyze"]:
-            cache_file = self._get_cache_file(stage)
-            cache_data = self._load_json(cache_file)
-            
+        def _drop_expired(data: Dict[str, Any]) -> int:
             expired_keys = []
-            for key, entry in cache_data.items():
+            for key, entry in data.items():
                 expires_at = self._parse_datetime(entry.get('expires_at'))
                 created_at = self._parse_datetime(entry.get('created_at'))
                 
@@ -143,11 +253,13 @@ class JSONStorageService:
                     expired_keys.append(key)
             
             for key in expired_keys:
-                del cache_data[key]
-                deleted_count += 1
-            
-            if expired_keys:
-                self._save_json(cache_file, cache_data)
+                del data[key]
+            return len(expired_keys)
+        
+        deleted_count = 0
+        with self._cache_lock:
+            for stage in ["import", "enrich", "analyze"]:
+                deleted_count += self._rewrite_stage(stage, _drop_expired)
         
         return deleted_count
     
@@ -161,10 +273,11 @@ class JSONStorageService:
         
         for stage in ["import", "enrich", "analyze"]:
             cache_file = self._get_cache_file(stage)
-            cache_data = self._load_json(cache_file)
+            with self._cache_lock:
+                entries_count = len(self._stage_entries(stage))
             
             stage_stats = {
-                "entries": len(cache_data),
+                "entries": entries_count,
                 "size_bytes": cache_file.stat().st_size if cache_file.exists() else 0
             }
             
@@ -175,117 +288,227 @@ class JSONStorageService:
         return stats
     
     
+    def _tasks(self) -> Dict[str, Any]:
+        """Задачи из памяти; файл читается при первом обращении и после чужой записи.
+        Вызывать под _tasks_lock"""
+        tasks_file = self._get_tasks_file()
+        mtime = self._file_mtime(tasks_file)
+        if self._tasks_mem is None or self._tasks_mtime != mtime:
+            self._tasks_mem = self._load_json(tasks_file)
+            self._tasks_mtime = mtime
+            self._index_tasks()
+        return self._tasks_mem
+    
+    def _index_tasks(self) -> None:
+        by_session: Dict[str, Set[str]] = {}
+        by_status: Dict[str, Set[str]] = {}
+        for task_id, task in self._tasks_mem.items():
+            by_session.setdefault(task.get("user_session"), set()).add(task_id)
+            by_status.setdefault(task.get("status"), set()).add(task_id)
+        self._tasks_by_session = by_session
+        self._tasks_by_status = by_status
+    
+    def _store_tasks(self) -> bool:
+        """Пишет задачи из памяти на диск и обновляет индексы. Вызывать под _tasks_lock"""
+        tasks_file = self._get_tasks_file()
+        saved = self._save_json(tasks_file, self._tasks_mem)
+        self._tasks_mtime = self._file_mtime(tasks_file)
+        self._index_tasks()
+        return saved
+    
     def create_background_task(self, task_id: str, task_data: Dict[str, Any]) -> bool:
         """Создать фоновую задачу"""
-        tasks_file = self._get_tasks_file()
-        tasks_data = self._load_json(tasks_file)
-        
-        task_data["task_id"] = task_id
-        task_data["created_at"] = datetime.utcnow().isoformat()
-        
-        tasks_data[task_id] = task_data
-        return self._save_json(tasks_file, tasks_data)
+        with self._tasks_lock:
+            tasks_data = self._tasks()
+
+            task_data["task_id"] = task_id
+            task_data["created_at"] = datetime.utcnow().isoformat()
+
+            tasks_data[task_id] = task_data
+            return self._store_tasks()
     
     def get_background_task(self, task_id: str) -> Optional[Dict[str, Any]]:
         """Получить фоновую задачу"""
-        tasks_file = self._get_tasks_file()
-        tasks_data = self._load_json(tasks_file)
-        return tasks_data.get(task_id)
+        with self._tasks_lock:
+            task = self._tasks().get(task_id)
+            return dict(task) if task is not None else None
     
     def update_background_task(self, task_id: str, updates: Dict[str, Any]) -> bool:
-        """Обновить фоновую задачу"""
-        tasks_file = self._get_tasks_file()
-        tasks_data = self._load_json(tasks_file)
-        
-        if task_id not in tasks_data:
-            return False
-        
-        tasks_data[task_id].update(updates)
-        return self._save_json(tasks_file, tasks_data)
+        """Обновить фоновую задачу.
+
+        Ключ с точками (``"results.import"``) задаёт путь во вложенных словарях,
+        так что статус и результат этапа пишутся одной записью файла.
+        """
+        with self._tasks_lock:
+            tasks_data = self._tasks()
+
+            if task_id not in tasks_data:
+                return False
+
+            task = tasks_data[task_id]
+            for key, value in updates.items():
+                *parents, leaf = key.split(".")
+                target = task
+                for part in parents:
+                    if not isinstance(target.get(part), dict):
+                        target[part] = {}
+                    target = target[part]
+                target[leaf] = value
+            return self._store_tasks()
     
     def list_background_tasks(self, user_session: Optional[str] = None, 
                             status: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
         """Получить список фоновых задач"""
-        tasks_file = self._get_tasks_file()
-        tasks_data = self._load_json(tasks_file)
-        
-        # Фильтрация
-        filtered_tasks = []
-        for task in tasks_data.values():
-            if user_session and task.get("user_session") != user_session:
-                continue
-            if status and task.get("status") != status:
-                continue
-            filtered_tasks.append(task)
-        
-        # Сортировка по дате создания (новые первые)
-        filtered_tasks.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-        
-        return filtered_tasks[:limit]
+        with self._tasks_lock:
+            tasks_data = self._tasks()
+            
+            # Фильтрация по индексам: перебираются только подходящие задачи
+            task_ids: Optional[Set[str]] = None
+            if user_session:
+                task_ids = self._tasks_by_session.get(user_session, set())
+            if status:
+                by_status = self._tasks_by_status.get(status, set())
+                task_ids = by_status if task_ids is None else task_ids & by_status
+            candidates = tasks_data.values() if task_ids is None else (tasks_data[i] for i in task_ids)
+            
+            # Первые limit по дате создания (новые первые): heapq.nlargest вместо полной сортировки
+            newest = heapq.nlargest(limit, candidates, key=lambda x: x.get("created_at", ""))
+            return [dict(task) for task in newest]
     
     def cleanup_old_background_tasks(self, days_old: int = 7) -> int:
         """Удалить старые завершенные задачи"""
-        tasks_file = self._get_tasks_file()
-        tasks_data = self._load_json(tasks_file)
-        
-        cutoff_date = datetime.utcnow() - timedelta(days=days_old)
-        deleted_count = 0
-        
-        tasks_to_delete = []
-        for task_id, task in tasks_data.items():
-            created_at = self._parse_datetime(task.get("created_at"))
-            status = task.get("status")
-            
-            if created_at and created_at < cutoff_date and \
-               status in ["completed", "failed", "cancelled"]:
-                tasks_to_delete.append(task_id)
-        
-        for task_id in tasks_to_delete:
-            del tasks_data[task_id]
-            deleted_count += 1
-        
-        if tasks_to_delete:
-            self._save_json(tasks_file, tasks_data)
-        
-        return deleted_count
+        with self._tasks_lock:
+            tasks_data = self._tasks()
+
+            cutoff_date = datetime.utcnow() - timedelta(days=days_old)
+            deleted_count = 0
+
+            tasks_to_delete = []
+            for task_id, task in tasks_data.items():
+                created_at = self._parse_datetime(task.get("created_at"))
+                status = task.get("status")
+
+                if created_at and created_at < cutoff_date and \
+                   status in ["completed", "failed", "cancelled"]:
+                    tasks_to_delete.append(task_id)
+
+            for task_id in tasks_to_delete:
+                del tasks_data[task_id]
+                deleted_count += 1
+
+            if tasks_to_delete:
+                self._store_tasks()
+
+            return deleted_count
+
+
     
+    def load_llm_labels(self) -> Dict[str, Dict[str, Any]]:
+        """Непросроченные LLM-классификации событий по ключу текста"""
+        now = datetime.utcnow().isoformat()
+        labels = self._load_json(self._get_llm_labels_file())
+        return {k: v for k, v in labels.items() if v.get("expires_at", "") > now}
+    
+    def save_llm_labels(self, labels: Dict[str, Dict[str, Any]]) -> bool:
+        """Дописывает LLM-классификации одной перезаписью файла; просроченные удаляются"""
+        if not labels:
+            return True
+        labels_file = self._get_llm_labels_file()
+        now = datetime.utcnow().isoformat()
+        with self._llm_labels_lock:
+            data = self._load_json(labels_file)
+            data = {k: v for k, v in data.items() if v.get("expires_at", "") > now}
+            data.update(labels)
+            return self._save_json(labels_file, data)
     
     def log_layer_result(self, layer: str, result_data: Dict[str, Any]) -> bool:
         """Логирование результата этапа"""
-        logs_file = self._get_logs_file()
-        logs_data = self._load_json(logs_file)
-        
-        log_id = str(uuid.uuid4())
-        
-        log_entry = {
-            "id": log_id,
-            "layer": layer,
-            "timestamp": datetime.utcnow().isoformat(),
-            "result_data": result_data
-        }
-        
-        # Сохраняем в список (новые записи в начало)
-        if "logs" not in logs_data:
-            logs_data["logs"] = []
-        
-        logs_data["logs"].insert(0, log_entry)
+        return self.log_layer_results([(layer, result_data)])
+    
+    def log_layer_results(self, records: List[Tuple[str, Dict[str, Any]]]) -> bool:
+        """Логирование пачки результатов этапов: одна дозапись строк в конец файла"""
+        if not records:
+            return True
         
-        # Ограничиваем количество логов (оставляем последние 1000)
-        logs_data["logs"] = logs_data["logs"][:1000]
+        timestamp = datetime.utcnow().isoformat()
+        lines = []
+        try:
+            for layer, result_data in records:
+                entry = {
+                    "id": str(uuid.uuid4()),
+                    "layer": layer,
+                    "timestamp": timestamp,
+                    "result_data": result_data
+                }
+                lines.append(self._dump_line(entry))
+        except (TypeError, ValueError) as e:
+            logger.warning("Ошибка сериализации лога: %s", e)
+            return False
         
-        return self._save_json(logs_file, logs_data)
+        logs_file = self._get_logs_file()
+        try:
+            with self._logs_lock:
+                with open(logs_file, 'ab') as f:
+                    f.write(b"".join(lines))
+                    size = f.tell()
+                # Старые записи уходят в .1 целиком, без перезаписи текущего файла
+                if size > _LOGS_ROTATE_BYTES:
+                    os.replace(logs_file, logs_file.with_name(logs_file.name + ".1"))
+            return True
+        except IOError as e:
+            logger.warning("Ошибка записи лога %s: %s", logs_file, e)
+            return False
+    
+    def _dump_line(self, entry: Dict[str, Any]) -> bytes:
+        """Запись лога строкой JSONL"""
+        if orjson:
+            return orjson.dumps(entry, default=self._json_serializer, option=orjson.OPT_NON_STR_KEYS) + b"\n"
+        return (json.dumps(entry, ensure_ascii=False, default=self._json_serializer) + "\n").encode('utf-8')
     
     def get_layer_logs(self, layer: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
-        """Получить логи этапов"""
+        """Получить логи этапов, самые свежие первыми"""
         logs_file = self._get_logs_file()
-        logs_data = self._load_json(logs_file)
-        
-        logs = logs_data.get("logs", [])
-        
-        if layer:
-            logs = [log for log in logs if log.get("layer") == layer]
-        
-        return logs[:limit]
+        logs: List[Dict[str, Any]] = []
+        if limit <= 0:
+            return logs
+        
+        for path in (logs_file, logs_file.with_name(logs_file.name + ".1")):
+            for line in _read_lines_reversed(path):
+                try:
+                    log = orjson.loads(line) if orjson else json.loads(line)
+                except ValueError:
+                    continue
+                if layer and log.get("layer") != layer:
+                    continue
+                logs.append(log)
+                if len(logs) >= limit:
+                    return logs
+        
+        return logs
+
+
+def _read_lines_reversed(path: Path, chunk_size: int = 64 * 1024):
+    """Непустые строки файла с конца к началу; читает блоками с хвоста"""
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        position = f.seek(0, os.SEEK_END)
+        tail = b""
+        while position > 0:
+            step = min(chunk_size, position)
+            position -= step
+            f.seek(position)
+            block = f.read(step) + tail
+            lines = block.split(b"\n")
+            # Первая строка блока может продолжаться в предыдущем блоке
+            tail = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip():
+                    yield line
+        if tail.strip():
+            yield tail
 
 
 # Глобальный экземпляр
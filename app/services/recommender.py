@@ -1,9 +1,11 @@
 """
 Сервис рекомендации оптимальных временных слотов
 """
-from datetime import datetime, timedelta
-from typing import List, Tuple
-from zoneinfo import ZoneInfo
+import heapq
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from operator import itemgetter
+from typing import List, Optional, Tuple
 
 from app.core.config import settings
 from app.core.schemas import (
@@ -11,6 +13,37 @@ from app.core.schemas import (
     TimeSlot, EnrichedEvent, PriorityType
 )
 from app.core.db import log_layer_result
+from app.utils.timezones import get_zone
+
+
+# Событие ближе этого к слоту попадает в conflicts_found
+_NEAR_GAP = timedelta(minutes=30)
+_ZERO = timedelta(0)
+
+
+def _week_adjustment(weekday: int, hour: int) -> Tuple[float, Optional[str]]:
+    if weekday == 0 and hour < 10:
+        # Бонус за утро понедельника для планирования
+        return 0.05, "Начало недели - хорошо для планирования"
+    if weekday == 4 and hour >= 16:
+        # Штраф за пятницу вечер
+        return -0.1, "Пятница вечер - не лучшее время"
+    return 0.0, None
+
+
+# (поправка к score, обоснование) для слота weekday * 24 + hour
+_WEEK_ADJUSTMENTS = tuple(
+    _week_adjustment(weekday, hour)
+    for weekday in range(7)
+    for hour in range(24)
+)
+
+
+@lru_cache(maxsize=256)
+def _parse_hhmm(value: str) -> float:
+    """'09:30' -> 9.5; окна привычек повторяются между запросами"""
+    hour, minute = value.split(':')[:2]
+    return int(hour) + int(minute) / 60
 
 
 class RecommenderService:
@@ -18,16 +51,32 @@ class RecommenderService:
 
     def __init__(self):
         self.scoring_weights = settings.scoring_weights
+        # Веса разворачиваем в кортеж один раз, а не ищем по ключу на каждый слот
+        self._weights: Tuple[float, float, float, float] = (
+            self.scoring_weights["time_preference_match"],
+            self.scoring_weights["no_conflicts"],
+            self.scoring_weights["within_working_hours"],
+            self.scoring_weights["proximity"],
+        )
         self.work_day_start = settings.work_day_start
         self.work_day_end = settings.work_day_end
+        # Таймзона и границы рабочего дня не меняются между запросами
+        self._tz = get_zone(settings.default_timezone)
+        self._work_start_time = time(hour=self.work_day_start)
+        self._work_end_time = time(hour=self.work_day_end)
+        # (score рабочих часов, обоснование) для слота weekday * 24 + hour
+        self._working_hours = tuple(
+            self._working_hours_score(weekday, hour)
+            for weekday in range(7)
+            for hour in range(24)
+        )
         self.buffer_before = timedelta(minutes=settings.event_buffer_before)
         self.buffer_after = timedelta(minutes=settings.event_buffer_after)
 
     async def recommend_slot(self, request: RecommendRequest) -> RecommendResponse:
         """Рекомендует оптимальный слот для нового события"""
 
-        tz = ZoneInfo(settings.default_timezone)
-        now = datetime.now(tz)
+        now = datetime.now(self._tz)
 
         free_slots = self._generate_free_slots(
             request.enriched_events,
@@ -47,23 +96,25 @@ class RecommenderService:
                 conflicts_found=["Календарь полностью занят"],
                 search_stats={"slots_found": 0}
             )
-            await log_layer_result("recommend", response.model_dump())
+            await log_layer_result("recommend", response)
             return response
 
+        # Всё, что не зависит от слота (окно привычек, веса, now), считаем один раз
+        query = request.user_query
+        use_habits = bool(request.history_habits and query.event_type)
+        window = self._parse_window(
+            request.history_habits.default_windows.get(query.event_type) if use_habits else None
+        )
+
         scored_slots = []
         for slot in free_slots:
-            score, rationale = self._score_slot(
-                slot,
-                request.user_query,
-                request.history_habits,
-                request.enriched_events
-            )
-
+            score, rationale = self._score_slot(slot, query, use_habits, window, now)
             scored_slots.append((slot, score, rationale))
 
-        scored_slots.sort(key=lambda x: x[1], reverse=True)
+        # Нужны только лучший и альтернативы; nlargest стабилен как sorted(reverse=True)
+        top_slots = heapq.nlargest(max(request.max_alternatives, 0) + 1, scored_slots, key=lambda x: x[1])
 
-        best_slot, best_score, best_rationale = scored_slots[0]
+        best_slot, best_score, best_rationale = top_slots[0]
         recommendation = SlotRecommendation(
             slot=best_slot,
             score=best_score,
@@ -71,7 +122,7 @@ class RecommenderService:
         )
 
         alternatives = []
-        for slot, score, rationale in scored_slots[1:request.max_alternatives + 1]:
+        for slot, score, rationale in top_slots[1:]:
             alternatives.append(SlotRecommendation(
                 slot=slot,
                 score=score,
@@ -93,7 +144,7 @@ class RecommenderService:
             conflicts_found=conflicts,
             search_stats=search_stats
         )
-        await log_layer_result("recommend", response.model_dump())
+        await log_layer_result("recommend", response)
         return response
 
     def _generate_free_slots(
@@ -115,44 +166,54 @@ class RecommenderService:
                 busy_end = event.end + self.buffer_after
                 busy_intervals.append((busy_start, busy_end))
 
-        # Сортируем и объединяем пересекающиеся интервалы
-        busy_intervals.sort(key=lambda x: x[0])
+        # Сортируем и объединяем пересекающиеся интервалы: текущая группа
+        # держится в двух переменных, кортеж собирается один раз на группу
+        busy_intervals.sort(key=itemgetter(0))
         merged_busy = []
-        for start, end in busy_intervals:
-            if merged_busy and start <= merged_busy[-1][1]:
-                merged_busy[-1] = (merged_busy[-1][0], max(merged_busy[-1][1], end))
-            else:
-                merged_busy.append((start, end))
-
+        if busy_intervals:
+            group_start, group_end = busy_intervals[0]
+            for start, end in busy_intervals[1:]:
+                if start <= group_end:
+                    if end > group_end:
+                        group_end = end
+                else:
+                    merged_busy.append((group_start, group_end))
+                    group_start, group_end = start, end
+            merged_busy.append((group_start, group_end))
+
+        # Даты интервалов считаем один раз, а не на каждый день поиска.
+        # Дни идут по возрастанию: интервалы, закончившиеся до текущего дня,
+        # отбрасываются насовсем (first), а перебор дня обрывается, когда все
+        # оставшиеся интервалы начинаются позже него (суффиксный минимум дат
+        # начала - события могут быть в разных таймзонах, даты не монотонны)
+        busy_dates = [(start.date(), end.date()) for start, end in merged_busy]
+        later_start = [date.max] * (len(busy_dates) + 1)
+        for i in range(len(busy_dates) - 1, -1, -1):
+            later_start[i] = min(busy_dates[i][0], later_start[i + 1])
+        first = 0
+
+        tzinfo = start_from.tzinfo
+        first_date = start_from.date()
         for day in range(days_ahead):
-            current_date = start_from.date() + timedelta(days=day)
+            current_date = first_date + timedelta(days=day)
 
+            day_start = datetime.combine(current_date, self._work_start_time, tzinfo=tzinfo)
             if day == 0:
-                day_start = max(
-                    start_from + timedelta(minutes=30),
-                    datetime.combine(
-                        current_date,
-                        datetime.min.time().replace(hour=self.work_day_start),
-                        tzinfo=start_from.tzinfo
-                    )
-                )
-            else:
-                day_start = datetime.combine(
-                    current_date,
-                    datetime.min.time().replace(hour=self.work_day_start),
-                    tzinfo=start_from.tzinfo
-                )
+                day_start = max(start_from + timedelta(minutes=30), day_start)
 
-            day_end = datetime.combine(
-                current_date,
-                datetime.min.time().replace(hour=self.work_day_end),
-                tzinfo=start_from.tzinfo
-            )
+            day_end = datetime.combine(current_date, self._work_end_time, tzinfo=tzinfo)
 
             current_time = day_start
 
-            for busy_start, busy_end in merged_busy:
-                if busy_start.date() <= current_date <= busy_end.date():
+            while first < len(busy_dates) and busy_dates[first][1] < current_date:
+                first += 1
+
+            for i in range(first, len(busy_dates)):
+                if later_start[i] > current_date:
+                    break
+                start_date, end_date = busy_dates[i]
+                if start_date <= current_date <= end_date:
+                    busy_start, busy_end = merged_busy[i]
                     if current_time < busy_start:
                         free_duration = busy_start - current_time
                         if free_duration >= duration_td:
@@ -174,40 +235,60 @@ class RecommenderService:
 
         return free_slots
 
+    def _working_hours_score(self, weekday: int, hour: int) -> Tuple[float, str]:
+        """Score рабочих часов и обоснование для часа дня недели"""
+        if self.work_day_start <= hour < self.work_day_end:
+            if weekday < 5:  # Будний день
+                return 1.0, "В рабочие часы буднего дня"
+            return 1.0, "В дневное время выходного"
+        return 0.3, "Вне стандартных рабочих часов"  # Штраф за нерабочее время
+
+    @staticmethod
+    def _parse_window(window) -> Optional[Tuple[float, float, str, str]]:
+        """Окно привычек в часах и готовые строки обоснования (None - окна нет)"""
+        if not window:
+            return None
+        return (
+            _parse_hhmm(window.start),
+            _parse_hhmm(window.end),
+            f"Попадает в предпочитаемое окно {window.start}-{window.end}",
+            f"Вне предпочитаемого окна {window.start}-{window.end}",
+        )
+
     def _score_slot(
             self,
             slot: TimeSlot,
             query,
-            history_habits,
-            existing_events: List[EnrichedEvent]
+            use_habits: bool,
+            window: Optional[Tuple[float, float, str, str]],
+            now: datetime
     ) -> Tuple[float, List[str]]:
-        """Оценивает слот и возвращает score и обоснование"""
+        """Оценивает слот и возвращает score и обоснование.
+
+        use_habits/window - разобранное окно привычек (см. _parse_window),
+        now - момент запроса; оба общие для всех слотов.
+        """
 
+        w_time_pref, w_no_conflicts, w_working_hours, w_proximity = self._weights
         score = 0.0
         rationale = []
+        start = slot.start
+        hour = start.hour
+        weekday = start.weekday()
 
         # 1. Соответствие временным предпочтениям
         time_pref_score = 0.0
 
-        if history_habits and query.event_type:
+        if use_habits:
             # Есть данные о привычках
-            window = history_habits.default_windows.get(query.event_type)
             if window:
-                slot_hour = slot.start.hour + slot.start.minute / 60
-
-                # Парсим временное окно
-                window_start_hour = int(window.start.split(':')[0])
-                window_start_min = int(window.start.split(':')[1])
-                window_end_hour = int(window.end.split(':')[0])
-                window_end_min = int(window.end.split(':')[1])
-
-                window_start = window_start_hour + window_start_min / 60
-                window_end = window_end_hour + window_end_min / 60
+                window_start, window_end, inside_note, outside_note = window
+                slot_hour = hour + start.minute / 60
 
                 # Проверяем попадание в окно
                 if window_start <= slot_hour <= window_end:
                     time_pref_score = 1.0
-                    rationale.append(f"Попадает в предпочитаемое окно {window.start}-{window.end}")
+                    rationale.append(inside_note)
                 else:
                     # Чем дальше от окна, тем хуже
                     if slot_hour < window_start:
@@ -217,10 +298,9 @@ class RecommenderService:
 
                     time_pref_score = max(0, 1 - distance / 12)  # Нормализуем на 12 часов
                     if time_pref_score < 0.5:
-                        rationale.append(f"Вне предпочитаемого окна {window.start}-{window.end}")
+                        rationale.append(outside_note)
         else:
             # Используем общие предпочтения по времени суток
-            hour = slot.start.hour
             if query.preferred_time == "morning" and 6 <= hour < 12:
                 time_pref_score = 1.0
                 rationale.append("Утреннее время как запрошено")
@@ -233,33 +313,23 @@ class RecommenderService:
             else:
                 time_pref_score = 0.5  # Нейтральный score
 
-        score += time_pref_score * self.scoring_weights["time_preference_match"]
+        score += time_pref_score * w_time_pref
 
         # 2. Отсутствие конфликтов (уже гарантировано при генерации слотов)
         no_conflicts_score = 1.0
-        score += no_conflicts_score * self.scoring_weights["no_conflicts"]
+        score += no_conflicts_score * w_no_conflicts
         rationale.append("Нет конфликтов с существующими событиями")
 
-        # 3. В пределах рабочих часов
-        working_hours_score = 0.0
-        hour = slot.start.hour
-
-        if self.work_day_start <= hour < self.work_day_end:
-            working_hours_score = 1.0
-            if slot.start.weekday() < 5:  # Будний день
-                rationale.append("В рабочие часы буднего дня")
-            else:
-                rationale.append("В дневное время выходного")
-        else:
-            working_hours_score = 0.3  # Штраф за нерабочее время
-            rationale.append("Вне стандартных рабочих часов")
+        # 3. В пределах рабочих часов - по таблице слотов недели
+        slot_index = weekday * 24 + hour
+        working_hours_score, working_hours_note = self._working_hours[slot_index]
+        rationale.append(working_hours_note)
 
-        score += working_hours_score * self.scoring_weights["within_working_hours"]
+        score += working_hours_score * w_working_hours
 
         # 4. Близость по времени
         proximity_score = 0.0
-        now = datetime.now(slot.start.tzinfo)
-        hours_until = (slot.start - now).total_seconds() / 3600
+        hours_until = (start - now).total_seconds() / 3600
 
         if query.priority_type == PriorityType.HIGH:
             # Для высокого приоритета - чем раньше, тем лучше
@@ -285,19 +355,13 @@ class RecommenderService:
             else:
                 proximity_score = max(0.3, 1 - (hours_until - 72) / 168)
 
-        score += proximity_score * self.scoring_weights["proximity"]
+        score += proximity_score * w_proximity
 
-        # Дополнительные факторы
-
-        # Бонус за утро понедельника для планирования
-        if slot.start.weekday() == 0 and slot.start.hour < 10:
-            score += 0.05
-            rationale.append("Начало недели - хорошо для планирования")
-
-        # Штраф за пятницу вечер
-        if slot.start.weekday() == 4 and slot.start.hour >= 16:
-            score -= 0.1
-            rationale.append("Пятница вечер - не лучшее время")
+        # Дополнительные факторы: утро понедельника, вечер пятницы
+        adjustment, adjustment_note = _WEEK_ADJUSTMENTS[slot_index]
+        if adjustment_note:
+            score += adjustment
+            rationale.append(adjustment_note)
 
         # Нормализуем score в диапазон [0, 1]
         score = max(0.0, min(1.0, score))
@@ -312,27 +376,31 @@ class RecommenderService:
         """Проверяет потенциальные конфликты"""
 
         conflicts = []
+        slot_start, slot_end = slot.start, slot.end
+        slot_date = slot_start.date()
+        day_events = 0
 
-        # Проверяем близкие события (в пределах часа)
+        # Один проход: близкие события (зазор меньше 30 минут) и загруженность дня.
+        # Зазор сравниваем как timedelta, в минуты переводим только совпавшие
         for event in events:
-            time_before = (slot.start - event.end).total_seconds() / 60
-            time_after = (event.start - slot.end).total_seconds() / 60
-
-            if 0 < time_before < 30:
+            time_before = slot_start - event.end
+            if _ZERO < time_before < _NEAR_GAP:
                 conflicts.append(
-                    f"Всего {int(time_before)} минут после '{event.summary}'"
-                )
-            elif 0 < time_after < 30:
-                conflicts.append(
-                    f"Всего {int(time_after)} минут до '{event.summary}'"
+                    f"Всего {int(time_before.total_seconds() / 60)} минут после '{event.summary}'"
                 )
+            else:
+                time_after = event.start - slot_end
+                if _ZERO < time_after < _NEAR_GAP:
+                    conflicts.append(
+                        f"Всего {int(time_after.total_seconds() / 60)} минут до '{event.summary}'"
+                    )
 
-        # Проверяем загруженность дня
-        slot_date = slot.start.date()
-        day_events = [e for e in events if e.start.date() == slot_date]
+            if event.start.date() == slot_date:
+                day_events += 1
 
-        if len(day_events) >= 5:
-            conflicts.append(f"День уже загружен ({len(day_events)} событий)")
+        # Проверяем загруженность дня
+        if day_events >= 5:
+            conflicts.append(f"День уже загружен ({day_events} событий)")
 
         return conflicts
 
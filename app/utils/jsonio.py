@@ -1,4 +1,7 @@
 from __future__ import annotations
+import asyncio
+import os
+import uuid
 from pathlib import Path
 from typing import Any, Mapping
 from datetime import datetime, date, time, timedelta
@@ -13,7 +16,53 @@ try:
 except Exception:
     orjson = None
 
+try:
+    from pydantic import BaseModel
+except Exception:
+    BaseModel = None
+
+# Типы numpy для _json_default; без numpy - пустые кортежи, isinstance(obj, ()) всегда False
+try:
+    import numpy as np
+    _NP_INT, _NP_FLOAT, _NP_NDARRAY = np.integer, np.floating, np.ndarray
+except ImportError:
+    _NP_INT = _NP_FLOAT = _NP_NDARRAY = ()
+
+_ORJSON_COMPACT_OPTIONS = (
+    orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    if orjson else 0
+)
+_ORJSON_OPTIONS = _ORJSON_COMPACT_OPTIONS | (orjson.OPT_INDENT_2 if orjson else 0)
+
+def _isoformat(obj: Any) -> str:
+    return obj.isoformat()
+
+# Точный тип -> преобразование: частые типы без цепочки isinstance;
+# подклассы (Enum, PosixPath и т.п.) уходят в цепочку ниже
+_DEFAULT_BY_TYPE = {
+    datetime: _isoformat,
+    date: _isoformat,
+    time: _isoformat,
+    timedelta: timedelta.total_seconds,
+    ZoneInfo: str,
+    UUID: str,
+    Decimal: float,
+    set: list,
+}
+if _NP_NDARRAY:
+    # Частые типы numpy (stdlib json и to_json_safe их не знают) - тоже без цепочки
+    _DEFAULT_BY_TYPE.update({
+        np.ndarray: np.ndarray.tolist,
+        np.int64: int,
+        np.int32: int,
+        np.float64: float,
+        np.float32: float,
+    })
+
 def _json_default(obj: Any):
+    handler = _DEFAULT_BY_TYPE.get(type(obj))
+    if handler is not None:
+        return handler(obj)
     if isinstance(obj, (datetime, date, time)):
         return obj.isoformat()
     if isinstance(obj, timedelta):
@@ -26,22 +75,14 @@ def _json_default(obj: Any):
         return obj.decode("utf-8", errors="ignore")
     if isinstance(obj, set):
         return list(obj)
-    try:
-        import numpy as np  # type: ignore
-        if isinstance(obj, np.integer):   return int(obj)
-        if isinstance(obj, np.floating):  return float(obj)
-        if isinstance(obj, np.ndarray):   return obj.tolist()
-    except Exception:
-        pass
+    if isinstance(obj, _NP_INT):      return int(obj)
+    if isinstance(obj, _NP_FLOAT):    return float(obj)
+    if isinstance(obj, _NP_NDARRAY):  return obj.tolist()
     return str(obj)
 
 def to_json_safe(obj: Any) -> Any:
-    try:
-        from pydantic import BaseModel  # type: ignore
-        if isinstance(obj, BaseModel):
-            return to_json_safe(obj.model_dump(mode="json"))
-    except Exception:
-        pass
+    if BaseModel is not None and isinstance(obj, BaseModel):
+        return to_json_safe(obj.model_dump(mode="json"))
 
     if obj is None or isinstance(obj, (str, int, float, bool)):
         return obj
@@ -51,16 +92,50 @@ def to_json_safe(obj: Any) -> Any:
         return [to_json_safe(v) for v in obj]
     return _json_default(obj)
 
-def save_json(path: Path, payload: Any) -> None:
+def _orjson_default(obj: Any):
+    if BaseModel is not None and isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json")
+    return _json_default(obj)
+
+def dump_json_bytes(payload: Any) -> bytes:
+    """Компактный JSON в байтах, для ответов, которые собираются вручную"""
+    if orjson:
+        return orjson.dumps(payload, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
+    import json
+    return json.dumps(to_json_safe(payload), ensure_ascii=False).encode("utf-8")
+
+def write_bytes_atomic(path: Path, data: bytes) -> None:
+    """Пишет во временный файл рядом и публикует через os.replace:
+    читатель видит либо старый файл, либо новый целиком"""
+    tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+def save_json(path: Path, payload: Any, indent: bool = True) -> None:
+    """Атомарно сохраняет JSON; indent=False - компактно, для файлов, которые читает только код"""
     path.parent.mkdir(parents=True, exist_ok=True)
-    safe = to_json_safe(payload)
+    if BaseModel is not None and isinstance(payload, BaseModel):
+        # Модель сериализует pydantic-core, без промежуточного dict в Python
+        write_bytes_atomic(path, payload.model_dump_json(indent=2 if indent else None).encode("utf-8"))
+        return
     if orjson:
-        data = orjson.dumps(safe, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
-        path.write_bytes(data)
+        options = _ORJSON_OPTIONS if indent else _ORJSON_COMPACT_OPTIONS
+        # datetime/UUID/Enum/numpy orjson пишет сам, остальное - через default
+        try:
+            data = orjson.dumps(payload, default=_orjson_default, option=options)
+        except orjson.JSONEncodeError:
+            data = orjson.dumps(to_json_safe(payload), option=options)
     else:
+        safe = to_json_safe(payload)
         import json
-        with path.open("w", encoding="utf-8") as f:
-            json.dump(safe, f, ensure_ascii=False, indent=2, default=_json_default)
+        data = json.dumps(
+            safe, ensure_ascii=False, indent=2 if indent else None, default=_json_default
+        ).encode("utf-8")
+    write_bytes_atomic(path, data)
 
 def load_json(path: Path) -> Any:
     if orjson:
@@ -68,3 +143,19 @@ def load_json(path: Path) -> Any:
     import json
     with path.open("r", encoding="utf-8") as f:
         return json.load(f)
+
+async def asave_json(path: Path, payload: Any, indent: bool = True) -> None:
+    """save_json в потоке, чтобы не блокировать event loop"""
+    await asyncio.to_thread(save_json, path, payload, indent)
+
+async def aload_json(path: Path) -> Any:
+    """load_json в потоке, чтобы не блокировать event loop"""
+    return await asyncio.to_thread(load_json, path)
+
+def load_model(path: Path, model: Any) -> Any:
+    """Читает JSON-файл сразу в pydantic-модель (разбор и валидация в pydantic-core)"""
+    return model.model_validate_json(path.read_bytes())
+
+async def aload_model(path: Path, model: Any) -> Any:
+    """load_model в потоке, чтобы не блокировать event loop"""
+    return await asyncio.to_thread(load_model, path, model)
@@ -0,0 +1,69 @@
+"""
+Поиск ключевых слов в тексте одним проходом скомпилированной регулярки
+"""
+from __future__ import annotations
+
+import re
+from typing import Dict, Iterable, List, Mapping, Set, Tuple
+
+
+class KeywordMatcher:
+    """Словарь ключевых слов по категориям, собранный в одну регулярку.
+
+    Результат совпадает с проверкой ``keyword in text`` для каждого слова,
+    но текст сканируется один раз движком ``re``, а не K раз из Python.
+    """
+
+    def __init__(self, keywords_by_category: Mapping[str, Iterable[str]]):
+        self.categories: Tuple[str, ...] = tuple(keywords_by_category)
+
+        keyword_categories: Dict[str, list] = {}
+        for category, keywords in keywords_by_category.items():
+            for keyword in keywords:
+                cats = keyword_categories.setdefault(keyword.lower(), [])
+                if category not in cats:
+                    cats.append(category)
+        self.keyword_categories: Dict[str, Tuple[str, ...]] = {
+            k: tuple(v) for k, v in keyword_categories.items()
+        }
+
+        category_index = {c: i for i, c in enumerate(self.categories)}
+        self._keyword_indices: Dict[str, Tuple[int, ...]] = {
+            k: tuple(category_index[c] for c in cats)
+            for k, cats in self.keyword_categories.items()
+        }
+
+        # Длинные слова первыми: в каждой позиции берём самое длинное совпадение,
+        # а более короткие слова-префиксы добавляем по таблице ниже
+        ordered = sorted(self.keyword_categories, key=len, reverse=True)
+        self._pattern = re.compile("(?=(" + "|".join(map(re.escape, ordered)) + "))")
+        self._prefixes: Dict[str, Tuple[str, ...]] = {
+            k: tuple(p for p in ordered if k.startswith(p)) for k in ordered
+        }
+
+    def search(self, text: str) -> bool:
+        """Есть ли в тексте хотя бы одно ключевое слово"""
+        return self._pattern.search(text) is not None
+
+    def find(self, text: str) -> Set[str]:
+        """Все различные ключевые слова, встречающиеся в тексте"""
+        found: Set[str] = set()
+        for longest in set(self._pattern.findall(text)):
+            found.update(self._prefixes[longest])
+        return found
+
+    def count_by_category(self, text: str) -> List[int]:
+        """Число различных совпавших слов по индексу категории в ``categories``"""
+        counts = [0] * len(self.categories)
+        for keyword in self.find(text):
+            for index in self._keyword_indices[keyword]:
+                counts[index] += 1
+        return counts
+
+    def match_by_category(self, text: str) -> Dict[str, List[str]]:
+        """Совпавшие слова по категориям (категории в порядке объявления)"""
+        matched: Dict[str, List[str]] = {}
+        for keyword in self.find(text):
+            for category in self.keyword_categories[keyword]:
+                matched.setdefault(category, []).append(keyword)
+        return {c: matched[c] for c in self.categories if c in matched}
@@ -0,0 +1,11 @@
+"""
+Кеш объектов таймзон по имени
+"""
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+
+@lru_cache(maxsize=64)
+def get_zone(name: str) -> ZoneInfo:
+    """ZoneInfo по имени; повторные запросы с той же таймзоной не идут в кеш zoneinfo"""
+    return ZoneInfo(name)
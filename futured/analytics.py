@@ -1,6 +1,12 @@
 """
 Страница анализа календаря
 """
+import hashlib
+import json
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
 import streamlit as st
 
 from app.core.config import NAVIGATION
@@ -15,6 +21,28 @@ from app.core.ui_components import (
 )
 
 
+def _events_key(events: List[Dict]) -> str:
+    """Хеш содержимого событий: ключ кешей ниже, одинаковый между перезапусками страницы"""
+    blob = json.dumps(events, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(blob.encode("utf-8"), digest_size=16).hexdigest()
+
+
+@st.cache_data(show_spinner=False)
+def _events_frame(events_key: str, _events: List[Dict]):
+    """DataFrame событий; пересобирается только при смене набора событий"""
+    return process_events_for_analysis(_events)
+
+
+def _build_vector_store(events_key: str, assistant, events: List[Dict]) -> None:
+    """Векторное хранилище строится один раз на набор событий и экземпляр ассистента,
+    а не на каждый rerun. Ключ набора хранится на самом ассистенте: новый экземпляр
+    (даже по адресу удалённого) всегда строит своё хранилище"""
+    if getattr(assistant, "_vector_store_events_key", None) == events_key:
+        return
+    assistant.create_vector_store(events)
+    assistant._vector_store_events_key = events_key
+
+
 def render_analytics_page():
     """Рендер страницы анализа календаря"""
     st.header("📊 Анализ календаря")
@@ -38,7 +66,7 @@ def render_analytics_page():
                         StateManager.set_authorized(True)
                         
                         # Получение email пользователя
-                        user_email = calendar_service.get_user_email(service)
+                        user_email = calendar_service.get_user_email()
                         StateManager.set_user_email(user_email)
                         
                         st.success("✅ Авторизация успешна!")
@@ -55,7 +83,7 @@ def render_analytics_page():
     calendar_service = GoogleCalendarService()
     
     try:
-        calendars = calendar_service.get_calendars(service)
+        calendars = calendar_service.get_calendars(service=service)
         
         # Выбор календарей для анализа
         selected_calendars = render_calendar_selector(calendars)
@@ -70,7 +98,7 @@ def render_analytics_page():
                                            if name in selected_calendars}
                         
                         user_email = StateManager.get_user_email()
-                        events_data = calendar_service.fetch_events(service, filtered_calendars, user_email)
+                        events_data = calendar_service.fetch_events(filtered_calendars, user_email, service=service)
                         
                         st.success(f"✅ Загружено {len(events_data[0]['events'])} событий")
                         st.rerun()
@@ -94,8 +122,10 @@ def render_analytics_page():
                 if not events:
                     render_info_message("Нет событий для анализа. Сначала импортируйте события из календаря.")
                 else:
-                    # Обработка событий для анализа
-                    df = process_events_for_analysis(events)
+                    # Обработка событий для анализа (виджеты перезапускают страницу -
+                    # DataFrame и векторное хранилище берём из кеша по хешу событий)
+                    events_key = _events_key(events)
+                    df = _events_frame(events_key, events)
                     
                     # Выбор календарей для отображения
                     available_cals = sorted(df["calendar"].unique())
@@ -108,11 +138,11 @@ def render_analytics_page():
                     if selected_calendars_display:
                         df_selected = df[df["calendar"].isin(selected_calendars_display)]
 
-                        # Подсчёт частотности по дням недели и часам для timetable/сетки
-                        weekday_hour_counts = {}
-                        for _, row in df_selected.iterrows():
-                            key = (row["weekday"], row["hour"])
-                            weekday_hour_counts[key] = weekday_hour_counts.get(key, 0) + 1
+                        # Подсчёт частотности по дням недели и часам для timetable/сетки:
+                        # ключи - кортежи (weekday, hour), как у прежнего цикла по строкам
+                        weekday_hour_counts = df_selected.groupby(["weekday", "hour"]).size().to_dict()
+                        # weekday - 0..6: счётчики по дням без сортировки и хеширования
+                        weekday_counts = np.bincount(df_selected['weekday'].to_numpy(dtype=np.int64), minlength=7)
 
                         viz_options = ["Heatmap", "Timetable", "Bar Chart"]
                         choice = st.radio("🔍 Выберите тип визуализации:", viz_options, index=1)
@@ -131,8 +161,7 @@ def render_analytics_page():
                             render_weekly_timetable_plotly(weekday_hour_counts)
                         else:
                             st.subheader("📊 Количество событий по дням недели")
-                            counts = df_selected['weekday'].value_counts().reindex(range(7), fill_value=0)
-                            counts.index = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+                            counts = pd.Series(weekday_counts, index=["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"])
                             st.bar_chart(counts)
 
                         # # Подсчёт частотности для timetable
@@ -157,7 +186,7 @@ def render_analytics_page():
                         with col3:
                             if not df_selected.empty:
                                 day_names = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
-                                most_busy_day = int(df_selected['weekday'].value_counts().idxmax())
+                                most_busy_day = int(weekday_counts.argmax())
                                 st.metric("Самый загруженный день", day_names[most_busy_day])
                             else:
                                 st.metric("Самый загруженный день", "Н/Д")
@@ -171,7 +200,7 @@ def render_analytics_page():
                         
                         # Создание векторного хранилища
                         try:
-                            ai_assistant.create_vector_store(events)
+                            _build_vector_store(events_key, ai_assistant, events)
                             st.success("✅ Векторное хранилище создано для семантического поиска")
                         except Exception as e:
                             render_warning_message(f"Не удалось создать векторное хранилище: {str(e)}")
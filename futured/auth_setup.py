@@ -9,6 +9,7 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 
 SCOPES = ['https://www.googleapis.com/auth/calendar']
+CREDENTIALS_FILE = '../../credentials.json'
 
 def setup_google_auth():
     """Настройка авторизации Google Calendar"""
@@ -16,8 +17,12 @@ def setup_google_auth():
     print("🔧 Настройка авторизации Google Calendar")
     print("=" * 50)
     
-    # Проверка наличия credentials.json
-    if not os.path.exists('../../credentials.json'):
+    # Проверка наличия credentials.json: файл читаем один раз,
+    # отсутствие - по FileNotFoundError, без отдельной проверки exists
+    try:
+        with open(CREDENTIALS_FILE, 'rb') as f:
+            credentials_blob = f.read()
+    except FileNotFoundError:
         print("❌ Файл credentials.json не найден!")
         print("\n📋 Инструкции:")
         print("1. Перейдите в Google Cloud Console")
@@ -31,7 +36,7 @@ def setup_google_auth():
         
         # Создание flow для авторизации
         print("\n🔐 Запуск авторизации...")
-        flow = InstalledAppFlow.from_client_secrets_file('../../credentials.json', SCOPES)
+        flow = InstalledAppFlow.from_client_config(json.loads(credentials_blob), SCOPES)
         
         # Запуск локального сервера для авторизации
         print("🌐 Откроется браузер для авторизации...")
@@ -4,18 +4,53 @@
 import json
 import os
 import shutil
+import time
+import weakref
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Optional
+from operator import itemgetter
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
 
-import pandas as pd
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+try:
+    import orjson
+except Exception:
+    orjson = None
 
 from app.core.config import SCOPES, CREDENTIALS_FILE, TOKEN_FILE, DATA_FILE, DEFAULT_CALENDAR_ID, EVENT_FETCH_DAYS, MAX_EVENTS
 
 
+# Максимум запросов в одном batch-запросе Google Calendar API
+_BATCH_LIMIT = 50
+
+# Смещение таймзоны в конце dateTime ('...T10:00:00+03:00', '...T10:00:00Z')
+_TZ_SUFFIX_RE = r"(T[\d:.]+)(?:Z|[+-]\d{2}:?\d{2})$"
+
+# Сколько секунд переиспользуем ответ calendarList().list()
+_CALENDAR_LIST_TTL = 300
+
+# сервис -> (время загрузки, items). На уровне модуля, а не экземпляра: Streamlit
+# создаёт GoogleCalendarService заново на каждый rerun, а сервис живёт в состоянии
+# сессии. Слабые ключи - запись уходит вместе с сервисом, сессии не пересекаются
+_calendar_list_cache: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+_NS_PER_MINUTE = 60 * 10**9
+_NS_PER_HOUR = 60 * _NS_PER_MINUTE
+_NS_PER_DAY = 24 * _NS_PER_HOUR
+
+# С Python 3.11 fromisoformat сам понимает суффикс 'Z' - замена строки не нужна
+try:
+    datetime.fromisoformat("2020-01-01T00:00:00Z")
+    _ISO_NATIVE_Z = True
+except ValueError:
+    _ISO_NATIVE_Z = False
+
+
 class GoogleCalendarService:
     """Сервис для работы с Google Calendar"""
     
@@ -25,6 +60,10 @@ class GoogleCalendarService:
     
     def get_service(self):
         """Получение сервиса Google Calendar"""
+        # Пока токен действителен, повторно используем уже собранный сервис
+        if self.service is not None and self.credentials is not None and self.credentials.valid:
+            return self.service
+
         try:
             creds = None
             
@@ -51,79 +90,186 @@ class GoogleCalendarService:
                     token.write(creds.to_json())
             
             self.credentials = creds
-            self.service = build('calendar', 'v3', credentials=creds)
+            # googleapiclient (с httplib2) нужен только здесь - импортируем при первой сборке.
+            # Discovery-документ берём из поставки googleapiclient, без запроса по сети
+            from googleapiclient.discovery import build
+
+            self.service = build(
+                'calendar', 'v3', credentials=creds,
+                static_discovery=True, cache_discovery=False,
+            )
             return self.service
             
         except Exception as e:
             raise Exception(f"Ошибка получения сервиса Google Calendar: {str(e)}")
     
-    def get_user_email(self, service) -> str:
+    def _resolve_service(self, service=None):
+        """Явно переданный сервис (например, из состояния сессии или в тестах) или собственный"""
+        return service if service is not None else self.get_service()
+    
+    def _get_calendar_list(self, service, force_refresh: bool = False) -> List[Dict]:
+        """Список календарей пользователя; один запрос на _CALENDAR_LIST_TTL секунд"""
+        try:
+            cached = None if force_refresh else _calendar_list_cache.get(service)
+        except TypeError:
+            # Объект без поддержки weakref (например, простой мок) - без кеша
+            cached = None
+        if cached is not None and time.monotonic() - cached[0] < _CALENDAR_LIST_TTL:
+            return cached[1]
+        items = service.calendarList().list().execute().get('items', [])
+        try:
+            _calendar_list_cache[service] = (time.monotonic(), items)
+        except TypeError:
+            pass
+        return items
+    
+    def get_user_email(self, service=None) -> str:
         """Получение email пользователя"""
+        service = self._resolve_service(service)
         try:
-            calendar_list = service.calendarList().list().execute()
-            for calendar in calendar_list.get('items', []):
+            for calendar in self._get_calendar_list(service):
                 if calendar.get('primary'):
                     return calendar.get('id')
             return "unknown@example.com"
         except Exception:
             return "unknown@example.com"
     
-    def get_calendars(self, service) -> Dict[str, str]:
+    def get_calendars(self, service=None) -> Dict[str, str]:
         """Получение списка календарей"""
+        service = self._resolve_service(service)
         try:
-            calendar_list = service.calendarList().list().execute()
             calendars = {}
-            for calendar in calendar_list.get('items', []):
+            for calendar in self._get_calendar_list(service):
                 calendars[calendar['summary']] = calendar['id']
             return calendars
         except Exception as e:
             raise Exception(f"Ошибка получения календарей: {str(e)}")
     
-    def create_event(self, service, summary: str, start_dt: datetime, end_dt: datetime, 
+    @staticmethod
+    def _event_body(summary: str, start_dt: datetime, end_dt: datetime,
+                    description: str = "", attendees: List[str] = None) -> Dict:
+        """Тело запроса events().insert"""
+        event = {
+            'summary': summary,
+            'description': description,
+            'start': {
+                'dateTime': start_dt.isoformat(),
+                'timeZone': 'Europe/Moscow',
+            },
+            'end': {
+                'dateTime': end_dt.isoformat(),
+                'timeZone': 'Europe/Moscow',
+            },
+        }
+        
+        if attendees:
+            event['attendees'] = [{'email': email} for email in attendees]
+        return event
+    
+    def create_event(self, summary: str, start_dt: datetime, end_dt: datetime, 
                     description: str = "", attendees: List[str] = None, 
-                    calendar_id: str = DEFAULT_CALENDAR_ID) -> Optional[str]:
+                    calendar_id: str = DEFAULT_CALENDAR_ID, service=None) -> Optional[str]:
         """Создание события в календаре"""
+        service = self._resolve_service(service)
         try:
-            event = {
-                'summary': summary,
-                'description': description,
-                'start': {
-                    'dateTime': start_dt.isoformat(),
-                    'timeZone': 'Europe/Moscow',
-                },
-                'end': {
-                    'dateTime': end_dt.isoformat(),
-                    'timeZone': 'Europe/Moscow',
-                },
-            }
-            
-            if attendees:
-                event['attendees'] = [{'email': email} for email in attendees]
-            
+            event = self._event_body(summary, start_dt, end_dt, description, attendees)
             created = service.events().insert(calendarId=calendar_id, body=event).execute()
             return created.get('htmlLink', None)
             
         except Exception as e:
             raise Exception(f"Ошибка создания события: {str(e)}")
     
-    def fetch_events(self, service, calendar_ids: Dict[str, str], user_email: str) -> List[Dict]:
+    def create_events_batch(self, events: Iterable[Dict], calendar_id: str = DEFAULT_CALENDAR_ID,
+                            service=None) -> List[Optional[str]]:
+        """Массовое создание событий batch-запросами (до 50 вставок в одном HTTP).
+
+        Элементы ``events`` - словари с аргументами ``create_event`` (summary, start_dt,
+        end_dt и необязательные description, attendees, calendar_id). Возвращает
+        ссылки на созданные события в том же порядке.
+        """
+        service = self._resolve_service(service)
+        links: Dict[str, Optional[str]] = {}
+        errors: List[Exception] = []
+
+        def _collect(request_id, response, exception):
+            if exception is not None:
+                errors.append(exception)
+            else:
+                links[request_id] = response.get('htmlLink', None)
+
+        try:
+            events = list(events)
+            for offset in range(0, len(events), _BATCH_LIMIT):
+                batch = service.new_batch_http_request(callback=_collect)
+                for index in range(offset, min(offset + _BATCH_LIMIT, len(events))):
+                    item = events[index]
+                    body = self._event_body(
+                        item['summary'], item['start_dt'], item['end_dt'],
+                        item.get('description', ""), item.get('attendees'),
+                    )
+                    batch.add(
+                        service.events().insert(calendarId=item.get('calendar_id', calendar_id), body=body),
+                        request_id=str(index),
+                    )
+                batch.execute()
+
+            if errors:
+                raise errors[0]
+            return [links.get(str(index)) for index in range(len(events))]
+
+        except Exception as e:
+            raise Exception(f"Ошибка создания событий: {str(e)}")
+    
+    def fetch_events(self, calendar_ids: Dict[str, str], user_email: str, service=None) -> List[Dict]:
         """Загрузка событий из календарей"""
+        service = self._resolve_service(service)
         now = datetime.now()
         time_min = (now - timedelta(days=EVENT_FETCH_DAYS)).isoformat() + 'Z'
         time_max = (now + timedelta(days=EVENT_FETCH_DAYS)).isoformat() + 'Z'
 
+        # Запросы по всем календарям уходят batch-запросами (до 50 в одном HTTP),
+        # а не по одному round-trip на календарь. Колбэк вызывается внутри
+        # batch.execute() в этом же потоке; ответы раскладываем по индексу календаря
+        names = list(calendar_ids)
+        items_by_index: Dict[str, List[Dict]] = {}
+        errors: List[Exception] = []
+
+        def _collect(request_id, response, exception):
+            if exception is not None:
+                errors.append(exception)
+            else:
+                items_by_index[request_id] = response.get('items', [])
+
+        for offset in range(0, len(names), _BATCH_LIMIT):
+            batch = service.new_batch_http_request(callback=_collect)
+            for index in range(offset, min(offset + _BATCH_LIMIT, len(names))):
+                batch.add(service.events().list(
+                    calendarId=calendar_ids[names[index]],
+                    timeMin=time_min,
+                    timeMax=time_max,
+                    maxResults=MAX_EVENTS,
+                    singleEvents=True,
+                    orderBy='startTime'
+                ), request_id=str(index))
+            batch.execute()
+
+        if errors:
+            raise errors[0]
+
         all_events = []
-        for name, calendar_id in calendar_ids.items():
-            events = service.events().list(
-                calendarId=calendar_id,
-                timeMin=time_min,
-                timeMax=time_max,
-                maxResults=MAX_EVENTS,
-                singleEvents=True,
-                orderBy='startTime'
-            ).execute().get('items', [])
+        # Одна встреча часто лежит в нескольких календарях (организатор, участники,
+        # общий календарь) с тем же id - оставляем первое вхождение
+        seen_ids = set()
+        for index, name in enumerate(names):
+            events = items_by_index.get(str(index), [])
 
             for event in events:
+                event_id = event.get('id')
+                if event_id:
+                    if event_id in seen_ids:
+                        continue
+                    seen_ids.add(event_id)
+
                 start = event['start'].get('dateTime') or event['start'].get('date')
                 end = event['end'].get('dateTime') or event['end'].get('date')
                 summary = event.get('summary', '[Без названия]')
@@ -133,6 +279,7 @@ class GoogleCalendarService:
                 
                 if start and end:
                     all_events.append({
+                        "id": event_id,
                         "calendar": name,
                         "start": start,
                         "end": end,
@@ -150,8 +297,9 @@ class GoogleCalendarService:
         self._safe_write_data(json_data)
         return json_data
     
-    def find_conflicts(self, service, calendar_id: str, start_dt: datetime, end_dt: datetime) -> List[Dict]:
+    def find_conflicts(self, calendar_id: str, start_dt: datetime, end_dt: datetime, service=None) -> List[Dict]:
         """Поиск конфликтов в календаре"""
+        service = self._resolve_service(service)
         try:
             start_utc = start_dt.astimezone(timezone.utc).isoformat()
             end_utc = end_dt.astimezone(timezone.utc).isoformat()
@@ -168,68 +316,111 @@ class GoogleCalendarService:
     def _safe_write_data(self, json_data: List[Dict]):
         """Безопасная запись данных в файл"""
         try:
-            # Удаляем calendar_data.json если это директория
-            if os.path.exists(DATA_FILE) and os.path.isdir(DATA_FILE):
+            # Пишем во временный файл и подменяем через os.replace: читатель видит
+            # старый файл или новый целиком, без окна, когда файла нет
+            tmp_file = f"{DATA_FILE}.tmp"
+            with open(tmp_file, "wb") as f:
+                _write_events_json(f, json_data)
+            try:
+                os.replace(tmp_file, DATA_FILE)
+            except IsADirectoryError:
+                # На месте calendar_data.json оказалась директория - удаляем её
                 shutil.rmtree(DATA_FILE)
-            
-            # Удаляем файл если он существует (для перезаписи)
-            if os.path.exists(DATA_FILE) and os.path.isfile(DATA_FILE):
-                os.remove(DATA_FILE)
-            
-            # Создаем новый файл
-            with open(DATA_FILE, "w", encoding="utf-8") as f:
-                json.dump(json_data, f, indent=2, ensure_ascii=False)
-                
+                os.replace(tmp_file, DATA_FILE)
+
         except Exception as e:
             raise Exception(f"Ошибка записи в {DATA_FILE}: {str(e)}")
     
     def load_events_data(self) -> Optional[List[Dict]]:
         """Загрузка данных событий из файла"""
         try:
-            if os.path.exists(DATA_FILE):
-                if os.path.isdir(DATA_FILE):
-                    shutil.rmtree(DATA_FILE)
-                    return None
-                elif os.path.isfile(DATA_FILE) and os.path.getsize(DATA_FILE) > 0:
-                    with open(DATA_FILE, "r", encoding="utf-8") as f:
-                        return json.load(f)
+            with open(DATA_FILE, "rb") as f:
+                content = f.read()
+            if not content:
+                return None
+            return orjson.loads(content) if orjson else json.loads(content)
+        except FileNotFoundError:
+            return None
+        except IsADirectoryError:
+            shutil.rmtree(DATA_FILE)
             return None
         except Exception as e:
             raise Exception(f"Ошибка чтения {DATA_FILE}: {str(e)}")
 
 
+def _dumps(value) -> bytes:
+    """Сериализация одного значения в JSON-байты"""
+    if orjson:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, ensure_ascii=False).encode("utf-8")
+
+
+def _write_events_json(f, json_data: List[Dict]) -> None:
+    """Потоковая запись [{"user": ..., "events": [...]}]: события пишутся
+    по одному на строку, целиком файл в памяти не собирается"""
+    f.write(b"[")
+    for block_index, block in enumerate(json_data):
+        if block_index:
+            f.write(b",")
+        events = block.get("events")
+        if not isinstance(events, list):
+            f.write(b"\n" + _dumps(block))
+            continue
+
+        # Шапка блока без events: '{"user":"..."' + ',"events":['
+        head = _dumps({key: value for key, value in block.items() if key != "events"})
+        f.write(b"\n" + head[:-1] + (b"," if len(head) > 2 else b"") + b'"events":[')
+        for event_index, event in enumerate(events):
+            f.write((b",\n" if event_index else b"\n") + _dumps(event))
+        f.write(b"\n]}")
+    f.write(b"\n]\n")
+
+
 def normalize_datetime(datetime_str: str) -> datetime:
     """Нормализация datetime строки"""
     if 'T' in datetime_str:  # datetime с временем
-        dt = datetime.fromisoformat(datetime_str.replace('Z', '+00:00'))
+        if not _ISO_NATIVE_Z:
+            datetime_str = datetime_str.replace('Z', '+00:00')
+        dt = datetime.fromisoformat(datetime_str)
         return dt.replace(tzinfo=None)  # Конвертируем в локальное время без timezone
     else:  # только дата
         return datetime.fromisoformat(datetime_str)
 
 
-def process_events_for_analysis(events: List[Dict]) -> pd.DataFrame:
-    """Обработка событий для анализа"""
-    records = []
-    for e in events:
-        # Нормализуем datetime объекты
-        start_str = e["start"]
-        end_str = e["end"]
-        
-        start_dt = normalize_datetime(start_str)
-        end_dt = normalize_datetime(end_str)
-        
-        weekday = start_dt.weekday()
-        hour = start_dt.hour
-        duration_min = (end_dt - start_dt).total_seconds() / 60
-        
-        records.append({
-            "calendar": e["calendar"],
-            "summary": e["summary"],
-            "start": start_dt,
-            "end": end_dt,
-            "weekday": weekday,
-            "hour": hour,
-            "duration_min": duration_min
-        })
-    
-    return pd.DataFrame(records)
+def process_events_for_analysis(events: List[Dict]) -> "pd.DataFrame":
+    """Обработка событий для анализа: DataFrame собирается по столбцам,
+    даты разбирает pandas, а не normalize_datetime на каждую строку"""
+    # pandas/numpy тяжёлые при импорте, а нужны только для анализа:
+    # OAuth-поток и миграции, импортирующие модуль, их не загружают
+    import numpy as np
+    import pandas as pd
+
+    # Столбцы достаём одним проходом по событиям и сразу задаём им тип:
+    # pandas не выводит dtype по списку словарей и не консолидирует блоки
+    columns = ("calendar", "summary", "start", "end")
+    values = zip(*map(itemgetter(*columns), events)) if events else ((),) * len(columns)
+    data = {name: pd.Series(column, dtype=object) for name, column in zip(columns, values)}
+
+    # Как normalize_datetime: смещение у dateTime отбрасываем (остаётся время
+    # события, без перевода в UTC), дата без времени - полночь
+    for column in ("start", "end"):
+        data[column] = pd.to_datetime(
+            data[column].str.replace(_TZ_SUFFIX_RE, r"\1", regex=True),
+            format="ISO8601",
+        )
+
+    # Календарей единицы, а названия у повторяющихся встреч совпадают:
+    # храним коды категорий, а не строку в каждой строке
+    data["calendar"] = data["calendar"].astype("category")
+    data["summary"] = data["summary"].astype("category")
+    # Числовые признаки для группировок - узкие типы, без object-столбцов.
+    # Считаем их целочисленной арифметикой по наносекундам, без .dt-аксессоров
+    start_ns = data["start"].to_numpy(dtype="datetime64[ns]").view("i8")
+    end_ns = data["end"].to_numpy(dtype="datetime64[ns]").view("i8")
+    days, day_ns = np.divmod(start_ns, _NS_PER_DAY)
+    # 1970-01-01 - четверг (weekday 3); // и % в numpy округляют вниз и до 1970 года
+    data["weekday"] = pd.Series(((days + 3) % 7).astype(np.int8), copy=False)
+    data["hour"] = pd.Series((day_ns // _NS_PER_HOUR).astype(np.int8), copy=False)
+    data["duration_min"] = pd.Series(((end_ns - start_ns) / _NS_PER_MINUTE).astype(np.float32), copy=False)
+
+    return pd.DataFrame(data, copy=False)
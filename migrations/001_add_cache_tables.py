@@ -3,7 +3,7 @@ Migration: Add cache tables for pipeline results
 Created: 2025-01-XX
 """
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine
 from app.core.config import settings
 
 CREATE_PIPELINE_CACHE_TABLE = """
@@ -52,13 +52,9 @@ def upgrade():
     """Применить миграцию"""
     engine = create_engine(settings.database_url, future=True)
     
-    with engine.connect() as conn:
-        conn.execute(text(CREATE_PIPELINE_CACHE_TABLE))
-        
-        conn.execute(text(CREATE_USER_SESSIONS_TABLE))
-        
-        # Коммитим изменения
-        conn.commit()
+    # Оба скрипта уходят одним запросом в одной транзакции: при ошибке DDL откатывается целиком
+    with engine.begin() as conn:
+        conn.exec_driver_sql(CREATE_PIPELINE_CACHE_TABLE + CREATE_USER_SESSIONS_TABLE)
         
     print("✅ Cache tables created successfully")
 
@@ -67,12 +63,9 @@ def downgrade():
     """Откатить миграцию"""
     engine = create_engine(settings.database_url, future=True)
     
-    with engine.connect() as conn:
+    with engine.begin() as conn:
         # Удаляем таблицы кеша
-        conn.execute(text(DROP_CACHE_TABLES))
-        
-        # Коммитим изменения
-        conn.commit()
+        conn.exec_driver_sql(DROP_CACHE_TABLES)
         
     print("✅ Cache tables dropped successfully")
 
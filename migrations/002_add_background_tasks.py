@@ -3,7 +3,7 @@ Migration: Add background tasks table
 Created: 2025-01-XX
 """
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine
 from app.core.config import settings
 
 CREATE_BACKGROUND_TASKS_TABLE = """
@@ -38,11 +38,25 @@ CREATE INDEX IF NOT EXISTS idx_background_tasks_task_type ON background_tasks(ta
 CREATE INDEX IF NOT EXISTS idx_background_tasks_status ON background_tasks(status);
 CREATE INDEX IF NOT EXISTS idx_background_tasks_created_at ON background_tasks(created_at);
 
--- Добавляем constraint для статуса
-ALTER TABLE background_tasks ADD CONSTRAINT chk_status 
-CHECK (status IN ('pending', 'running', 'completed', 'failed', 'cancelled'));
+-- Constraint'ы пересоздаём, чтобы миграцию можно было применить повторно.
+-- chk_status - только пока status VARCHAR: после 007 (или create_all) это
+-- enum taskstatus, и строчные значения для него недопустимы
+DO $$
+BEGIN
+    IF (SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'background_tasks'
+          AND column_name = 'status') = 'character varying' THEN
+        ALTER TABLE background_tasks DROP CONSTRAINT IF EXISTS chk_status;
+
+        -- Добавляем constraint для статуса
+        ALTER TABLE background_tasks ADD CONSTRAINT chk_status
+        CHECK (status IN ('pending', 'running', 'completed', 'failed', 'cancelled'));
+    END IF;
+END $$;
 
 -- Добавляем constraint для прогресса
+ALTER TABLE background_tasks DROP CONSTRAINT IF EXISTS chk_progress;
 ALTER TABLE background_tasks ADD CONSTRAINT chk_progress 
 CHECK (progress >= 0 AND progress <= 100);
 """
@@ -57,11 +71,8 @@ def upgrade():
     """Применить миграцию"""
     engine = create_engine(settings.database_url, future=True)
     
-    with engine.connect() as conn:
-        conn.execute(text(CREATE_BACKGROUND_TASKS_TABLE))
-        
-        # Коммитим изменения
-        conn.commit()
+    with engine.begin() as conn:
+        conn.exec_driver_sql(CREATE_BACKGROUND_TASKS_TABLE)
         
     print("✅ Background tasks table created successfully")
 
@@ -70,12 +81,9 @@ def downgrade():
     """Откатить миграцию"""
     engine = create_engine(settings.database_url, future=True)
     
-    with engine.connect() as conn:
+    with engine.begin() as conn:
         # Удаляем таблицу фоновых задач
-        conn.execute(text(DROP_BACKGROUND_TASKS_TABLE))
-        
-        # Коммитим изменения
-        conn.commit()
+        conn.exec_driver_sql(DROP_BACKGROUND_TASKS_TABLE)
         
     print("✅ Background tasks table dropped successfully")
 
@@ -0,0 +1,76 @@
+"""
+Migration: Add composite and partial indexes for cache and task lookups
+Created: 2025-01-XX
+"""
+
+from sqlalchemy import create_engine
+from app.core.config import settings
+
+CREATE_COMPOSITE_INDEXES = """
+-- Оставляем только самую свежую запись для каждой пары (stage, input_hash)
+DELETE FROM pipeline_cache a
+USING pipeline_cache b
+WHERE a.stage = b.stage
+  AND a.input_hash = b.input_hash
+  AND a.id < b.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_pipeline_cache_stage_hash ON pipeline_cache(stage, input_hash);
+DROP INDEX IF EXISTS idx_pipeline_cache_stage;
+DROP INDEX IF EXISTS idx_pipeline_cache_hash;
+
+CREATE INDEX IF NOT EXISTS ix_background_tasks_type_status ON background_tasks(task_type, status);
+
+-- Строчные значения в условии - только пока status VARCHAR; для enum taskstatus
+-- (после 007 или create_all) частичный индекс создаёт 007
+DO $$
+BEGIN
+    IF (SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'background_tasks'
+          AND column_name = 'status') = 'character varying' THEN
+        CREATE INDEX IF NOT EXISTS ix_background_tasks_active ON background_tasks(created_at)
+        WHERE status IN ('pending', 'running');
+    END IF;
+END $$;
+"""
+
+# SQL для отката миграции
+DROP_COMPOSITE_INDEXES = """
+DROP INDEX IF EXISTS ix_background_tasks_active;
+DROP INDEX IF EXISTS ix_background_tasks_type_status;
+DROP INDEX IF EXISTS ix_pipeline_cache_stage_hash;
+
+CREATE INDEX IF NOT EXISTS idx_pipeline_cache_stage ON pipeline_cache(stage);
+CREATE INDEX IF NOT EXISTS idx_pipeline_cache_hash ON pipeline_cache(input_hash);
+"""
+
+
+def upgrade():
+    """Применить миграцию"""
+    engine = create_engine(settings.database_url, future=True)
+    
+    with engine.begin() as conn:
+        conn.exec_driver_sql(CREATE_COMPOSITE_INDEXES)
+        
+    print("✅ Composite indexes created successfully")
+
+
+def downgrade():
+    """Откатить миграцию"""
+    engine = create_engine(settings.database_url, future=True)
+    
+    with engine.begin() as conn:
+        conn.exec_driver_sql(DROP_COMPOSITE_INDEXES)
+        
+    print("✅ Composite indexes dropped successfully")
+
+
+if __name__ == "__main__":
+    import sys
+    
+    if len(sys.argv) > 1 and sys.argv[1] == "downgrade":
+        print("🔄 Rolling back composite indexes migration...")
+        downgrade()
+    else:
+        print("🚀 Applying composite indexes migration...")
+        upgrade()
\ No newline at end of file
@@ -0,0 +1,73 @@
+"""
+Migration: Store pipeline results as JSONB with lz4 TOAST compression
+Created: 2025-01-XX
+"""
+
+from sqlalchemy import create_engine
+from app.core.config import settings
+
+ALTER_RESULT_COLUMNS = """
+-- Таблицы, созданные через SQLAlchemy create_all, могли получить json вместо jsonb
+ALTER TABLE pipeline_cache
+    ALTER COLUMN input_data TYPE JSONB USING input_data::jsonb,
+    ALTER COLUMN result_data TYPE JSONB USING result_data::jsonb;
+
+ALTER TABLE background_tasks
+    ALTER COLUMN input_data TYPE JSONB USING input_data::jsonb,
+    ALTER COLUMN import_result TYPE JSONB USING import_result::jsonb,
+    ALTER COLUMN enrich_result TYPE JSONB USING enrich_result::jsonb,
+    ALTER COLUMN analyze_result TYPE JSONB USING analyze_result::jsonb;
+
+-- lz4 быстрее pglz и применяется к новым значениям (Postgres 14+)
+ALTER TABLE pipeline_cache
+    ALTER COLUMN input_data SET COMPRESSION lz4,
+    ALTER COLUMN result_data SET COMPRESSION lz4;
+
+ALTER TABLE background_tasks
+    ALTER COLUMN import_result SET COMPRESSION lz4,
+    ALTER COLUMN enrich_result SET COMPRESSION lz4,
+    ALTER COLUMN analyze_result SET COMPRESSION lz4;
+"""
+
+# SQL для отката миграции
+RESET_COMPRESSION = """
+ALTER TABLE pipeline_cache
+    ALTER COLUMN input_data SET COMPRESSION DEFAULT,
+    ALTER COLUMN result_data SET COMPRESSION DEFAULT;
+
+ALTER TABLE background_tasks
+    ALTER COLUMN import_result SET COMPRESSION DEFAULT,
+    ALTER COLUMN enrich_result SET COMPRESSION DEFAULT,
+    ALTER COLUMN analyze_result SET COMPRESSION DEFAULT;
+"""
+
+
+def upgrade():
+    """Применить миграцию"""
+    engine = create_engine(settings.database_url, future=True)
+    
+    with engine.begin() as conn:
+        conn.exec_driver_sql(ALTER_RESULT_COLUMNS)
+        
+    print("✅ Result columns switched to JSONB with lz4 compression")
+
+
+def downgrade():
+    """Откатить миграцию"""
+    engine = create_engine(settings.database_url, future=True)
+    
+    with engine.begin() as conn:
+        conn.exec_driver_sql(RESET_COMPRESSION)
+        
+    print("✅ Result columns compression reset successfully")
+
+
+if __name__ == "__main__":
+    import sys
+    
+    if len(sys.argv) > 1 and sys.argv[1] == "downgrade":
+        print("🔄 Rolling back JSONB compression migration...")
+        downgrade()
+    else:
+        print("🚀 Applying JSONB compression migration...")
+        upgrade()
\ No newline at end of file
@@ -0,0 +1,52 @@
+"""
+Migration: Replace full expires_at index on pipeline_cache with a partial one
+Created: 2025-01-XX
+"""
+
+from sqlalchemy import create_engine
+from app.core.config import settings
+
+CREATE_PARTIAL_EXPIRES_INDEX = """
+-- Записи без срока жизни никогда не удаляются по expires_at, в индексе они не нужны
+DROP INDEX IF EXISTS idx_pipeline_cache_expires;
+DROP INDEX IF EXISTS ix_pipeline_cache_expires_at;
+CREATE INDEX IF NOT EXISTS ix_pipeline_cache_expires_at ON pipeline_cache(expires_at)
+WHERE expires_at IS NOT NULL;
+"""
+
+# SQL для отката миграции
+RESTORE_FULL_EXPIRES_INDEX = """
+DROP INDEX IF EXISTS ix_pipeline_cache_expires_at;
+CREATE INDEX IF NOT EXISTS idx_pipeline_cache_expires ON pipeline_cache(expires_at);
+"""
+
+
+def upgrade():
+    """Применить миграцию"""
+    engine = create_engine(settings.database_url, future=True)
+    
+    with engine.begin() as conn:
+        conn.exec_driver_sql(CREATE_PARTIAL_EXPIRES_INDEX)
+        
+    print("✅ Partial expires_at index created successfully")
+
+
+def downgrade():
+    """Откатить миграцию"""
+    engine = create_engine(settings.database_url, future=True)
+    
+    with engine.begin() as conn:
+        conn.exec_driver_sql(RESTORE_FULL_EXPIRES_INDEX)
+        
+    print("✅ Full expires_at index restored successfully")
+
+
+if __name__ == "__main__":
+    import sys
+    
+    if len(sys.argv) > 1 and sys.argv[1] == "downgrade":
+        print("🔄 Rolling back partial expires_at index migration...")
+        downgrade()
+    else:
+        print("🚀 Applying partial expires_at index migration...")
+        upgrade()
\ No newline at end of file
@@ -0,0 +1,122 @@
+"""
+Migration: Store timestamps as TIMESTAMP WITH TIME ZONE with server-side now() defaults
+Created: 2025-01-XX
+"""
+
+from sqlalchemy import create_engine
+from app.core.config import settings
+
+ALTER_TIMESTAMPS = """
+-- Старые значения писались через datetime.utcnow(), т.е. это UTC без таймзоны.
+-- Переводим только колонки, которые ещё TIMESTAMP: для TIMESTAMPTZ (повторный
+-- запуск или схема из create_all) AT TIME ZONE 'UTC' вернул бы время без зоны,
+-- и значения сдвинулись бы на смещение TimeZone сервера
+DO $$
+DECLARE
+    col record;
+BEGIN
+    FOR col IN
+        SELECT table_name, column_name FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND data_type = 'timestamp without time zone'
+          AND (table_name, column_name) IN (
+              ('pipeline_cache', 'created_at'), ('pipeline_cache', 'expires_at'),
+              ('user_sessions', 'created_at'), ('user_sessions', 'last_accessed'),
+              ('background_tasks', 'created_at'), ('background_tasks', 'started_at'),
+              ('background_tasks', 'completed_at')
+          )
+    LOOP
+        -- quote_ident вместо format(): знак процента в тексте запроса драйвер принял бы за параметр
+        EXECUTE 'ALTER TABLE ' || quote_ident(col.table_name)
+            || ' ALTER COLUMN ' || quote_ident(col.column_name)
+            || ' TYPE TIMESTAMPTZ USING ' || quote_ident(col.column_name)
+            || ' AT TIME ZONE ''UTC''';
+    END LOOP;
+END $$;
+
+ALTER TABLE pipeline_cache ALTER COLUMN created_at SET DEFAULT now();
+ALTER TABLE user_sessions
+    ALTER COLUMN created_at SET DEFAULT now(),
+    ALTER COLUMN last_accessed SET DEFAULT now();
+ALTER TABLE background_tasks ALTER COLUMN created_at SET DEFAULT now();
+
+UPDATE pipeline_cache SET created_at = now() WHERE created_at IS NULL;
+UPDATE user_sessions SET created_at = now() WHERE created_at IS NULL;
+UPDATE user_sessions SET last_accessed = now() WHERE last_accessed IS NULL;
+UPDATE background_tasks SET created_at = now() WHERE created_at IS NULL;
+
+ALTER TABLE pipeline_cache ALTER COLUMN created_at SET NOT NULL;
+ALTER TABLE user_sessions
+    ALTER COLUMN created_at SET NOT NULL,
+    ALTER COLUMN last_accessed SET NOT NULL;
+ALTER TABLE background_tasks ALTER COLUMN created_at SET NOT NULL;
+"""
+
+# SQL для отката миграции: обратно переводятся только колонки, которые ещё TIMESTAMPTZ
+RESTORE_TIMESTAMPS = """
+ALTER TABLE pipeline_cache ALTER COLUMN created_at DROP NOT NULL;
+ALTER TABLE user_sessions
+    ALTER COLUMN created_at DROP NOT NULL,
+    ALTER COLUMN last_accessed DROP NOT NULL;
+ALTER TABLE background_tasks ALTER COLUMN created_at DROP NOT NULL;
+
+DO $$
+DECLARE
+    col record;
+BEGIN
+    FOR col IN
+        SELECT table_name, column_name FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND data_type = 'timestamp with time zone'
+          AND (table_name, column_name) IN (
+              ('pipeline_cache', 'created_at'), ('pipeline_cache', 'expires_at'),
+              ('user_sessions', 'created_at'), ('user_sessions', 'last_accessed'),
+              ('background_tasks', 'created_at'), ('background_tasks', 'started_at'),
+              ('background_tasks', 'completed_at')
+          )
+    LOOP
+        -- quote_ident вместо format(): знак процента в тексте запроса драйвер принял бы за параметр
+        EXECUTE 'ALTER TABLE ' || quote_ident(col.table_name)
+            || ' ALTER COLUMN ' || quote_ident(col.column_name)
+            || ' TYPE TIMESTAMP USING ' || quote_ident(col.column_name)
+            || ' AT TIME ZONE ''UTC''';
+    END LOOP;
+END $$;
+
+ALTER TABLE pipeline_cache ALTER COLUMN created_at SET DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE user_sessions
+    ALTER COLUMN created_at SET DEFAULT CURRENT_TIMESTAMP,
+    ALTER COLUMN last_accessed SET DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE background_tasks ALTER COLUMN created_at SET DEFAULT CURRENT_TIMESTAMP;
+"""
+
+
+def upgrade():
+    """Применить миграцию"""
+    engine = create_engine(settings.database_url, future=True)
+    
+    with engine.begin() as conn:
+        conn.exec_driver_sql(ALTER_TIMESTAMPS)
+        
+    print("✅ Timestamp columns switched to TIMESTAMPTZ successfully")
+
+
+def downgrade():
+    """Откатить миграцию"""
+    engine = create_engine(settings.database_url, future=True)
+    
+    with engine.begin() as conn:
+        conn.exec_driver_sql(RESTORE_TIMESTAMPS)
+        
+    print("✅ Timestamp columns restored to TIMESTAMP successfully")
+
+
+if __name__ == "__main__":
+    import sys
+    
+    if len(sys.argv) > 1 and sys.argv[1] == "downgrade":
+        print("🔄 Rolling back TIMESTAMPTZ migration...")
+        downgrade()
+    else:
+        print("🚀 Applying TIMESTAMPTZ migration...")
+        upgrade()
\ No newline at end of file
@@ -0,0 +1,80 @@
+"""
+Migration: Store background task status as the taskstatus enum used by the ORM model
+Created: 2025-01-XX
+"""
+
+from sqlalchemy import create_engine
+from app.core.config import settings
+
+CONVERT_STATUS_TO_ENUM = """
+-- Модель хранит статус как native enum taskstatus (имена членов TaskStatus),
+-- а таблица из миграции 002 - как VARCHAR со строчными значениями и CHECK
+DO $$
+BEGIN
+    CREATE TYPE taskstatus AS ENUM ('PENDING', 'RUNNING', 'COMPLETED', 'FAILED', 'CANCELLED');
+EXCEPTION
+    WHEN duplicate_object THEN NULL;
+END $$;
+
+-- CHECK и условие частичного индекса ссылаются на строки - пересоздаём после смены типа
+ALTER TABLE background_tasks DROP CONSTRAINT IF EXISTS chk_status;
+DROP INDEX IF EXISTS ix_background_tasks_active;
+
+ALTER TABLE background_tasks ALTER COLUMN status DROP DEFAULT;
+ALTER TABLE background_tasks
+    ALTER COLUMN status TYPE taskstatus USING upper(status::text)::taskstatus;
+ALTER TABLE background_tasks ALTER COLUMN status SET DEFAULT 'PENDING';
+
+-- Очередь активных задач: индекс только по pending/running, без истории
+CREATE INDEX IF NOT EXISTS ix_background_tasks_active ON background_tasks(created_at)
+WHERE status IN ('PENDING', 'RUNNING');
+"""
+
+# SQL для отката миграции
+RESTORE_STATUS_VARCHAR = """
+DROP INDEX IF EXISTS ix_background_tasks_active;
+
+ALTER TABLE background_tasks ALTER COLUMN status DROP DEFAULT;
+ALTER TABLE background_tasks
+    ALTER COLUMN status TYPE VARCHAR(20) USING lower(status::text);
+ALTER TABLE background_tasks ALTER COLUMN status SET DEFAULT 'pending';
+
+ALTER TABLE background_tasks ADD CONSTRAINT chk_status
+CHECK (status IN ('pending', 'running', 'completed', 'failed', 'cancelled'));
+
+CREATE INDEX IF NOT EXISTS ix_background_tasks_active ON background_tasks(created_at)
+WHERE status IN ('pending', 'running');
+
+DROP TYPE IF EXISTS taskstatus;
+"""
+
+
+def upgrade():
+    """Применить миграцию"""
+    engine = create_engine(settings.database_url, future=True)
+    
+    with engine.begin() as conn:
+        conn.exec_driver_sql(CONVERT_STATUS_TO_ENUM)
+        
+    print("✅ Task status switched to taskstatus enum successfully")
+
+
+def downgrade():
+    """Откатить миграцию"""
+    engine = create_engine(settings.database_url, future=True)
+    
+    with engine.begin() as conn:
+        conn.exec_driver_sql(RESTORE_STATUS_VARCHAR)
+        
+    print("✅ Task status restored to VARCHAR successfully")
+
+
+if __name__ == "__main__":
+    import sys
+    
+    if len(sys.argv) > 1 and sys.argv[1] == "downgrade":
+        print("🔄 Rolling back task status enum migration...")
+        downgrade()
+    else:
+        print("🚀 Applying task status enum migration...")
+        upgrade()
\ No newline at end of file
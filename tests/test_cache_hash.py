@@ -6,3 +6,9 @@ def test_create_hash_handles_datetime():
     data = {"when": datetime(2024, 1, 1, 12, 0, 0)}
     h = create_hash(data)
     assert isinstance(h, str) and len(h) == 64
+
+
+def test_create_hash_ignores_key_order():
+    a = {"tz": "Europe/Moscow", "events": [{"summary": "x", "start": datetime(2024, 1, 1)}]}
+    b = {"events": [{"start": datetime(2024, 1, 1), "summary": "x"}], "tz": "Europe/Moscow"}
+    assert create_hash(a) == create_hash(b)
@@ -2,6 +2,8 @@ import pytest
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
+from dateutil import rrule
+
 from app.services.importer import importer_service
 from app.core.schemas import ImportRequest, RawEvent
 
@@ -42,4 +44,56 @@ async def test_days_limit_filters_events():
     response = await importer_service.import_events(request)
 
     assert len(response.events) == 1
-    assert response.events[0].summary == "inside"
\ No newline at end of file
+    assert response.events[0].summary == "inside"
+
+# Быстрый путь разворачивания RRULE (шаблон, отсечение по UNTIL/COUNT, сдвиг
+# dtstart старого мастера) должен давать те же повторения, что и rrulestr напрямую
+_WINDOW_START = datetime(2025, 6, 1, 0, 0)
+_WINDOW_END = datetime(2025, 7, 1, 0, 0)
+
+
+def _plain_rrule_starts(rule, start, end, window_start, window_end):
+    try:
+        return rrule.rrulestr(rule, dtstart=start).between(window_start, window_end, inc=False)
+    except Exception:
+        # Как и _expand_rrule: некорректное правило - только сам мастер, если он в окне
+        return [start] if window_start <= start <= window_end and end > window_start else []
+
+
+@pytest.mark.parametrize("tz", ["Europe/Moscow", "Europe/Berlin"])
+@pytest.mark.parametrize("master_start", [
+    datetime(2015, 3, 2, 9, 30),   # мастер на десять лет старше окна
+    datetime(2025, 5, 27, 18, 0),  # мастер незадолго до окна
+])
+@pytest.mark.parametrize("rule", [
+    "FREQ=DAILY",
+    "FREQ=DAILY;INTERVAL=3",
+    "FREQ=WEEKLY",
+    "FREQ=WEEKLY;INTERVAL=2",
+    "FREQ=WEEKLY;BYDAY=MO,WE,FR",
+    "FREQ=WEEKLY;INTERVAL=2;BYDAY=TU,TH",
+    "FREQ=DAILY;UNTIL=20250610",
+    "FREQ=WEEKLY;UNTIL=20200101",
+    "FREQ=DAILY;UNTIL=20250610T060000Z",
+    "FREQ=WEEKLY;BYDAY=MO;UNTIL=20200101T000000Z",
+    "FREQ=DAILY;COUNT=10",
+    "FREQ=WEEKLY;INTERVAL=2;COUNT=5",
+    "FREQ=WEEKLY;BYDAY=MO,TH;COUNT=400",
+    "FREQ=MONTHLY;BYMONTHDAY=15",
+    "RRULE:FREQ=DAILY;INTERVAL=2",
+])
+def test_expand_rrule_matches_plain_rrulestr(rule, master_start, tz):
+    zone = ZoneInfo(tz)
+    start = master_start.replace(tzinfo=zone)
+    end = start + timedelta(hours=1)
+    window_start = _WINDOW_START.replace(tzinfo=zone)
+    window_end = _WINDOW_END.replace(tzinfo=zone)
+
+    events = importer_service._expand_rrule(
+        rule, start, end, window_start, window_end,
+        summary="s", description="", calendar="cal", attendees=[],
+    )
+
+    expected = _plain_rrule_starts(rule, start, end, window_start, window_end)
+    assert [e.start for e in events] == expected
+    assert all(e.end - e.start == end - start for e in events)
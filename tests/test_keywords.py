@@ -0,0 +1,14 @@
+from app.utils.keywords import KeywordMatcher
+
+
+def test_matcher_finds_overlapping_and_prefix_keywords():
+    matcher = KeywordMatcher({
+        "travel": ["поезд", "поездка"],
+        "creative": ["art"],
+        "family": ["party"],
+    })
+    matched = matcher.match_by_category("поездка на party")
+    assert sorted(matched["travel"]) == ["поезд", "поездка"]
+    assert matched["creative"] == ["art"]
+    assert list(matched) == ["travel", "creative", "family"]
+    assert not matcher.search("ничего")